@@ -1,4 +1,4 @@
-from flask import Flask, render_template, request, jsonify, redirect, url_for, flash, send_from_directory, session, send_file
+from flask import Flask, render_template, request, jsonify, redirect, url_for, flash, send_from_directory, session, send_file, g
 from werkzeug.utils import secure_filename
 from flask_login import LoginManager, login_user, logout_user, login_required, current_user
 from functools import wraps
@@ -6,6 +6,8 @@ from datetime import datetime, timedelta
 import json
 import os
 import re
+import time
+import threading
 import zipfile
 import shutil
 import tempfile
@@ -38,25 +40,46 @@ DATA_DIR = app.config['DATA_DIR']
 # Đảm bảo thư mục data tồn tại
 os.makedirs(DATA_DIR, exist_ok=True)
 
-# Khởi tạo storage - tất cả file dữ liệu trong thư mục data
-user_storage = CSVUserStorage(csv_file=os.path.join(DATA_DIR, 'users.csv'))
-file_storage = FileStorage(
-    notes_dir=os.path.join(DATA_DIR, 'notes'),
-    docs_dir=os.path.join(DATA_DIR, 'docs'),
-    metadata_file=os.path.join(DATA_DIR, 'metadata.json'),
-    uploads_dir=os.path.join(DATA_DIR, 'uploads')
-)
+# Khởi tạo storage - STORAGE_BACKEND='database' dùng SQLALCHEMY_DATABASE_URI,
+# mặc định tất cả file dữ liệu (CSV/JSON) trong thư mục data
+USE_DATABASE = app.config.get('STORAGE_BACKEND') == 'database'
+if USE_DATABASE:
+    from db_storage import init_database, DatabaseUserStorage, DatabaseFileStorage
+    init_database(app)
+    user_storage = DatabaseUserStorage(app)
+    file_storage = DatabaseFileStorage(app, data_dir=DATA_DIR)
+else:
+    user_storage = CSVUserStorage(csv_file=os.path.join(DATA_DIR, 'users.csv'))
+    file_storage = FileStorage(
+        notes_dir=os.path.join(DATA_DIR, 'notes'),
+        docs_dir=os.path.join(DATA_DIR, 'docs'),
+        metadata_file=os.path.join(DATA_DIR, 'metadata.json'),
+        uploads_dir=os.path.join(DATA_DIR, 'uploads')
+    )
 
-# Edit logs storage
-edit_logs_file = os.path.join(DATA_DIR, 'edit_logs.json')
+# Edit logs storage (log append-only chia segment theo ngày trong data/edit_logs/)
+from edit_log_storage import EditLogStorage, make_content_delta, apply_content_delta, is_content_delta, content_delta_ops
+edit_log_storage = EditLogStorage(data_dir=DATA_DIR)
 # Categories storage
 categories_file = os.path.join(DATA_DIR, 'categories.json')
 # Chat storage
-from chat_storage import ChatStorage
-chat_storage = ChatStorage(data_dir=DATA_DIR)
+if USE_DATABASE:
+    from db_storage import DatabaseChatStorage
+    chat_storage = DatabaseChatStorage(app, data_dir=DATA_DIR)
+else:
+    from chat_storage import ChatStorage
+    chat_storage = ChatStorage(data_dir=DATA_DIR)
 # Notification storage
 from notification_storage import NotificationStorage
 notification_storage = NotificationStorage(data_dir=DATA_DIR)
+# Event bus cho realtime (Server-Sent Events), dùng chung giữa các gunicorn worker qua file log
+from event_bus import EventBus
+event_bus = EventBus(data_dir=DATA_DIR)
+# Mỗi kết nối realtime giữ 1 thread gthread: giới hạn số kết nối cùng lúc trong worker này
+realtime_slots = threading.BoundedSemaphore(app.config.get('REALTIME_MAX_CONNECTIONS', 16))
+# Hàng đợi job nền (thông báo, edit log, search index) để request không phải chờ các tác vụ phụ
+from job_queue import JobQueue
+job_queue = JobQueue(data_dir=DATA_DIR)
 
 # Scheduled tasks
 from apscheduler.schedulers.background import BackgroundScheduler
@@ -66,7 +89,7 @@ import atexit
 # Khởi tạo scheduler với timezone
 scheduler = BackgroundScheduler(timezone=utc)
 
-# Task: Cleanup old messages mỗi 6 giờ
+# Task: Cleanup old messages mỗi giờ (chat lưu theo segment giờ, cleanup chỉ xóa segment hết hạn)
 def cleanup_old_chat_messages():
     """Tự động xóa tin nhắn cũ hơn 48 giờ"""
     try:
@@ -78,19 +101,98 @@ def cleanup_old_chat_messages():
         print(f"✗ Scheduled cleanup error: {e}")
         app.logger.error(f"Scheduled cleanup error: {e}")
 
-# Đăng ký task chạy mỗi 6 giờ
+# Đăng ký task chạy mỗi giờ; lần đầu chạy ngay trong thread của scheduler (không chặn lúc import app)
 scheduler.add_job(
     func=cleanup_old_chat_messages,
     trigger='interval',
-    hours=6,
+    hours=1,
+    next_run_time=datetime.now(utc),
     id='cleanup_chat_messages',
     name='Cleanup old chat messages (>48h)',
     replace_existing=True
 )
 
+# Task: Đối chiếu bộ đếm dung lượng file chat với file thật trên đĩa mỗi giờ
+def reconcile_chat_storage_usage():
+    """Sửa attachment_size lệch so với file trên đĩa (quota đọc từ bộ đếm, không stat từng file)"""
+    try:
+        fixed = chat_storage.reconcile_storage_usage()
+        if fixed > 0:
+            app.logger.info(f"Scheduled reconcile: Fixed {fixed} chat attachment sizes")
+    except Exception as e:
+        print(f"✗ Chat storage reconcile error: {e}")
+        app.logger.error(f"Chat storage reconcile error: {e}")
+
+scheduler.add_job(
+    func=reconcile_chat_storage_usage,
+    trigger='interval',
+    hours=1,
+    id='reconcile_chat_storage',
+    name='Reconcile chat attachment storage usage',
+    replace_existing=True
+)
+
+# Task: Gộp lượt xem từ journal vào metadata mỗi 5 phút
+def compact_note_view_counts():
+    """Ghi các lượt xem đang chờ trong journal vào metadata.json"""
+    try:
+        applied = file_storage.compact_view_counts()
+        if applied > 0:
+            app.logger.info(f"Scheduled compaction: Applied {applied} note views")
+    except Exception as e:
+        print(f"✗ View count compaction error: {e}")
+        app.logger.error(f"View count compaction error: {e}")
+
+scheduler.add_job(
+    func=compact_note_view_counts,
+    trigger='interval',
+    minutes=5,
+    id='compact_view_counts',
+    name='Compact note view counts',
+    replace_existing=True
+)
+
+# Task: Chạy các job nền đang chờ trong hàng đợi (enqueue_job còn đánh thức ngay, interval để vét job sót/retry)
+def run_background_jobs():
+    """Chạy hết job đang chờ trong data/jobs"""
+    try:
+        job_queue.drain()
+    except Exception as e:
+        print(f"✗ Background jobs error: {e}")
+        app.logger.error(f"Background jobs error: {e}")
+
+scheduler.add_job(
+    func=run_background_jobs,
+    trigger='interval',
+    seconds=5,
+    id='run_background_jobs',
+    name='Run queued background jobs',
+    replace_existing=True
+)
+
+# Task: Xóa segment edit log hết hạn (EDIT_LOGS_RETENTION_DAYS) mỗi giờ
+def cleanup_expired_edit_logs():
+    """Xóa các segment edit log cũ hơn thời hạn lưu"""
+    try:
+        deleted = cleanup_old_logs()
+        if deleted > 0:
+            app.logger.info(f"Scheduled cleanup: Deleted {deleted} old edit logs")
+    except Exception as e:
+        print(f"✗ Edit log cleanup error: {e}")
+        app.logger.error(f"Edit log cleanup error: {e}")
+
+scheduler.add_job(
+    func=cleanup_expired_edit_logs,
+    trigger='interval',
+    hours=1,
+    id='cleanup_edit_logs',
+    name='Cleanup expired edit log segments',
+    replace_existing=True
+)
+
 # Start scheduler
 scheduler.start()
-print("✓ Scheduler started: Auto cleanup old messages every 6 hours")
+print("✓ Scheduler started: Auto cleanup old messages every hour")
 
 # Shutdown scheduler khi app tắt
 atexit.register(lambda: scheduler.shutdown())
@@ -172,82 +274,65 @@ def load_user(user_id):
     return user_storage.get_user_by_id(user_id)
 
 def load_edit_logs():
-    """Load edit logs từ file JSON"""
-    if not os.path.exists(edit_logs_file):
-        return []
+    """Load toàn bộ edit logs (export/import); trang admin dùng edit_log_storage.get_recent"""
     try:
-        with open(edit_logs_file, 'r', encoding='utf-8') as f:
-            return json.load(f)
+        return edit_log_storage.load_all()
     except:
         return []
 
-def cleanup_old_logs(days=30):
-    """Xóa các log cũ hơn số ngày chỉ định (mặc định 30 ngày)"""
-    logs = load_edit_logs()
-    if not logs:
-        return 0
+def cleanup_old_logs(days=None):
+    """Xóa các log cũ hơn số ngày chỉ định (mặc định EDIT_LOGS_RETENTION_DAYS) - xóa nguyên segment ngày"""
+    if days is None:
+        days = app.config.get('EDIT_LOGS_RETENTION_DAYS', 30)
+    return edit_log_storage.cleanup_old_logs(days)
+
+def save_edit_log(log_data):
+    """Lưu edit log (append 1 dòng vào segment của ngày; created_at do caller truyền thì giữ nguyên)"""
+    edit_log_storage.append(log_data)
+
+def get_content_version(log_id):
+    """Dựng lại nội dung trước/sau lần sửa log_id bằng cách lùi từ nội dung hiện tại qua các delta mới hơn
     
-    cutoff_date = datetime.utcnow() - timedelta(days=days)
-    initial_count = len(logs)
+    Returns:
+        (log, nội dung trước, nội dung sau) hoặc None nếu log không tồn tại/không phải log sửa note/doc
     
-    # Lọc các log còn trong thời hạn
-    filtered_logs = []
-    for log in logs:
-        log_date = None
-        created_at = log.get('created_at')
-        
-        # Xử lý created_at có thể là string hoặc datetime
-        if isinstance(created_at, str):
-            try:
-                # Xử lý ISO format với hoặc không có timezone
-                if 'Z' in created_at:
-                    log_date = datetime.fromisoformat(created_at.replace('Z', '+00:00'))
-                else:
-                    log_date = datetime.fromisoformat(created_at)
-                
-                # Chuyển về naive datetime (không có timezone) để so sánh
-                if log_date.tzinfo is not None:
-                    # Chuyển về UTC trước khi remove timezone
-                    log_date = log_date.replace(tzinfo=None)
-            except Exception as e:
-                # Nếu không parse được, giữ lại log để an toàn
-                filtered_logs.append(log)
-                continue
-        elif isinstance(created_at, datetime):
-            log_date = created_at
-            # Chuyển về naive datetime nếu có timezone
-            if log_date.tzinfo is not None:
-                log_date = log_date.replace(tzinfo=None)
-        
-        # Giữ lại log nếu còn trong thời hạn hoặc không xác định được ngày
-        if log_date is None or log_date >= cutoff_date:
-            filtered_logs.append(log)
-    
-    # Chỉ lưu lại nếu có thay đổi
-    deleted_count = initial_count - len(filtered_logs)
-    if deleted_count > 0:
-        os.makedirs(os.path.dirname(edit_logs_file), exist_ok=True)
-        with open(edit_logs_file, 'w', encoding='utf-8') as f:
-            json.dump(filtered_logs, f, ensure_ascii=False, indent=2)
+    Raises:
+        ValueError: chuỗi log bị đứt (nội dung đã bị sửa mà không qua edit log) hoặc item đã bị xóa
+    """
+    target = edit_log_storage.get_log(log_id)
+    if target is None or target.get('item_type') not in ('note', 'doc'):
+        return None
     
-    return deleted_count
-
-def save_edit_log(log_data):
-    """Lưu edit log vào file JSON"""
-    logs = load_edit_logs()
-    log_id = max([l.get('id', 0) for l in logs] + [0]) + 1
-    log_data['id'] = log_id
-    log_data['created_at'] = datetime.utcnow().isoformat()
-    logs.append(log_data)
-    
-    os.makedirs(os.path.dirname(edit_logs_file), exist_ok=True)
-    with open(edit_logs_file, 'w', encoding='utf-8') as f:
-        json.dump(logs, f, ensure_ascii=False, indent=2)
-    
-    # Tự động xóa log cũ hơn 30 ngày sau mỗi lần lưu log mới (để tránh check quá thường xuyên)
-    # Chỉ cleanup mỗi 10 log để không làm chậm hệ thống
-    if log_id % 10 == 0:
-        cleanup_old_logs(30)
+    def content_change(log):
+        try:
+            changes = json.loads(log['changes']) if isinstance(log.get('changes'), str) else log.get('changes')
+        except:
+            return None
+        return changes.get('content') if isinstance(changes, dict) else None
+    
+    def revert(change, content):
+        if is_content_delta(change):
+            return apply_content_delta(content, change, reverse=True)
+        return change['old']  # Log cũ lưu toàn văn
+    
+    item_type, item_id = target['item_type'], target['item_id']
+    item = file_storage.get_note(item_id) if item_type == 'note' else file_storage.get_doc(item_id)
+    content = item.content if item else None
+    
+    for log in reversed(edit_log_storage.get_item_logs(item_type, item_id)):
+        if log['id'] < log_id:
+            break
+        change = content_change(log)
+        if not isinstance(change, dict):
+            continue  # Log không đổi nội dung (create, xóa file đính kèm...)
+        if not is_content_delta(change):
+            content = change.get('new', content)  # Log cũ toàn văn: không cần nội dung hiện tại
+        if content is None:
+            raise ValueError('Item đã bị xóa, không dựng lại được nội dung')
+        if log['id'] == log_id:
+            return target, revert(change, content), content
+        content = revert(change, content)
+    return None
 
 def load_categories():
     """Load categories từ file JSON - Hỗ trợ danh mục con"""
@@ -322,6 +407,119 @@ def get_child_categories(parent_name, categories=None):
     children = categories[parent_name].get('children', [])
     return {k: categories[k] for k in children if k in categories}
 
+def get_users_map(user_ids):
+    """Tra cứu nhiều user một lần, dùng chung map {user_id: User hoặc None} trong cả request
+    
+    Mỗi user chỉ được tra một lần dù xuất hiện ở nhiều note/log/tin nhắn.
+    """
+    users_map = g.setdefault('users_map', {})
+    missing = set()
+    for user_id in user_ids:
+        try:
+            user_id = int(user_id)
+        except (TypeError, ValueError):
+            continue
+        if user_id not in users_map:
+            missing.add(user_id)
+    if missing:
+        found = user_storage.get_users_by_ids(missing)
+        for user_id in missing:
+            users_map[user_id] = found.get(user_id)
+    return users_map
+
+def get_username(user_id, default='Unknown'):
+    """Username của user_id qua map trong request (gọi get_users_map trước để tra theo lô)"""
+    try:
+        user = get_users_map([user_id]).get(int(user_id))
+    except (TypeError, ValueError):
+        user = None
+    return user.username if user else default
+
+def publish_event(event, data=None, user_id=None):
+    """Phát sự kiện realtime tới trình duyệt qua event bus (lỗi chỉ ghi log, không làm hỏng request)"""
+    try:
+        event_bus.publish(event, data, user_id=user_id)
+    except Exception as e:
+        app.logger.error(f"Error publishing event {event}: {e}")
+
+def enqueue_job(name, **payload):
+    """Đưa tác vụ phụ vào hàng đợi job nền (lỗi chỉ ghi log, không làm hỏng request)"""
+    try:
+        job_queue.enqueue(name, **payload)
+    except Exception as e:
+        app.logger.error(f"Error enqueuing job {name}: {e}")
+
+def wake_background_jobs():
+    """Cho scheduler chạy hàng đợi ngay thay vì chờ lượt interval kế tiếp"""
+    try:
+        scheduler.add_job(run_background_jobs, id='run_background_jobs_now', replace_existing=True)
+    except Exception:
+        pass  # Scheduler chưa chạy/đã tắt: job interval sẽ chạy sau
+
+@job_queue.handler('search_index')
+def job_search_index(item_type, item_id):
+    """Job nền: cập nhật search index cho note/doc"""
+    file_storage.reindex_item(item_type, item_id)
+
+@job_queue.handler('item_created_notification')
+def job_item_created_notification(item_type, item_id, username):
+    """Job nền: thông báo broadcast cho mọi user khi có note/doc mới"""
+    item = file_storage.get_note(item_id) if item_type == 'note' else file_storage.get_doc(item_id)
+    if not item:
+        return  # Đã bị xóa trước khi job chạy
+    
+    # Tạo tóm tắt nội dung (100 ký tự đầu, loại bỏ HTML)
+    content_text = re.sub(r'<[^>]+>', '', item.content or '')
+    content_summary = content_text[:100] + '...' if len(content_text) > 100 else content_text
+    
+    if item_type == 'note':
+        title, type_, link = f"📝 Note mới: {item.title}", "info", f"/notes/{item.id}/view"
+    else:
+        title, type_, link = f"📄 Tài liệu mới: {item.title}", "success", f"/docs/{item.id}/view"
+    notification = notification_storage.create_notification(
+        title=title,
+        message=f"Người tạo: {username}\nDanh mục: {item.category}\n\n{content_summary}",
+        type=type_,
+        user_id=None,  # Broadcast to all users
+        link=link
+    )
+    
+    # Đẩy sự kiện realtime tới các trình duyệt đang mở
+    publish_event('new_notification', {'notification': notification})
+
+def enqueue_item_created_jobs(item_type, item):
+    """Đưa các tác vụ chậm sau khi tạo note/doc (search index, thông báo) vào hàng đợi
+    
+    Edit log "create" vẫn ghi trong request để luôn đứng trước log sửa đầu tiên của item.
+    """
+    enqueue_job('search_index', item_type=item_type, item_id=item.id)
+    enqueue_job('item_created_notification', item_type=item_type, item_id=item.id,
+                username=current_user.username)
+    wake_background_jobs()
+
+def get_paging(total, item_type='note'):
+    """Đọc tham số phân trang (page, sort) từ query string cho danh sách notes/docs"""
+    per_page = app.config.get('ITEMS_PER_PAGE', 24)
+    total_pages = max(1, (total + per_page - 1) // per_page)
+    try:
+        page = int(request.args.get('page', 1))
+    except (TypeError, ValueError):
+        page = 1
+    page = min(max(page, 1), total_pages)
+    
+    sort = request.args.get('sort', 'updated_at')
+    if sort not in file_storage.SORT_KEYS[item_type]:
+        sort = 'updated_at'
+    
+    return {
+        'page': page,
+        'per_page': per_page,
+        'offset': (page - 1) * per_page,
+        'total': total,
+        'total_pages': total_pages,
+        'sort': sort
+    }
+
 def process_pasted_images_in_content(note_id, content):
     """Xử lý các hình ảnh đã paste trong nội dung, chuyển thành attachment"""
     import re
@@ -362,31 +560,33 @@ def process_pasted_images_in_content(note_id, content):
             shutil.copy2(temp_path, attachment_path)
             
             # Thêm vào metadata của note
-            metadata = file_storage._load_metadata()
-            for note_meta in metadata.get('notes', []):
-                if note_meta['id'] == int(note_id):
-                    if 'attachments' not in note_meta:
-                        note_meta['attachments'] = []
-                    
-                    note_meta['attachments'].append({
-                        'filename': unique_filename,
-                        'original_filename': secure_filename(original_name),
-                        'uploaded_at': datetime.utcnow().isoformat()
-                    })
-                    note_meta['updated_at'] = datetime.utcnow().isoformat()
-                    file_storage._save_metadata(metadata)
-                    
-                    # Tạo URL mới cho attachment
-                    new_url = url_for('download_attachment', note_id=note_id, filename=unique_filename)
-                    # Thay thế URL cũ bằng URL mới trong content
-                    updated_content = updated_content.replace(full_url, new_url)
-                    
-                    # Xóa file tạm sau khi đã chuyển thành attachment
-                    try:
-                        os.remove(temp_path)
-                    except:
-                        pass
-                    break
+            def add_attachment_meta(metadata):
+                _, note_meta = file_storage._find_item_meta('note', note_id)
+                if not note_meta:
+                    return False
+                if 'attachments' not in note_meta:
+                    note_meta['attachments'] = []
+                
+                note_meta['attachments'].append({
+                    'filename': unique_filename,
+                    'original_filename': secure_filename(original_name),
+                    'uploaded_at': datetime.utcnow().isoformat()
+                })
+                note_meta['updated_at'] = datetime.utcnow().isoformat()
+                file_storage._touch_category_stats(metadata, note_meta)
+                return True
+            
+            if file_storage._update_metadata(add_attachment_meta):
+                # Tạo URL mới cho attachment
+                new_url = url_for('download_attachment', note_id=note_id, filename=unique_filename)
+                # Thay thế URL cũ bằng URL mới trong content
+                updated_content = updated_content.replace(full_url, new_url)
+                
+                # Xóa file tạm sau khi đã chuyển thành attachment
+                try:
+                    os.remove(temp_path)
+                except:
+                    pass
                     
         except Exception as e:
             print(f"Lỗi khi xử lý pasted image {temp_filename}: {str(e)}")
@@ -631,29 +831,15 @@ Thiết lập headers để không cache trang (bảo mật)"""
 @app.route('/')
 @login_required
 def dashboard():
-    all_notes = file_storage.get_all_notes()
-    all_docs = file_storage.get_all_docs()
+    # Dùng thống kê category được duy trì sẵn, không duyệt danh sách notes
+    item_counts = file_storage.get_item_counts()
+    category_stats = file_storage.get_category_stats()
     
-    notes_count = len(all_notes)
-    docs_count = len(all_docs)
+    notes_count = item_counts['notes']
+    docs_count = item_counts['docs']
     
-    # Lấy tất cả categories và đếm số notes trong mỗi category
+    # Lấy tất cả categories (số notes và note gần nhất của mỗi category lấy từ category_stats)
     categories_dict = load_categories()
-    category_stats = {}
-    
-    for note in all_notes:
-        cat = note.category
-        if cat not in category_stats:
-            category_stats[cat] = {
-                'count': 0,
-                'recent_note': None,
-                'recent_date': None
-            }
-        category_stats[cat]['count'] += 1
-        # Lấy note gần đây nhất trong category
-        if not category_stats[cat]['recent_date'] or note.updated_at > category_stats[cat]['recent_date']:
-            category_stats[cat]['recent_date'] = note.updated_at
-            category_stats[cat]['recent_note'] = note
     
     # Chỉ lấy danh mục gốc (không có parent) và tính tổng count bao gồm cả children
     categories_with_stats = []
@@ -751,31 +937,22 @@ def view_category(category_name):
     
     cat_data = categories_dict[category_name]
     
-    # Lấy thống kê cho danh mục này
-    all_notes = file_storage.get_all_notes()
+    # Lấy thống kê theo category (count + note mới nhất được duy trì sẵn, không duyệt notes)
+    category_stats = file_storage.get_category_stats()
+    empty_stats = {'count': 0, 'recent_note': None, 'recent_date': None}
     
-    # Count notes trong danh mục này
-    parent_count = sum(1 for note in all_notes if note.category == category_name)
+    parent_count = category_stats.get(category_name, empty_stats)['count']
     
     # Lấy thống kê cho các danh mục con
     children_stats = []
     if cat_data.get('children'):
         for child_name in cat_data['children']:
-            child_count = sum(1 for note in all_notes if note.category == child_name)
-            recent_note = None
-            recent_date = None
-            
-            for note in all_notes:
-                if note.category == child_name:
-                    if not recent_date or note.updated_at > recent_date:
-                        recent_date = note.updated_at
-                        recent_note = note
-            
+            child_stats = category_stats.get(child_name, empty_stats)
             children_stats.append({
                 'name': child_name,
-                'count': child_count,
-                'recent_note': recent_note,
-                'recent_date': recent_date
+                'count': child_stats['count'],
+                'recent_note': child_stats['recent_note'],
+                'recent_date': child_stats['recent_date']
             })
     
     return render_template('view_category.html',
@@ -789,22 +966,29 @@ def view_category(category_name):
 def notes():
     category = request.args.get('category', 'all')
     search_query = request.args.get('search', '')
-    
-    notes_list = file_storage.get_all_notes(category=category, search_query=search_query)
+    if search_query:
+        # Tìm một lần, dùng danh sách ID cho cả tổng số lẫn trang hiện tại
+        match_ids = file_storage.search_ids(search_query, item_type='note', category=category)
+        paging = get_paging(len(match_ids))
+        notes_list = file_storage.get_items_by_ids('note', match_ids[paging['offset']:paging['offset'] + paging['per_page']])
+    else:
+        paging = get_paging(file_storage.count_items('note', category=category))
+        notes_list = file_storage.get_all_notes(category=category, sort=paging['sort'],
+                                                limit=paging['per_page'], offset=paging['offset'])
     categories = file_storage.get_note_categories()
     categories_dict = load_categories()
     
-    # Thêm thông tin username cho mỗi note
+    # Thêm thông tin username cho mỗi note (tra tất cả user của trang trong một lần)
+    get_users_map([note.user_id for note in notes_list if note.user_id] +
+                  [note.updated_by for note in notes_list if note.updated_by])
     for note in notes_list:
         if note.user_id:
-            creator = user_storage.get_user_by_id(note.user_id)
-            note.creator_username = creator.username if creator else 'Không xác định'
+            note.creator_username = get_username(note.user_id, 'Không xác định')
         else:
             note.creator_username = 'Không xác định'
         
         if note.updated_by:
-            updater = user_storage.get_user_by_id(note.updated_by)
-            note.updater_username = updater.username if updater else 'Không xác định'
+            note.updater_username = get_username(note.updated_by, 'Không xác định')
         else:
             note.updater_username = None
     
@@ -813,7 +997,8 @@ def notes():
                          categories=categories,
                          categories_dict=categories_dict,
                          current_category=category,
-                         search_query=search_query)
+                         search_query=search_query,
+                         paging=paging)
 
 @app.route('/notes/new', methods=['GET', 'POST'])
 @can_create_required
@@ -842,7 +1027,8 @@ def new_note():
                 title=title,
                 content=content,
                 category=category,
-                user_id=current_user.id
+                user_id=current_user.id,
+                update_search_index=False  # Index trong job nền
             )
         except Exception as e:
             flash(f'Có lỗi xảy ra khi tạo ghi chú: {str(e)}', 'danger')
@@ -871,27 +1057,8 @@ def new_note():
                 })
             })
             
-            # Tạo thông báo cho tất cả users về note mới
-            try:
-                # Tạo tóm tắt nội dung (100 ký tự đầu, loại bỏ HTML)
-                content_text = re.sub(r'<[^>]+>', '', content)
-                content_summary = content_text[:100] + '...' if len(content_text) > 100 else content_text
-                
-                notification = notification_storage.create_notification(
-                    title=f"📝 Note mới: {title}",
-                    message=f"Người tạo: {current_user.username}\nDanh mục: {category}\n\n{content_summary}",
-                    type="info",
-                    user_id=None,  # Broadcast to all users
-                    link=f"/notes/{note.id}/view"
-                )
-                
-                # Emit socket event để notify realtime
-                socketio.emit('new_notification', {
-                    'notification': notification
-                }, broadcast=True)
-            except Exception as e:
-                # Không làm gián đoạn flow nếu tạo notification lỗi
-                app.logger.error(f"Error creating notification for new note: {e}")
+            # Search index và thông báo cho mọi user chạy trong job nền
+            enqueue_item_created_jobs('note', note)
             
             flash('✓ Đã lưu ghi chú thành công!', 'success')
             return redirect(url_for('notes'))
@@ -933,7 +1100,7 @@ def edit_note(id):
         # Lưu thay đổi trước khi update
         changes = {
             'title': {'old': old_title, 'new': title},
-            'content': {'old': note.content, 'new': content},  # Lưu toàn bộ nội dung, không chỉ preview
+            'content': make_content_delta(note.content, content),  # Chỉ lưu phần thay đổi, dựng lại được mọi phiên bản
             'category': {'old': old_category, 'new': category}
         }
         
@@ -1100,8 +1267,15 @@ def delete_attachment(note_id, filename):
 def docs():
     category = request.args.get('category', 'all')
     search_query = request.args.get('search', '')
-    
-    docs_list = file_storage.get_all_docs(category=category, search_query=search_query)
+    if search_query:
+        # Tìm một lần, dùng danh sách ID cho cả tổng số lẫn trang hiện tại
+        match_ids = file_storage.search_ids(search_query, item_type='doc', category=category)
+        paging = get_paging(len(match_ids), 'doc')
+        docs_list = file_storage.get_items_by_ids('doc', match_ids[paging['offset']:paging['offset'] + paging['per_page']])
+    else:
+        paging = get_paging(file_storage.count_items('doc', category=category), 'doc')
+        docs_list = file_storage.get_all_docs(category=category, sort=paging['sort'],
+                                              limit=paging['per_page'], offset=paging['offset'])
     categories = file_storage.get_doc_categories()
     categories_dict = load_categories()
     
@@ -1110,7 +1284,8 @@ def docs():
                          categories=categories,
                          categories_dict=categories_dict,
                          current_category=category,
-                         search_query=search_query)
+                         search_query=search_query,
+                         paging=paging)
 
 @app.route('/docs/new', methods=['GET', 'POST'])
 @can_create_required
@@ -1138,7 +1313,8 @@ def new_doc():
                 title=title,
                 content=content,
                 category=category,
-                user_id=current_user.id
+                user_id=current_user.id,
+                update_search_index=False  # Index trong job nền
             )
         except Exception as e:
             flash(f'Có lỗi xảy ra khi tạo tài liệu: {str(e)}', 'danger')
@@ -1165,27 +1341,8 @@ def new_doc():
                 })
             })
             
-            # Tạo thông báo cho tất cả users về document mới
-            try:
-                # Tạo tóm tắt nội dung (100 ký tự đầu, loại bỏ HTML)
-                content_text = re.sub(r'<[^>]+>', '', content)
-                content_summary = content_text[:100] + '...' if len(content_text) > 100 else content_text
-                
-                notification = notification_storage.create_notification(
-                    title=f"📄 Tài liệu mới: {title}",
-                    message=f"Người tạo: {current_user.username}\nDanh mục: {category}\n\n{content_summary}",
-                    type="success",
-                    user_id=None,  # Broadcast to all users
-                    link=f"/docs/{doc.id}/view"
-                )
-                
-                # Emit socket event để notify realtime
-                socketio.emit('new_notification', {
-                    'notification': notification
-                }, broadcast=True)
-            except Exception as e:
-                # Không làm gián đoạn flow nếu tạo notification lỗi
-                app.logger.error(f"Error creating notification for new document: {e}")
+            # Search index và thông báo cho mọi user chạy trong job nền
+            enqueue_item_created_jobs('doc', doc)
             
             flash('Tài liệu đã được tạo thành công!', 'success')
             return redirect(url_for('docs'))
@@ -1235,7 +1392,7 @@ def edit_doc(id):
         # Lưu thay đổi trước khi update
         changes = {
             'title': {'old': old_title, 'new': title},
-            'content': {'old': doc.content, 'new': content},  # Lưu toàn bộ nội dung, không chỉ preview
+            'content': make_content_delta(doc.content, content),  # Chỉ lưu phần thay đổi, dựng lại được mọi phiên bản
             'category': {'old': old_category, 'new': category}
         }
         
@@ -1385,8 +1542,9 @@ def search():
     results = {'notes': [], 'docs': []}
     
     if query:
-        results['notes'] = file_storage.get_all_notes(search_query=query)
-        results['docs'] = file_storage.get_all_docs(search_query=query)
+        # Tìm qua inverted index, kết quả sắp xếp theo độ liên quan
+        results['notes'] = file_storage.search(query, item_type='note')
+        results['docs'] = file_storage.search(query, item_type='doc')
     
     return render_template('search.html', query=query, results=results)
 
@@ -1397,8 +1555,8 @@ def api_search():
     results = {'notes': [], 'docs': []}
     
     if query:
-        notes = file_storage.get_all_notes(search_query=query)[:5]
-        docs = file_storage.get_all_docs(search_query=query)[:5]
+        notes = file_storage.search(query, item_type='note', limit=5)
+        docs = file_storage.search(query, item_type='doc', limit=5)
         
         results['notes'] = [{'id': n.id, 'title': n.title, 'type': 'note'} for n in notes]
         results['docs'] = [{'id': d.id, 'title': d.title, 'type': 'doc'} for d in docs]
@@ -1778,12 +1936,15 @@ def delete_category():
 @app.route('/admin/edit-logs')
 @admin_required
 def edit_logs():
-    # Tự động xóa log cũ hơn 30 ngày khi vào trang edit logs
-    deleted_count = cleanup_old_logs(30)
+    # Tự động xóa log hết hạn khi vào trang edit logs (chỉ xóa segment ngày cũ, không đọc log)
+    retention_days = app.config.get('EDIT_LOGS_RETENTION_DAYS', 30)
+    deleted_count = cleanup_old_logs(retention_days)
     if deleted_count > 0:
-        flash(f'Đã tự động xóa {deleted_count} log cũ hơn 30 ngày.', 'info')
+        flash(f'Đã tự động xóa {deleted_count} log cũ hơn {retention_days} ngày.', 'info')
     
-    logs = load_edit_logs()
+    # Chỉ đọc 100 log cuối (phần cuối segment mới nhất) thay vì toàn bộ lịch sử
+    logs = edit_log_storage.get_recent(100)
+    get_users_map(log.get('user_id') for log in logs)
     
     # Convert created_at và edit_timestamp từ string sang datetime và xử lý logs
     for log in logs:
@@ -1814,8 +1975,7 @@ def edit_logs():
                 log['created_at'] = None
         
         # Convert user_id thành username để hiển thị
-        user = user_storage.get_user_by_id(log.get('user_id'))
-        log['username'] = user.username if user else 'Unknown'
+        log['username'] = get_username(log.get('user_id'))
         
         # Parse changes JSON nếu là string
         if isinstance(log.get('changes'), str):
@@ -1823,6 +1983,18 @@ def edit_logs():
                 log['changes'] = json.loads(log['changes'])
             except:
                 pass
+        
+        # Nội dung lưu dạng delta: chỉ hiển thị các đoạn đã thay đổi (bản đầy đủ qua /admin/edit-logs/<id>/content)
+        changes = log.get('changes')
+        if isinstance(changes, dict) and is_content_delta(changes.get('content')):
+            ops = content_delta_ops(changes['content'])
+            if ops:
+                changes['content'] = {
+                    'old': '\n…\n'.join(op[1] for op in ops),
+                    'new': '\n…\n'.join(op[2] for op in ops)
+                }
+            else:
+                del changes['content']  # Lần sửa không đổi nội dung
     
     # Sort by created_at descending và limit 100
     logs.sort(key=lambda x: x.get('created_at', datetime.min) if isinstance(x.get('created_at'), datetime) else datetime.min, reverse=True)
@@ -1830,6 +2002,25 @@ def edit_logs():
     
     return render_template('edit_logs.html', logs=logs)
 
+@app.route('/admin/edit-logs/<int:log_id>/content')
+@admin_required
+def edit_log_content(log_id):
+    """Nội dung đầy đủ trước/sau một lần sửa note/doc (dựng lại từ các delta trong edit log)"""
+    try:
+        version = get_content_version(log_id)
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 409
+    if version is None:
+        return jsonify({'success': False, 'error': 'Không tìm thấy lần sửa nội dung này'}), 404
+    log, old_content, new_content = version
+    return jsonify({
+        'success': True,
+        'item_type': log['item_type'],
+        'item_id': log['item_id'],
+        'old': old_content,
+        'new': new_content
+    })
+
 # Export/Import Data Routes (Admin only)
 @app.route('/admin/export-import')
 @admin_required
@@ -1841,6 +2032,10 @@ def export_import():
 @admin_required
 def export_data():
     """Export toàn bộ dữ liệu ra file ZIP"""
+    if USE_DATABASE:
+        flash('Export/Import chỉ hỗ trợ storage file (CSV/JSON). Với database, hãy backup file database.', 'warning')
+        return redirect(url_for('export_import'))
+    
     try:
         # Tạo file ZIP tạm
         timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
@@ -1861,9 +2056,8 @@ def export_data():
             if os.path.exists(categories_file):
                 zipf.write(categories_file, 'categories.json')
             
-            # 4. Export edit_logs.json
-            if os.path.exists(edit_logs_file):
-                zipf.write(edit_logs_file, 'edit_logs.json')
+            # 4. Export edit_logs.json (gộp các segment về định dạng backup cũ)
+            zipf.writestr('edit_logs.json', json.dumps(load_edit_logs(), ensure_ascii=False, indent=2))
             
             # 5. Export thư mục notes (tất cả file .txt)
             if os.path.exists(file_storage.notes_dir):
@@ -1927,6 +2121,10 @@ def export_data():
 @admin_required
 def import_data():
     """Import dữ liệu từ file ZIP"""
+    if USE_DATABASE:
+        flash('Export/Import chỉ hỗ trợ storage file (CSV/JSON). Với database, hãy backup file database.', 'warning')
+        return redirect(url_for('export_import'))
+    
     if 'import_file' not in request.files:
         flash('Vui lòng chọn file để import!', 'danger')
         return redirect(url_for('export_import'))
@@ -1999,30 +2197,35 @@ def import_data():
                 if os.path.exists(file_storage.metadata_file):
                     backup_file = file_storage.metadata_file + '.backup'
                     shutil.copy2(file_storage.metadata_file, backup_file)
-                # Copy file mới
+                # Copy file mới (giữ khóa ghi metadata để không đè lên thay đổi của worker khác)
                 os.makedirs(os.path.dirname(file_storage.metadata_file), exist_ok=True)
-                shutil.copy2(metadata_file, file_storage.metadata_file)
+                with file_storage._metadata_write_lock():
+                    shutil.copy2(metadata_file, file_storage.metadata_file)
             else:
                 # Merge mode: đọc cả hai và merge
                 with open(metadata_file, 'r', encoding='utf-8') as f:
                     imported_metadata = json.load(f)
-                current_metadata = file_storage._load_metadata()
                 
-                # Merge notes
-                imported_note_ids = {n['id'] for n in imported_metadata.get('notes', [])}
-                current_metadata['notes'] = [n for n in current_metadata.get('notes', []) 
-                                           if n['id'] not in imported_note_ids]
-                current_metadata['notes'].extend(imported_metadata.get('notes', []))
-                import_count['notes'] = len(imported_metadata.get('notes', []))
+                def merge_metadata(current_metadata):
+                    # Merge notes
+                    imported_note_ids = {n['id'] for n in imported_metadata.get('notes', [])}
+                    current_metadata['notes'] = [n for n in current_metadata.get('notes', []) 
+                                               if n['id'] not in imported_note_ids]
+                    current_metadata['notes'].extend(imported_metadata.get('notes', []))
+                    
+                    # Merge docs
+                    imported_doc_ids = {d['id'] for d in imported_metadata.get('docs', [])}
+                    current_metadata['docs'] = [d for d in current_metadata.get('docs', []) 
+                                              if d['id'] not in imported_doc_ids]
+                    current_metadata['docs'].extend(imported_metadata.get('docs', []))
+                    
+                    # Thống kê category tính lại theo danh sách notes sau khi merge
+                    file_storage._rebuild_category_stats(current_metadata)
+                    return True
                 
-                # Merge docs
-                imported_doc_ids = {d['id'] for d in imported_metadata.get('docs', [])}
-                current_metadata['docs'] = [d for d in current_metadata.get('docs', []) 
-                                          if d['id'] not in imported_doc_ids]
-                current_metadata['docs'].extend(imported_metadata.get('docs', []))
+                file_storage._update_metadata(merge_metadata)
+                import_count['notes'] = len(imported_metadata.get('notes', []))
                 import_count['docs'] = len(imported_metadata.get('docs', []))
-                
-                file_storage._save_metadata(current_metadata)
         
         # 3. Import categories.json
         categories_file_import = os.path.join(extract_dir, 'categories.json')
@@ -2045,17 +2248,14 @@ def import_data():
             with open(edit_logs_file_import, 'r', encoding='utf-8') as f:
                 imported_logs = json.load(f)
             if import_mode == 'replace':
-                os.makedirs(os.path.dirname(edit_logs_file), exist_ok=True)
-                shutil.copy2(edit_logs_file_import, edit_logs_file)
+                edit_log_storage.replace_all(imported_logs)
             else:
                 # Merge logs
                 current_logs = load_edit_logs()
                 imported_log_ids = {l.get('id') for l in imported_logs}
                 current_logs = [l for l in current_logs if l.get('id') not in imported_log_ids]
                 current_logs.extend(imported_logs)
-                os.makedirs(os.path.dirname(edit_logs_file), exist_ok=True)
-                with open(edit_logs_file, 'w', encoding='utf-8') as f:
-                    json.dump(current_logs, f, ensure_ascii=False, indent=2)
+                edit_log_storage.replace_all(current_logs)
         
         # 5. Import notes files
         notes_dir_import = os.path.join(extract_dir, 'notes')
@@ -2122,6 +2322,9 @@ def import_data():
         # Dọn dẹp file tạm
         shutil.rmtree(temp_dir)
         
+        # Nội dung notes/docs đã thay đổi hàng loạt, build lại index tìm kiếm
+        file_storage.rebuild_search_index()
+        
         # Log import action
         save_edit_log({
             'item_type': 'system',
@@ -2172,32 +2375,85 @@ def chat():
     
     return render_template('chat.html', total_users=total_users)
 
+@app.route('/events/stream')
+@login_required
+def event_stream():
+    """Server-Sent Events: đẩy sự kiện realtime (chat, thông báo) tới trình duyệt
+    
+    Stream tự kết thúc sau SSE_STREAM_TIMEOUT giây, EventSource sẽ kết nối lại
+    và gửi Last-Event-ID để nhận tiếp các sự kiện bị lỡ.
+    """
+    # Hết slot: 204 làm EventSource dừng hẳn, tab đó dùng polling dự phòng thay vì giữ thread
+    if not realtime_slots.acquire(blocking=False):
+        return app.response_class(status=204)
+    
+    user_id = str(current_user.id)
+    last_event_id = request.headers.get('Last-Event-ID')
+    timeout = app.config.get('SSE_STREAM_TIMEOUT', 300)
+    
+    def generate():
+        # Thời gian chờ (ms) trước khi trình duyệt kết nối lại
+        yield 'retry: 3000\n\n'
+        for event_id, record in event_bus.subscribe(last_event_id, timeout=timeout):
+            if record is None:
+                yield ': keep-alive\n\n'
+            elif record.get('user_id') is None or str(record['user_id']) == user_id:
+                data = json.dumps(record.get('data', {}), ensure_ascii=False, default=str)
+                yield f"id: {event_id}\nevent: {record['event']}\ndata: {data}\n\n"
+    
+    response = app.response_class(generate(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'  # nginx: không buffer stream
+    response.call_on_close(realtime_slots.release)  # Trả slot khi stream kết thúc/client ngắt
+    return response
+
 @app.route('/chat/group/messages')
 @login_required
 def get_group_messages():
-    """API: Lấy tất cả tin nhắn group chat (hoặc phân trang)"""
+    """API: Lấy tin nhắn group chat (phân trang, hoặc chỉ tin mới hơn since_id khi polling)
+    
+    Hỗ trợ ETag: nếu log chat không đổi kể từ lần trước, trả về 304 không có body.
+    """
     # Lấy tham số pagination (nếu có)
     limit = request.args.get('limit', type=int)  # None = lấy tất cả
     offset = request.args.get('offset', default=0, type=int)
+    since_id = request.args.get('since_id', type=int)
+    
+    etag = f"chat-{chat_storage.get_version()}-{since_id}-{limit}-{offset}"
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+        response.set_etag(etag)
+        return response
     
-    # Lấy messages với pagination
-    messages = chat_storage.get_all_messages(limit=limit, offset=offset)
+    if since_id is not None:
+        # Polling: chỉ trả về tin nhắn mới, has_more = còn tin mới chưa trả về (khi có limit)
+        messages = chat_storage.get_group_messages_since(since_id, limit=limit)
+        has_more = limit is not None and len(messages) == limit and \
+            bool(chat_storage.get_group_messages_since(messages[-1]['id'], limit=1))
+    else:
+        # Lấy messages với pagination
+        messages = chat_storage.get_all_messages(limit=limit, offset=offset)
     
     # Thêm thông tin sender vào mỗi message
+    get_users_map(msg['sender_id'] for msg in messages)
     for msg in messages:
-        user = user_storage.get_user_by_id(msg['sender_id'])
-        msg['sender_name'] = user.username if user else 'Unknown'
+        msg['sender_name'] = get_username(msg['sender_id'])
     
-    # Lấy tổng số tin nhắn để client biết còn bao nhiêu
-    all_messages = chat_storage.get_all_messages()
-    total_count = len(all_messages)
+    # Tổng số tin nhắn để client biết còn bao nhiêu (và phát hiện tin bị xóa khi polling)
+    total_count = chat_storage.count_group_messages()
+    if since_id is None:
+        has_more = (offset + len(messages)) < total_count
     
-    return jsonify({
+    response = jsonify({
         'success': True,
         'messages': messages,
         'total_count': total_count,
-        'has_more': (offset + len(messages)) < total_count
+        'has_more': has_more,
+        'last_id': messages[-1]['id'] if messages else since_id
     })
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
 
 @app.route('/chat/group/send', methods=['POST'])
 @login_required
@@ -2233,11 +2489,8 @@ def send_group_message():
             attachment_file=attachment if attachment else None
         )
         
-        # Emit socket event để realtime update
-        try:
-            socketio.emit('new_message', {'message': new_message}, broadcast=True)
-        except:
-            pass
+        # Đẩy sự kiện realtime để các client lấy tin mới
+        publish_event('new_message', {'message': new_message})
         
         return jsonify({
             'success': True,
@@ -2260,11 +2513,8 @@ def clear_group_chat_history():
         # Log action
         app.logger.info(f"Admin {current_user.username} cleared chat history: {deleted_count} messages deleted")
         
-        # Emit socket event để tất cả users refresh
-        try:
-            socketio.emit('chat_cleared', {}, broadcast=True)
-        except:
-            pass
+        # Đẩy sự kiện realtime để tất cả users refresh
+        publish_event('chat_cleared')
         
         return jsonify({
             'success': True,
@@ -2281,7 +2531,55 @@ def get_unread_count():
     count = chat_storage.get_unread_count(current_user.id)
     return jsonify({'count': count})
 
-@app.route('/chat/download/<filename>')
+@app.route('/api/badges')
+@login_required
+def get_badges():
+    """API long-poll: số tin nhắn chat và thông báo chưa đọc trong một request
+    
+    Client gửi lại version/chat/notifications nhận được lần trước (và wait=0 để lấy ngay).
+    Server chỉ tính lại số chưa đọc khi phiên bản dữ liệu chat/thông báo đổi, và giữ request
+    tới khi một trong hai số thay đổi hoặc hết BADGES_LONG_POLL_TIMEOUT giây.
+    Worker đã hết slot realtime (REALTIME_MAX_CONNECTIONS) thì trả ngay kèm retry_after (giây).
+    """
+    user_id = current_user.id
+    version = request.args.get('version') or None
+    known = (request.args.get('chat', type=int), request.args.get('notifications', type=int))
+    timeout = app.config.get('BADGES_LONG_POLL_TIMEOUT', 25)
+    wait = max(0, min(request.args.get('wait', default=timeout, type=float), timeout))
+    retry_after = None
+    held = wait > 0 and realtime_slots.acquire(blocking=False)
+    if wait > 0 and not held:
+        wait, retry_after = 0, 5  # Không giữ thread: client đợi rồi hỏi lại
+    deadline = time.monotonic() + wait
+    
+    counts = known
+    try:
+        while True:
+            current_version = f"{chat_storage.get_version()}|{notification_storage.get_version()}"
+            if current_version != version or None in counts:
+                version = current_version
+                counts = (chat_storage.get_unread_count(user_id), notification_storage.get_unread_count(user_id))
+                if counts != known:
+                    break
+            if time.monotonic() >= deadline:
+                break
+            time.sleep(0.5)
+    finally:
+        if held:
+            realtime_slots.release()
+    
+    result = {
+        'success': True,
+        'version': version,
+        'chat_unread': counts[0],
+        'notification_unread': counts[1],
+        'changed': counts != known
+    }
+    if retry_after:
+        result['retry_after'] = retry_after
+    return jsonify(result)
+
+@app.route('/chat/download/<path:filename>')
 @login_required
 def download_chat_file(filename):
     """Download file đính kèm trong chat"""
@@ -2305,6 +2603,29 @@ def mark_message_read(message_id):
     success = chat_storage.mark_message_as_read_by_user(message_id, current_user.id)
     return jsonify({'success': success})
 
+@app.route('/chat/group/mark-read', methods=['POST'])
+@login_required
+def mark_group_read():
+    """Đánh dấu đã xem mọi tin nhắn group tới up_to_id (hoặc ID lớn nhất trong message_ids) - 1 request cho cả lô"""
+    data = request.get_json(silent=True) or request.form
+    try:
+        if data.get('up_to_id') is not None:
+            up_to_id = int(data.get('up_to_id'))
+        else:
+            message_ids = data.get('message_ids')
+            if isinstance(message_ids, str):
+                message_ids = message_ids.split(',')
+            up_to_id = max(int(message_id) for message_id in message_ids)
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'error': 'up_to_id không hợp lệ'}), 400
+    
+    updated = chat_storage.mark_group_read(current_user.id, up_to_id)
+    return jsonify({
+        'success': True,
+        'updated': updated,
+        'last_read_id': chat_storage.get_group_read_id(current_user.id)
+    })
+
 @app.route('/chat/storage-info')
 @login_required
 def get_storage_info():
@@ -2328,27 +2649,8 @@ def manage_chat_files():
 def clear_chat_history(other_user_id):
     """Xóa lịch sử chat với user (chỉ xóa tin nhắn mà user gửi)"""
     try:
-        messages = chat_storage._load_messages()
-        
         # Xóa tin nhắn mà current_user gửi cho other_user
-        deleted_count = 0
-        new_messages = []
-        
-        for msg in messages:
-            if msg['sender_id'] == current_user.id and msg['receiver_id'] == other_user_id:
-                # Xóa file đính kèm nếu có
-                if msg.get('attachment_filename'):
-                    file_path = os.path.join(chat_storage.chat_uploads_dir, msg['attachment_filename'])
-                    if os.path.exists(file_path):
-                        try:
-                            os.remove(file_path)
-                        except:
-                            pass
-                deleted_count += 1
-            else:
-                new_messages.append(msg)
-        
-        chat_storage._save_messages(new_messages)
+        deleted_count = chat_storage.clear_conversation(current_user.id, other_user_id)
         
         return jsonify({
             'success': True,
@@ -2431,13 +2733,8 @@ def create_notification():
         creator_id=current_user.id
     )
     
-    # Emit socket event để notify realtime (nếu socketio có sẵn)
-    try:
-        socketio.emit('new_notification', {
-            'notification': notification
-        }, broadcast=True)
-    except:
-        pass  # Socketio chưa được khởi tạo, bỏ qua
+    # Đẩy sự kiện realtime (thông báo riêng chỉ gửi tới user nhận)
+    publish_event('new_notification', {'notification': notification}, user_id=user_id)
     
     return jsonify({
         'success': True,
@@ -2454,9 +2751,7 @@ def cleanup_old_notifications():
         # days=0 nghĩa là xóa tất cả
         if days == 0:
             # Xóa tất cả thông báo
-            notifications = notification_storage._load_notifications()
-            deleted_count = len(notifications)
-            notification_storage._save_notifications([])
+            deleted_count = notification_storage.delete_all_notifications()
         else:
             # Giới hạn từ 1-90 ngày
             if days < 1:
@@ -2484,13 +2779,8 @@ def delete_notification(notification_id):
     success = notification_storage.delete_notification(notification_id)
     
     if success:
-        # Emit socket event (nếu socketio có sẵn)
-        try:
-            socketio.emit('notification_deleted', {
-                'notification_id': notification_id
-            }, broadcast=True)
-        except:
-            pass  # Socketio chưa được khởi tạo, bỏ qua
+        # Đẩy sự kiện realtime
+        publish_event('notification_deleted', {'notification_id': notification_id})
     
     return jsonify({'success': success})
 
@@ -1,151 +1,469 @@
 """
-Chat Storage - Lưu trữ tin nhắn chat bằng JSON (tương thích với hệ thống hiện tại)
+Chat Storage - Lưu trữ tin nhắn chat bằng log append-only (JSON Lines), chia segment theo giờ
 Sẽ migrate sang database sau
 """
 import os
 import json
+import bisect
+import shutil
+import tempfile
+import threading
 from datetime import datetime, timedelta, timezone
 from werkzeug.utils import secure_filename
+from file_lock import locked_file
 
 class ChatStorage:
     # Storage limit per user: 1GB
     STORAGE_LIMIT_BYTES = 1 * 1024 * 1024 * 1024  # 1GB
     WARNING_THRESHOLD = 0.8  # Cảnh báo khi dùng >80%
     MESSAGE_RETENTION_HOURS = 48  # Tự động xóa tin nhắn sau 48 giờ
+    SEGMENT_FORMAT = '%Y%m%d%H'  # Mỗi giờ (UTC) một file segment: chat_log/YYYYMMDDHH.jsonl
+    # File đính kèm nằm trong thư mục cùng tên segment (uploads/chat/YYYYMMDDHH/), hết hạn cùng segment
     
     def __init__(self, data_dir='data'):
         self.data_dir = data_dir
-        self.chat_file = os.path.join(data_dir, 'chat_messages.json')
+        self.chat_file = os.path.join(data_dir, 'chat_messages.json')  # Định dạng cũ, chỉ dùng để migrate
+        self.log_dir = os.path.join(data_dir, 'chat_log')
+        self.seq_file = os.path.join(self.log_dir, 'last_id')
+        self.lock_file = os.path.join(self.log_dir, '.lock')
         self.chat_uploads_dir = os.path.join(data_dir, 'uploads', 'chat')
         
         # Tạo thư mục nếu chưa tồn tại
         os.makedirs(self.chat_uploads_dir, exist_ok=True)
+        os.makedirs(self.log_dir, exist_ok=True)
         
-        # Khởi tạo file nếu chưa tồn tại
-        if not os.path.exists(self.chat_file):
-            self._save_messages([])
+        # Trạng thái trong bộ nhớ, dựng lại từ log và đọc tiếp phần mới ghi (kể cả từ worker khác)
+        self._lock = threading.RLock()
+        self._reset_state()
         
-        # Migrate tin nhắn cũ sang UTC (chỉ chạy 1 lần)
-        self._migrate_to_utc()
-        
-        # Tự động xóa tin nhắn cũ khi khởi tạo
-        self._cleanup_old_messages()
+        # Chuyển chat_messages.json cũ sang log (chỉ chạy 1 lần)
+        if os.path.exists(self.chat_file):
+            with self._lock, locked_file(self.lock_file):
+                if os.path.exists(self.chat_file):
+                    self._migrate_legacy_file()
     
-    def _load_messages(self):
-        """Load messages từ JSON"""
+    # === LOG ===
+    # Mỗi dòng là một record JSON: tin nhắn mới (dict tin nhắn) hoặc thao tác có khóa 'op':
+    #   {'op': 'delete', 'ids': [...]}, {'op': 'group_read', 'user_id', 'up_to'},
+    #   {'op': 'read_conversation', 'sender_id', 'receiver_id', 'up_to'},
+    #   {'op': 'attachment_size', 'sizes': [[id, size hoặc None nếu file đã mất], ...]} (do reconcile ghi)
+    #   ({'op': 'read', 'id', 'user_id'} là định dạng cũ, chỉ còn được đọc lại)
+    # Record luôn được ghi vào segment của giờ hiện tại, nên thao tác luôn nằm sau tin nhắn nó tác động.
+    def _reset_state(self):
+        self._messages = {}  # id -> tin nhắn còn hiệu lực (thứ tự chèn = thứ tự gửi)
+        self._group_ids = []  # ID tin nhắn group chat, luôn sắp xếp tăng dần (bisect dựa vào điều này)
+        self._segments = {}  # tên segment -> (inode, số byte đã đọc)
+        self._segment_ids = {}  # tên segment -> [ID tin nhắn ghi trong segment]
+        self._last_id = 0
+        
+        # Index theo cuộc hội thoại, cập nhật khi áp dụng từng record (không quét lại tin nhắn):
+        self._conversations = {}  # (user nhỏ, user lớn) -> [ID tin nhắn theo thứ tự gửi]
+        self._peers = {}  # user_id -> {user đã chat cùng}
+        self._unread = {}  # receiver_id -> {sender_id: số tin chưa đọc}
+        self._unread_total = {}  # receiver_id -> tổng số tin chưa đọc
+        self._group_read = {}  # user_id -> ID tin nhắn group cuối cùng đã xem (watermark)
+        self._storage_usage = {}  # user_id -> tổng byte file đính kèm đã gửi/nhận (từ attachment_size)
+    
+    @staticmethod
+    def _conversation_key(user1_id, user2_id):
+        return (user1_id, user2_id) if user1_id <= user2_id else (user2_id, user1_id)
+    
+    def _add_unread(self, receiver_id, sender_id, delta):
+        per_sender = self._unread.setdefault(receiver_id, {})
+        per_sender[sender_id] = per_sender.get(sender_id, 0) + delta
+        if per_sender[sender_id] <= 0:
+            del per_sender[sender_id]
+        self._unread_total[receiver_id] = self._unread_total.get(receiver_id, 0) + delta
+    
+    def _add_storage_usage(self, msg, sign):
+        size = msg.get('attachment_size') or 0
+        if size:
+            for user_id in {msg['sender_id'], msg['receiver_id']}:
+                self._storage_usage[user_id] = self._storage_usage.get(user_id, 0) + sign * size
+    
+    def _attachment_file_size(self, msg):
+        """Kích thước file đính kèm trên đĩa (None nếu file không còn)"""
         try:
-            with open(self.chat_file, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except:
+            return os.path.getsize(os.path.join(self.chat_uploads_dir, msg['attachment_filename']))
+        except OSError:
+            return None
+    
+    def _index_message(self, msg):
+        sender_id, receiver_id = msg['sender_id'], msg['receiver_id']
+        if msg.get('attachment_filename') and 'attachment_size' not in msg:
+            # Tin nhắn ghi trước khi có attachment_size: stat 1 lần khi đọc log
+            msg['attachment_size'] = self._attachment_file_size(msg)
+        self._add_storage_usage(msg, 1)
+        self._conversations.setdefault(self._conversation_key(sender_id, receiver_id), []).append(msg['id'])
+        self._peers.setdefault(sender_id, set()).add(receiver_id)
+        self._peers.setdefault(receiver_id, set()).add(sender_id)
+        if receiver_id != 0 and not msg.get('is_read'):
+            self._add_unread(receiver_id, sender_id, 1)
+    
+    def _unindex_message(self, msg):
+        sender_id, receiver_id = msg['sender_id'], msg['receiver_id']
+        key = self._conversation_key(sender_id, receiver_id)
+        conversation = self._conversations.get(key, [])
+        conversation.remove(msg['id'])
+        if not conversation:
+            self._conversations.pop(key, None)
+            self._peers.get(sender_id, set()).discard(receiver_id)
+            self._peers.get(receiver_id, set()).discard(sender_id)
+        if receiver_id != 0 and not msg.get('is_read'):
+            self._add_unread(receiver_id, sender_id, -1)
+        self._add_storage_usage(msg, -1)
+    
+    def _segment_names(self):
+        try:
+            return sorted(name for name in os.listdir(self.log_dir) if name.endswith('.jsonl'))
+        except OSError:
             return []
     
-    def _save_messages(self, messages):
-        """Lưu messages vào JSON"""
-        with open(self.chat_file, 'w', encoding='utf-8') as f:
-            json.dump(messages, f, ensure_ascii=False, indent=2)
+    def _apply(self, record):
+        """Áp dụng một record của log vào trạng thái trong bộ nhớ"""
+        op = record.get('op')
+        if op is None:
+            record.setdefault('read_by', [])
+            self._messages[record['id']] = record
+            if record.get('receiver_id') == 0:
+                if self._group_ids and record['id'] < self._group_ids[-1]:
+                    # Segment migrate từ chat_messages.json xếp theo created_at, ID có thể không tăng dần
+                    bisect.insort(self._group_ids, record['id'])
+                else:
+                    self._group_ids.append(record['id'])
+            self._index_message(record)
+            self._last_id = max(self._last_id, record['id'])
+        elif op == 'delete':
+            for msg_id in record['ids']:
+                msg = self._messages.pop(msg_id, None)
+                if msg is None:
+                    continue
+                if msg.get('receiver_id') == 0:
+                    self._group_ids.remove(msg_id)
+                self._unindex_message(msg)
+        elif op == 'group_read':
+            if record['up_to'] > self._group_read.get(record['user_id'], 0):
+                self._group_read[record['user_id']] = record['up_to']
+        elif op == 'attachment_size':
+            for msg_id, size in record['sizes']:
+                msg = self._messages.get(msg_id)
+                if msg is not None:
+                    self._add_storage_usage(msg, -1)
+                    msg['attachment_size'] = size
+                    self._add_storage_usage(msg, 1)
+        elif op == 'read':
+            msg = self._messages.get(record['id'])
+            if msg is not None and record['user_id'] not in msg['read_by']:
+                msg['read_by'].append(record['user_id'])
+        elif op == 'read_conversation':
+            sender_id, receiver_id = record['sender_id'], record['receiver_id']
+            if not self._unread.get(receiver_id, {}).get(sender_id):
+                return
+            for msg_id in self._conversations.get(self._conversation_key(sender_id, receiver_id), []):
+                msg = self._messages[msg_id]
+                if (msg['sender_id'] == sender_id and msg['receiver_id'] == receiver_id
+                        and msg_id <= record['up_to'] and not msg.get('is_read')):
+                    msg['is_read'] = True
+                    self._add_unread(receiver_id, sender_id, -1)
     
-    def _migrate_to_utc(self):
-        """Migrate tin nhắn cũ: chuyển created_at từ local time sang UTC"""
+    def _read_segment(self, name):
+        """Đọc phần mới của một segment, trả về False nếu segment đã bị thay thế/cắt ngắn"""
+        path = os.path.join(self.log_dir, name)
         try:
-            messages = self._load_messages()
-            updated = False
-            
-            for msg in messages:
-                created_at = msg.get('created_at', '')
-                # Nếu created_at không có 'Z' và không có timezone info
-                if created_at and not created_at.endswith('Z') and '+' not in created_at:
+            st = os.stat(path)
+        except OSError:
+            return name not in self._segments
+        inode, offset = self._segments.get(name, (st.st_ino, 0))
+        if inode != st.st_ino or st.st_size < offset:
+            return False
+        
+        if st.st_size > offset:
+            with open(path, 'rb') as f:
+                f.seek(offset)
+                data = f.read(st.st_size - offset)
+            # Chỉ dùng các dòng hoàn chỉnh, dòng đang ghi dở sẽ được đọc ở lần sau
+            end = data.rfind(b'\n') + 1
+            for line in data[:end].split(b'\n'):
+                if line.strip():
                     try:
-                        # Parse as naive datetime (assume local time)
-                        dt = datetime.fromisoformat(created_at)
-                        # Convert to UTC (giả sử local time là UTC+7)
-                        # Trừ đi 7 giờ để về UTC
-                        dt_utc = dt - timedelta(hours=7)
-                        msg['created_at'] = dt_utc.isoformat()
-                        updated = True
+                        record = json.loads(line)
+                        self._apply(record)
+                        if record.get('op') is None:
+                            self._segment_ids.setdefault(name, []).append(record['id'])
                     except:
                         pass
+            offset += end
+        self._segments[name] = (st.st_ino, offset)
+        return True
+    
+    def _refresh(self):
+        """Đọc tiếp các record mới trong log (mỗi segment 1 lần stat, chỉ đọc segment có kích thước vượt offset đã đọc)"""
+        with self._lock:
+            names = self._segment_names()
+            removed = [name for name in self._segments if name not in names]
+            if removed:
+                if names and max(removed) < names[0]:
+                    # Retention xóa các segment cũ nhất: bỏ tin nhắn của chúng khỏi bộ nhớ, không đọc lại log
+                    self._drop_segments(removed)
+                else:
+                    self._reset_state()
             
-            if updated:
-                self._save_messages(messages)
-                print(f"✓ Migrated {len(messages)} messages to UTC format")
+            for name in names:
+                if not self._read_segment(name):
+                    self._reset_state()
+                    for segment_name in names:
+                        self._read_segment(segment_name)
+                    break
+    
+    def _drop_segments(self, names):
+        """Bỏ khỏi trạng thái các tin nhắn nằm trong những segment đã bị xóa"""
+        dropped = set()
+        for name in names:
+            self._segments.pop(name, None)
+            for msg_id in self._segment_ids.pop(name, []):
+                msg = self._messages.pop(msg_id, None)
+                if msg is not None:
+                    self._unindex_message(msg)
+                    dropped.add(msg_id)
+        if dropped:
+            self._group_ids = [msg_id for msg_id in self._group_ids if msg_id not in dropped]
+    
+    def _current_segment(self):
+        return datetime.utcnow().strftime(self.SEGMENT_FORMAT)
+    
+    def _append(self, records, segment=None):
+        """Ghi records vào cuối segment của giờ hiện tại (hoặc segment đã chọn trước đó vài micro giây)
+        
+        Caller phải giữ self._lock và locked_file(self.lock_file).
+        """
+        segment = (segment or self._current_segment()) + '.jsonl'
+        data = ''.join(json.dumps(record, ensure_ascii=False) + '\n' for record in records).encode('utf-8')
+        fd = os.open(os.path.join(self.log_dir, segment), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, data)
+        finally:
+            os.close(fd)
+        self._refresh()
+    
+    def _read_seq(self):
+        try:
+            with open(self.seq_file, 'r') as f:
+                return int(f.read().strip() or 0)
+        except:
+            return 0
+    
+    def _allocate_id(self):
+        """Cấp ID tin nhắn tăng dần (không dùng lại ID kể cả khi tin nhắn cũ đã bị xóa)
+        
+        Caller phải giữ self._lock và locked_file(self.lock_file).
+        """
+        msg_id = max(self._read_seq(), self._last_id) + 1
+        with open(self.seq_file, 'w') as f:
+            f.write(str(msg_id))
+        return msg_id
+    
+    def _load_messages(self):
+        """Tất cả tin nhắn còn hiệu lực theo thứ tự gửi (dict dùng chung - không sửa trực tiếp)"""
+        with self._lock:
+            self._refresh()
+            return list(self._messages.values())
+    
+    def _group_readers(self):
+        """Watermark đã xem group sắp xếp tăng dần: ([watermark], [user_id]), tính một lần cho mỗi lượt đọc"""
+        readers = sorted((last_read_id, user_id) for user_id, last_read_id in self._group_read.items())
+        return [last_read_id for last_read_id, _ in readers], [user_id for _, user_id in readers]
+    
+    def _copy_message(self, msg, readers=None):
+        """Bản sao tin nhắn để trả ra ngoài; read_by của tin group được suy ra từ watermark đã xem
+        
+        readers: kết quả _group_readers() dùng chung khi copy nhiều tin trong một lượt
+        """
+        read_by = list(msg.get('read_by', []))
+        if msg.get('receiver_id') == 0:
+            watermarks, user_ids = readers if readers is not None else self._group_readers()
+            # Các user có watermark >= ID tin nhắn đã xem tin này
+            existing = set(read_by)
+            read_by.extend(user_id for user_id in user_ids[bisect.bisect_left(watermarks, msg['id']):]
+                           if user_id not in existing)
+        return dict(msg, read_by=read_by)
+    
+    def _remove_attachment(self, msg):
+        if msg.get('attachment_filename'):
+            file_path = os.path.join(self.chat_uploads_dir, msg['attachment_filename'])
+            if os.path.exists(file_path):
+                try:
+                    os.remove(file_path)
+                except:
+                    pass
+    
+    def _migrate_to_utc(self, messages):
+        """Migrate tin nhắn cũ: chuyển created_at từ local time sang UTC"""
+        updated = False
+        for msg in messages:
+            created_at = msg.get('created_at', '')
+            # Nếu created_at không có 'Z' và không có timezone info
+            if created_at and not created_at.endswith('Z') and '+' not in created_at:
+                try:
+                    # Parse as naive datetime (assume local time)
+                    dt = datetime.fromisoformat(created_at)
+                    # Convert to UTC (giả sử local time là UTC+7)
+                    # Trừ đi 7 giờ để về UTC
+                    dt_utc = dt - timedelta(hours=7)
+                    msg['created_at'] = dt_utc.isoformat()
+                    updated = True
+                except:
+                    pass
+        
+        if updated:
+            print(f"✓ Migrated {len(messages)} messages to UTC format")
+        return updated
+    
+    def _migrate_legacy_file(self):
+        """Chuyển chat_messages.json sang các segment log rồi đổi tên file cũ thành .migrated
+        
+        Caller phải giữ self._lock và locked_file(self.lock_file).
+        """
+        try:
+            with open(self.chat_file, 'r', encoding='utf-8') as f:
+                messages = json.load(f)
+        except:
+            messages = []
+        
+        try:
+            self._migrate_to_utc(messages)
         except Exception as e:
             print(f"Migration error: {e}")
+        
+        # Chia tin nhắn vào segment theo giờ created_at, giữ thứ tự thời gian trong từng segment
+        segments = {}
+        for msg in sorted(messages, key=lambda m: (m.get('created_at', ''), m['id'])):
+            msg.setdefault('read_by', [])
+            try:
+                segment = datetime.fromisoformat(msg['created_at']).strftime(self.SEGMENT_FORMAT)
+            except:
+                segment = datetime.utcnow().strftime(self.SEGMENT_FORMAT)
+            segments.setdefault(segment, []).append(msg)
+        
+        for segment, segment_messages in segments.items():
+            with open(os.path.join(self.log_dir, segment + '.jsonl'), 'a', encoding='utf-8') as f:
+                for msg in segment_messages:
+                    f.write(json.dumps(msg, ensure_ascii=False) + '\n')
+        
+        if messages:
+            with open(self.seq_file, 'w') as f:
+                f.write(str(max(self._read_seq(), max(msg['id'] for msg in messages))))
+        os.replace(self.chat_file, self.chat_file + '.migrated')
+        self._reset_state()
+        print(f"✓ Migrated {len(messages)} chat messages to {self.log_dir}")
     
     def _cleanup_old_messages(self):
-        """Tự động xóa tin nhắn cũ hơn MESSAGE_RETENTION_HOURS giờ"""
-        messages = self._load_messages()
-        cutoff_time = datetime.now() - timedelta(hours=self.MESSAGE_RETENTION_HOURS)
+        """Tự động xóa tin nhắn cũ hơn MESSAGE_RETENTION_HOURS giờ (chạy từ scheduler)
         
-        messages_to_keep = []
+        Xóa nguyên các segment giờ (UTC) đã hết hạn cùng thư mục file đính kèm của chúng,
+        không đọc từng tin nhắn.
+        """
+        cutoff_time = datetime.utcnow() - timedelta(hours=self.MESSAGE_RETENTION_HOURS)
+        cutoff_segment = cutoff_time.strftime(self.SEGMENT_FORMAT)
         deleted_count = 0
         
-        for msg in messages:
-            try:
-                msg_time = datetime.fromisoformat(msg['created_at'])
-                if msg_time >= cutoff_time:
-                    messages_to_keep.append(msg)
-                else:
-                    # Xóa file đính kèm nếu có
-                    if msg.get('attachment_filename'):
-                        file_path = os.path.join(self.chat_uploads_dir, msg['attachment_filename'])
-                        if os.path.exists(file_path):
-                            try:
-                                os.remove(file_path)
-                            except:
-                                pass
-                    deleted_count += 1
-            except:
-                # Giữ lại tin nhắn nếu không parse được thời gian
-                messages_to_keep.append(msg)
+        with self._lock, locked_file(self.lock_file):
+            self._refresh()
+            expired = [name for name in self._segment_names() if name[:-len('.jsonl')] < cutoff_segment]
+            for name in expired:
+                deleted_count += sum(1 for msg_id in self._segment_ids.get(name, []) if msg_id in self._messages)
+                try:
+                    os.remove(os.path.join(self.log_dir, name))
+                except OSError:
+                    pass
+            
+            for entry in os.scandir(self.chat_uploads_dir):
+                if entry.is_dir() and entry.name < cutoff_segment:
+                    shutil.rmtree(entry.path, ignore_errors=True)
+            
+            if expired:
+                self._refresh()
+                self._cleanup_unpartitioned_attachments()
         
         if deleted_count > 0:
-            self._save_messages(messages_to_keep)
             print(f"✓ Đã tự động xóa {deleted_count} tin nhắn cũ hơn {self.MESSAGE_RETENTION_HOURS} giờ")
         
         return deleted_count
     
+    def _cleanup_unpartitioned_attachments(self):
+        """Xóa file đính kèm kiểu cũ (nằm thẳng trong uploads/chat/) không còn tin nhắn nào trỏ tới
+        
+        Caller phải giữ self._lock và locked_file(self.lock_file).
+        """
+        referenced = {msg['attachment_filename'] for msg in self._messages.values() if msg.get('attachment_filename')}
+        for entry in os.scandir(self.chat_uploads_dir):
+            if entry.is_file() and not entry.name.startswith('.upload_') and entry.name not in referenced:
+                try:
+                    os.remove(entry.path)
+                except OSError:
+                    pass
+    
     def get_next_id(self):
         """Lấy ID tiếp theo"""
-        messages = self._load_messages()
-        if not messages:
-            return 1
-        return max(msg['id'] for msg in messages) + 1
+        with self._lock:
+            self._refresh()
+            return max(self._read_seq(), self._last_id) + 1
     
     def send_message(self, sender_id, receiver_id, message=None, attachment_file=None):
         """Gửi tin nhắn (1-1 chat)"""
-        messages = self._load_messages()
-        msg_id = self.get_next_id()
-        
         attachment_filename = None
         attachment_original_name = None
+        attachment_size = None
+        temp_path = None
         
-        # Xử lý file đính kèm
+        # Lưu file đính kèm với tên tạm trước, để không giữ khóa log trong lúc ghi file lớn
         if attachment_file:
-            original_name = secure_filename(attachment_file.filename)
-            file_ext = os.path.splitext(original_name)[1]
-            attachment_filename = f"chat_{msg_id}_{datetime.now().strftime('%Y%m%d%H%M%S')}{file_ext}"
-            
-            # Lưu file
-            file_path = os.path.join(self.chat_uploads_dir, attachment_filename)
-            attachment_file.save(file_path)
-            attachment_original_name = original_name
-        
-        new_message = {
-            'id': msg_id,
-            'sender_id': sender_id,
-            'receiver_id': receiver_id,
-            'message': message,
-            'attachment_filename': attachment_filename,
-            'attachment_original_name': attachment_original_name,
-            'is_read': False,  # Backward compatibility
-            'read_by': [],  # List of user IDs who have read this message
-            'created_at': datetime.utcnow().isoformat()
-        }
-        
-        messages.append(new_message)
-        self._save_messages(messages)
+            attachment_original_name = secure_filename(attachment_file.filename)
+            fd, temp_path = tempfile.mkstemp(dir=self.chat_uploads_dir, prefix='.upload_', suffix='.tmp')
+            os.close(fd)
+            try:
+                attachment_file.save(temp_path)
+                attachment_size = os.path.getsize(temp_path)
+            except Exception:
+                os.remove(temp_path)
+                raise
         
-        return new_message
+        try:
+            with self._lock, locked_file(self.lock_file):
+                self._refresh()
+                msg_id = self._allocate_id()
+                segment = self._current_segment()
+                
+                if temp_path:
+                    # File đính kèm vào thư mục của segment chứa tin nhắn để hết hạn cùng lúc
+                    file_ext = os.path.splitext(attachment_original_name)[1]
+                    os.makedirs(os.path.join(self.chat_uploads_dir, segment), exist_ok=True)
+                    attachment_filename = f"{segment}/chat_{msg_id}_{datetime.now().strftime('%Y%m%d%H%M%S')}{file_ext}"
+                    os.replace(temp_path, os.path.join(self.chat_uploads_dir, attachment_filename))
+                    temp_path = None
+                
+                new_message = {
+                    'id': msg_id,
+                    'sender_id': sender_id,
+                    'receiver_id': receiver_id,
+                    'message': message,
+                    'attachment_filename': attachment_filename,
+                    'attachment_original_name': attachment_original_name,
+                    'attachment_size': attachment_size,
+                    'is_read': False,  # Backward compatibility
+                    'read_by': [],  # List of user IDs who have read this message
+                    'created_at': datetime.utcnow().isoformat()
+                }
+                self._append([new_message], segment)
+                new_message = self._messages.get(msg_id, new_message)
+                result = self._copy_message(new_message)
+        finally:
+            if temp_path and os.path.exists(temp_path):
+                try:
+                    os.remove(temp_path)
+                except:
+                    pass
+        
+        return result
     
     def send_group_message(self, sender_id, message=None, attachment_file=None):
         """Gửi tin nhắn vào group chat (receiver_id = 0)"""
@@ -163,101 +481,104 @@ class ChatStorage:
             limit: Số lượng tin nhắn tối đa (None = không giới hạn)
             offset: Bỏ qua bao nhiêu tin nhắn từ cuối (dùng cho pagination)
         """
-        messages = self._load_messages()
-        
-        # Lọc chỉ lấy group messages
-        group_messages = [msg for msg in messages if msg.get('receiver_id') == 0]
-        
-        # Sắp xếp theo thời gian
-        group_messages.sort(key=lambda x: x['created_at'])
+        with self._lock:
+            self._refresh()
+            group_ids = self._group_ids
+            
+            # Áp dụng pagination
+            if limit is None:
+                # Không giới hạn - trả về tất cả
+                selected = group_ids
+            else:
+                # Có giới hạn - lấy từ cuối, bỏ qua offset
+                start_idx = max(0, len(group_ids) - limit - offset)
+                end_idx = max(0, len(group_ids) - offset)
+                selected = group_ids[start_idx:end_idx]
+            
+            readers = self._group_readers()
+            return [self._copy_message(self._messages[msg_id], readers) for msg_id in selected]
+    
+    def get_group_messages_since(self, since_id, limit=None):
+        """Lấy tin nhắn group chat có ID lớn hơn since_id (cũ -> mới)
         
-        # Áp dụng pagination
-        if limit is None:
-            # Không giới hạn - trả về tất cả
-            return group_messages
-        else:
-            # Có giới hạn - lấy từ cuối, bỏ qua offset
-            start_idx = max(0, len(group_messages) - limit - offset)
-            end_idx = len(group_messages) - offset if offset > 0 else len(group_messages)
-            return group_messages[start_idx:end_idx]
+        Args:
+            since_id: ID tin nhắn cuối cùng client đã có
+            limit: Số lượng tin nhắn tối đa (None = không giới hạn), lấy từ tin cũ nhất sau since_id
+        """
+        with self._lock:
+            self._refresh()
+            # _group_ids luôn sắp xếp theo ID (xem _apply)
+            start_idx = bisect.bisect_right(self._group_ids, since_id)
+            end_idx = len(self._group_ids) if limit is None else start_idx + limit
+            readers = self._group_readers()
+            return [self._copy_message(self._messages[msg_id], readers) for msg_id in self._group_ids[start_idx:end_idx]]
+    
+    def count_group_messages(self):
+        """Đếm số tin nhắn group chat"""
+        with self._lock:
+            self._refresh()
+            return len(self._group_ids)
+    
+    def get_version(self):
+        """Phiên bản hiện tại của log chat (đổi khi có record mới hoặc segment bị xóa), dùng làm ETag"""
+        with self._lock:
+            self._refresh()
+            if not self._segments:
+                return '0'
+            names = sorted(self._segments)
+            # Tổng offset đã đọc: đổi cả khi record được ghi thêm vào segment không phải mới nhất
+            return f"{names[0]}-{names[-1]}-{sum(offset for _, offset in self._segments.values())}"
     
     def clear_all_group_messages(self):
         """Xóa toàn bộ lịch sử chat tổng (receiver_id = 0)"""
-        messages = self._load_messages()
+        with self._lock, locked_file(self.lock_file):
+            self._refresh()
+            deleted_ids = list(self._group_ids)
+            for msg_id in deleted_ids:
+                self._remove_attachment(self._messages[msg_id])
+            if deleted_ids:
+                self._append([{'op': 'delete', 'ids': deleted_ids}])
         
-        # Đếm số messages sẽ bị xóa
-        deleted_count = 0
-        messages_to_keep = []
+        print(f"✓ Cleared {len(deleted_ids)} group chat messages")
         
-        for msg in messages:
-            if msg.get('receiver_id') == 0:
-                # Xóa file đính kèm nếu có
-                if msg.get('attachment_filename'):
-                    file_path = os.path.join(self.chat_uploads_dir, msg['attachment_filename'])
-                    if os.path.exists(file_path):
-                        try:
-                            os.remove(file_path)
-                        except:
-                            pass
-                deleted_count += 1
-            else:
-                # Giữ lại messages không phải group (1-1 chat cũ nếu có)
-                messages_to_keep.append(msg)
-        
-        # Lưu lại messages
-        self._save_messages(messages_to_keep)
-        
-        print(f"✓ Cleared {deleted_count} group chat messages")
-        
-        return deleted_count
+        return len(deleted_ids)
+    
+    def clear_conversation(self, sender_id, receiver_id):
+        """Xóa các tin nhắn sender_id đã gửi cho receiver_id (kèm file đính kèm)"""
+        with self._lock, locked_file(self.lock_file):
+            self._refresh()
+            deleted_ids = []
+            for msg in self._messages.values():
+                if msg['sender_id'] == sender_id and msg['receiver_id'] == receiver_id:
+                    self._remove_attachment(msg)
+                    deleted_ids.append(msg['id'])
+            if deleted_ids:
+                self._append([{'op': 'delete', 'ids': deleted_ids}])
+        return len(deleted_ids)
     
     def get_conversation(self, user1_id, user2_id, limit=500):
         """Lấy cuộc hội thoại giữa 2 users"""
-        # KHÔNG cleanup ở đây - chỉ cleanup khi khởi tạo app
-        # self._cleanup_old_messages()
-        
-        messages = self._load_messages()
-        
-        # Lọc tin nhắn giữa 2 users
-        conversation = [
-            msg for msg in messages
-            if (msg['sender_id'] == user1_id and msg['receiver_id'] == user2_id) or
-               (msg['sender_id'] == user2_id and msg['receiver_id'] == user1_id)
-        ]
-        
-        # Sắp xếp theo thời gian
-        conversation.sort(key=lambda x: x['created_at'])
-        
-        # Giới hạn số lượng
-        return conversation[-limit:]
+        with self._lock:
+            self._refresh()
+            conversation = self._conversations.get(self._conversation_key(user1_id, user2_id), [])
+            
+            # Giới hạn số lượng (index đã theo thứ tự gửi)
+            return [self._copy_message(self._messages[msg_id]) for msg_id in conversation[-limit:]]
     
     def get_user_conversations(self, user_id):
-        """Lấy danh sách người đã chat với user"""
-        messages = self._load_messages()
-        
-        # Tìm tất cả users đã chat
-        users = set()
-        for msg in messages:
-            if msg['sender_id'] == user_id:
-                users.add(msg['receiver_id'])
-            elif msg['receiver_id'] == user_id:
-                users.add(msg['sender_id'])
-        
-        # Lấy tin nhắn cuối cùng và số tin chưa đọc cho mỗi user
-        conversations = []
-        for other_user_id in users:
-            conv_messages = self.get_conversation(user_id, other_user_id)
-            if conv_messages:
-                last_message = conv_messages[-1]
-                unread_count = sum(
-                    1 for msg in conv_messages
-                    if msg['receiver_id'] == user_id and not msg['is_read']
-                )
-                conversations.append({
-                    'user_id': other_user_id,
-                    'last_message': last_message,
-                    'unread_count': unread_count
-                })
+        """Lấy danh sách người đã chat với user (tin nhắn cuối + số tin chưa đọc lấy từ index)"""
+        with self._lock:
+            self._refresh()
+            unread = self._unread.get(user_id, {})
+            conversations = []
+            for other_user_id in self._peers.get(user_id, ()):
+                conversation = self._conversations.get(self._conversation_key(user_id, other_user_id))
+                if conversation:
+                    conversations.append({
+                        'user_id': other_user_id,
+                        'last_message': self._copy_message(self._messages[conversation[-1]]),
+                        'unread_count': unread.get(other_user_id, 0)
+                    })
         
         # Sắp xếp theo thời gian tin nhắn cuối
         conversations.sort(key=lambda x: x['last_message']['created_at'], reverse=True)
@@ -266,82 +587,108 @@ class ChatStorage:
     
     def mark_as_read(self, user_id, other_user_id):
         """Đánh dấu tất cả tin nhắn từ other_user là đã đọc"""
-        messages = self._load_messages()
+        with self._lock:
+            self._refresh()
+            if not self._unread.get(user_id, {}).get(other_user_id):
+                return
+            
+            with locked_file(self.lock_file):
+                self._refresh()
+                if self._unread.get(user_id, {}).get(other_user_id):
+                    self._append([{'op': 'read_conversation', 'sender_id': other_user_id,
+                                   'receiver_id': user_id, 'up_to': self._last_id}])
+    
+    def get_group_read_id(self, user_id):
+        """ID tin nhắn group cuối cùng user đã xem (0 = chưa xem tin nào)"""
+        with self._lock:
+            self._refresh()
+            return self._group_read.get(user_id, 0)
+    
+    def mark_group_read(self, user_id, up_to_id):
+        """Đánh dấu user đã xem mọi tin nhắn group có ID <= up_to_id (chỉ ghi khi watermark tăng)
         
-        for msg in messages:
-            if msg['sender_id'] == other_user_id and msg['receiver_id'] == user_id:
-                msg['is_read'] = True
+        Returns:
+            True nếu watermark được nâng lên
+        """
+        with self._lock:
+            self._refresh()
+            up_to_id = min(int(up_to_id), self._last_id)
+            if up_to_id <= self._group_read.get(user_id, 0):
+                return False
+            
+            with locked_file(self.lock_file):
+                self._refresh()
+                if up_to_id <= self._group_read.get(user_id, 0):
+                    return False
+                self._append([{'op': 'group_read', 'user_id': user_id, 'up_to': up_to_id}])
         
-        self._save_messages(messages)
+        return True
     
     def mark_message_as_read_by_user(self, message_id, user_id):
-        """Đánh dấu user đã xem tin nhắn (cho group chat)"""
-        messages = self._load_messages()
-        updated = False
-        
-        for msg in messages:
-            if msg['id'] == message_id:
-                # Khởi tạo read_by nếu chưa có (backward compatibility)
-                if 'read_by' not in msg:
-                    msg['read_by'] = []
-                
-                # Thêm user vào danh sách đã xem nếu chưa có
-                if user_id not in msg['read_by']:
-                    msg['read_by'].append(user_id)
-                    updated = True
-                break
-        
-        if updated:
-            self._save_messages(messages)
-        
-        return updated
+        """Đánh dấu user đã xem tin nhắn (cho group chat) - nâng watermark tới tin này"""
+        with self._lock:
+            self._refresh()
+            msg = self._messages.get(message_id)
+            if msg is None or msg.get('receiver_id') != 0:
+                return False
+        return self.mark_group_read(user_id, message_id)
     
     def get_unread_count(self, user_id):
-        """Đếm số tin nhắn chưa đọc của user"""
-        messages = self._load_messages()
-        
-        return sum(
-            1 for msg in messages
-            if msg['receiver_id'] == user_id and not msg['is_read']
-        )
+        """Đếm số tin nhắn chưa đọc của user (bộ đếm theo người nhận)"""
+        with self._lock:
+            self._refresh()
+            return self._unread_total.get(user_id, 0)
     
     def delete_message(self, message_id, user_id):
         """Xóa tin nhắn (chỉ người gửi mới xóa được)"""
-        messages = self._load_messages()
-        
-        # Tìm message để xóa file đính kèm
-        for msg in messages:
-            if msg['id'] == message_id and msg['sender_id'] == user_id:
-                if msg.get('attachment_filename'):
-                    file_path = os.path.join(self.chat_uploads_dir, msg['attachment_filename'])
-                    if os.path.exists(file_path):
-                        try:
-                            os.remove(file_path)
-                        except:
-                            pass
-        
-        messages = [
-            msg for msg in messages
-            if not (msg['id'] == message_id and msg['sender_id'] == user_id)
-        ]
-        
-        self._save_messages(messages)
+        with self._lock, locked_file(self.lock_file):
+            self._refresh()
+            msg = self._messages.get(message_id)
+            if msg is not None and msg['sender_id'] == user_id:
+                self._remove_attachment(msg)
+                self._append([{'op': 'delete', 'ids': [message_id]}])
         return True
     
     def get_user_storage_usage(self, user_id):
-        """Tính tổng dung lượng file chat của user (bytes)"""
-        messages = self._load_messages()
-        total_size = 0
+        """Tổng dung lượng file chat của user gửi hoặc nhận (bytes), lấy từ bộ đếm - không stat file"""
+        with self._lock:
+            self._refresh()
+            return self._storage_usage.get(user_id, 0)
+    
+    def reconcile_storage_usage(self):
+        """Đối chiếu attachment_size đã ghi với file thật trên đĩa, ghi bù các chỗ lệch vào log
         
-        for msg in messages:
-            # Chỉ tính file của user gửi hoặc nhận
-            if msg['sender_id'] == user_id or msg['receiver_id'] == user_id:
-                if msg.get('attachment_filename'):
-                    file_path = os.path.join(self.chat_uploads_dir, msg['attachment_filename'])
-                    if os.path.exists(file_path):
-                        total_size += os.path.getsize(file_path)
+        Chạy định kỳ từ scheduler (file bị xóa/sửa ngoài ứng dụng, tin nhắn cũ chưa có attachment_size).
         
-        return total_size
+        Returns:
+            Số tin nhắn được sửa kích thước
+        """
+        with self._lock:
+            self._refresh()
+            attachments = [(msg['id'], msg['attachment_filename'], msg.get('attachment_size'))
+                           for msg in self._messages.values() if msg.get('attachment_filename')]
+        
+        # stat ngoài mọi khóa để không chặn việc đọc/gửi tin trong lúc duyệt toàn bộ file đính kèm
+        actual = {}
+        for msg_id, filename, size in attachments:
+            file_size = self._attachment_file_size({'attachment_filename': filename})
+            if file_size != size:
+                actual[msg_id] = (filename, file_size)
+        if not actual:
+            return 0
+        
+        with self._lock, locked_file(self.lock_file):
+            self._refresh()
+            # Bỏ qua tin đã bị xóa/sửa hoặc đã được sửa kích thước trong lúc stat
+            sizes = []
+            for msg_id, (filename, file_size) in actual.items():
+                msg = self._messages.get(msg_id)
+                if msg and msg.get('attachment_filename') == filename and msg.get('attachment_size') != file_size:
+                    sizes.append([msg_id, file_size])
+            if sizes:
+                self._append([{'op': 'attachment_size', 'sizes': sizes}])
+        
+        return len(sizes)
     
     def get_storage_info(self, user_id):
         """Lấy thông tin storage của user"""
@@ -378,15 +725,18 @@ class ChatStorage:
         return True, None
     
     def get_user_files_list(self, user_id):
-        """Lấy danh sách file của user để quản lý"""
-        messages = self._load_messages()
+        """Lấy danh sách file của user để quản lý (kích thước lấy từ attachment_size)"""
+        with self._lock:
+            self._refresh()
+            messages = [self._messages[msg_id]
+                        for other_user_id in self._peers.get(user_id, ())
+                        for msg_id in self._conversations.get(self._conversation_key(user_id, other_user_id), [])]
         files = []
         
         for msg in messages:
-            if (msg['sender_id'] == user_id or msg['receiver_id'] == user_id) and msg.get('attachment_filename'):
-                file_path = os.path.join(self.chat_uploads_dir, msg['attachment_filename'])
-                if os.path.exists(file_path):
-                    file_size = os.path.getsize(file_path)
+            if msg.get('attachment_filename'):
+                file_size = msg.get('attachment_size')
+                if file_size is not None:
                     files.append({
                         'message_id': msg['id'],
                         'filename': msg['attachment_filename'],
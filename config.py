@@ -21,6 +21,9 @@ class Config:
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     SQLALCHEMY_ECHO = False  # Set True để debug SQL queries
     
+    # Storage backend: 'file' (CSV/JSON trong DATA_DIR) hoặc 'database' (SQLALCHEMY_DATABASE_URI)
+    STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'file')
+    
     # Session configuration
     # Session sẽ tự động hết hạn sau PERMANENT_SESSION_LIFETIME kể từ request cuối cùng
     PERMANENT_SESSION_LIFETIME = timedelta(hours=1)  # Session timeout: 1 giờ
@@ -39,6 +42,20 @@ class Config:
     HOST = os.environ.get('HOST', '0.0.0.0')
     PORT = int(os.environ.get('PORT', 5001))
     
+    # Số notes/docs mỗi trang trong danh sách
+    ITEMS_PER_PAGE = int(os.environ.get('ITEMS_PER_PAGE', 24))
+    
+    # Realtime (Server-Sent Events): mỗi kết nối giữ một thread, tự đóng sau N giây rồi client kết nối lại
+    SSE_STREAM_TIMEOUT = int(os.environ.get('SSE_STREAM_TIMEOUT', 300))
+    
+    # Long-poll /api/badges: giữ request tối đa N giây chờ số chưa đọc thay đổi
+    BADGES_LONG_POLL_TIMEOUT = int(os.environ.get('BADGES_LONG_POLL_TIMEOUT', 25))
+    
+    # Số kết nối realtime (SSE + long-poll) tối đa mỗi gunicorn worker giữ cùng lúc.
+    # Mỗi tab đang mở giữ 1 thread; phải nhỏ hơn THREADS để còn thread cho request thường.
+    # Vượt giới hạn: SSE trả 204 (tab chuyển sang polling), long-poll trả ngay kèm retry_after.
+    REALTIME_MAX_CONNECTIONS = int(os.environ.get('REALTIME_MAX_CONNECTIONS', 16))
+    
     # Logging
     LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
     LOG_FILE = os.path.join(DATA_DIR, 'app.log')
@@ -3,154 +3,253 @@ Module quản lý người dùng bằng CSV
 """
 import csv
 import os
+import tempfile
+import threading
 from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime
 from flask_login import UserMixin
+from file_lock import locked_file
 
 class CSVUserStorage:
+    FIELDNAMES = ['id', 'username', 'email', 'password_hash', 'role', 'created_at', 'is_active', 'avatar']
+    
     def __init__(self, csv_file='users.csv'):
         self.csv_file = csv_file
+        self.lock_file = os.path.abspath(csv_file) + '.lock'
+        
+        # Cache users trong bộ nhớ + index theo id, username và email (chữ thường),
+        # chỉ đọc lại CSV khi file trên đĩa thay đổi (inode/size/mtime/ctime)
+        self._lock = threading.RLock()
+        self._users = None
+        self._signature = None
+        self._by_id = {}
+        self._by_username = {}
+        self._by_email = {}
+        
         self.ensure_csv_exists()
     
     def ensure_csv_exists(self):
         """Đảm bảo file CSV tồn tại với header"""
-        if not os.path.exists(self.csv_file):
-            with open(self.csv_file, 'w', newline='', encoding='utf-8') as f:
-                writer = csv.writer(f)
-                writer.writerow(['id', 'username', 'email', 'password_hash', 'role', 'created_at', 'is_active', 'avatar'])
+        with self._lock, locked_file(self.lock_file):
+            if not os.path.exists(self.csv_file):
+                self._save_all_users([])
+    
+    def _file_signature(self, path=None):
+        try:
+            st = os.stat(path or self.csv_file)
+        except OSError:
+            return None
+        return (st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns)
+    
+    def _set_cache(self, users, signature):
+        """Ghi danh sách users vào cache và build lại các index"""
+        self._users = users
+        self._signature = signature
+        self._by_id = {}
+        self._by_username = {}
+        self._by_email = {}
+        for user in users:
+            self._index_user(user)
+    
+    def _index_user(self, user):
+        self._by_id[user['id']] = user
+        self._by_username[user['username'].lower()] = user
+        if user.get('email'):
+            self._by_email[user['email'].lower()] = user
+    
+    def _unindex_user(self, user):
+        self._by_id.pop(user['id'], None)
+        if self._by_username.get(user['username'].lower()) is user:
+            del self._by_username[user['username'].lower()]
+        if user.get('email') and self._by_email.get(user['email'].lower()) is user:
+            del self._by_email[user['email'].lower()]
+    
+    def _load_users(self):
+        """Load users (có cache), trả về list dict dùng chung - không sửa trực tiếp"""
+        with self._lock:
+            signature = self._file_signature()
+            if self._users is not None and signature is not None and signature == self._signature:
+                return self._users
+            
+            users = []
+            if signature is not None:
+                with open(self.csv_file, 'r', encoding='utf-8') as f:
+                    reader = csv.DictReader(f)
+                    for row in reader:
+                        row['id'] = int(row['id'])
+                        row['is_active'] = row['is_active'].lower() == 'true'
+                        users.append(row)
+            self._set_cache(users, signature)
+            return users
     
     def get_next_id(self):
         """Lấy ID tiếp theo"""
-        users = self.get_all_users()
-        if not users:
-            return 1
-        return max(int(u['id']) for u in users) + 1
+        with self._lock:
+            self._load_users()
+            if not self._by_id:
+                return 1
+            return max(self._by_id) + 1
     
     def get_all_users(self):
-        """Lấy tất cả users từ CSV"""
-        users = []
-        if not os.path.exists(self.csv_file):
-            return users
-        
-        with open(self.csv_file, 'r', encoding='utf-8') as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                row['id'] = int(row['id'])
-                row['is_active'] = row['is_active'].lower() == 'true'
-                users.append(row)
-        return users
+        """Lấy tất cả users từ CSV (bản sao, caller được phép sửa)"""
+        return [dict(user) for user in self._load_users()]
     
     def get_user_by_id(self, user_id):
         """Lấy user theo ID"""
-        users = self.get_all_users()
-        for user in users:
-            if user['id'] == int(user_id):
-                return self._dict_to_user(user)
-        return None
+        with self._lock:
+            self._load_users()
+            user = self._by_id.get(int(user_id))
+            return self._dict_to_user(user) if user else None
+    
+    def get_users_by_ids(self, user_ids):
+        """Lấy nhiều user một lần
+        
+        Returns:
+            Dict {user_id: User} (ID không tồn tại sẽ không có trong dict)
+        """
+        with self._lock:
+            self._load_users()
+            result = {}
+            for user_id in user_ids:
+                user = self._by_id.get(int(user_id))
+                if user:
+                    result[user['id']] = self._dict_to_user(user)
+            return result
     
     def get_user_by_username(self, username):
         """Lấy user theo username (case-insensitive)"""
-        users = self.get_all_users()
-        username_lower = username.lower()
-        for user in users:
-            if user['username'].lower() == username_lower:
-                return self._dict_to_user(user)
-        return None
+        with self._lock:
+            self._load_users()
+            user = self._by_username.get(username.lower())
+            return self._dict_to_user(user) if user else None
     
     def create_user(self, username, password, email=None, role='user'):
         """Tạo user mới"""
-        # Kiểm tra username đã tồn tại
-        if self.get_user_by_username(username):
-            return None
-        
-        # Kiểm tra email đã tồn tại (nếu có)
-        if email:
-            users = self.get_all_users()
-            for user in users:
-                if user.get('email') and user['email'].lower() == email.lower():
-                    return None
-        
-        user_id = self.get_next_id()
-        password_hash = generate_password_hash(password)
-        created_at = datetime.utcnow().isoformat()
-        
-        # Thêm user mới vào CSV (avatar mặc định là rỗng)
-        with open(self.csv_file, 'a', newline='', encoding='utf-8') as f:
-            writer = csv.writer(f)
-            writer.writerow([user_id, username, email or '', password_hash, role, created_at, 'True', ''])
-        
-        return self.get_user_by_id(user_id)
+        with self._lock, locked_file(self.lock_file):
+            self._load_users()
+            
+            # Kiểm tra username đã tồn tại
+            if username.lower() in self._by_username:
+                return None
+            
+            # Kiểm tra email đã tồn tại (nếu có)
+            if email and email.lower() in self._by_email:
+                return None
+            
+            user = {
+                'id': self.get_next_id(),
+                'username': username,
+                'email': email or '',
+                'password_hash': generate_password_hash(password),
+                'role': role,
+                'created_at': datetime.utcnow().isoformat(),
+                'is_active': True,
+                'avatar': ''  # avatar mặc định là rỗng
+            }
+            
+            # Thêm user mới vào cuối CSV rồi cập nhật cache tại chỗ
+            with open(self.csv_file, 'a', newline='', encoding='utf-8') as f:
+                writer = csv.writer(f)
+                writer.writerow(self._to_row(user))
+            self._users.append(user)
+            self._index_user(user)
+            self._signature = self._file_signature()
+            
+            return self._dict_to_user(user)
     
     def update_user(self, user_id, username=None, email=None, role=None, password=None, is_active=None, avatar=None):
         """Cập nhật user"""
-        users = self.get_all_users()
-        updated = False
-        
-        for user in users:
-            if user['id'] == int(user_id):
-                if username is not None:
-                    # Kiểm tra username trùng (trừ chính nó)
-                    existing = self.get_user_by_username(username)
-                    if existing and existing.id != int(user_id):
+        with self._lock, locked_file(self.lock_file):
+            users = self._load_users()
+            current = self._by_id.get(int(user_id))
+            if current is None:
+                return False
+            user = dict(current)
+            updated = False
+            
+            if username is not None:
+                # Kiểm tra username trùng (trừ chính nó)
+                existing = self._by_username.get(username.lower())
+                if existing and existing['id'] != user['id']:
+                    return False
+                user['username'] = username
+                updated = True
+            
+            if email is not None:
+                # Kiểm tra email trùng (trừ chính nó)
+                if email:
+                    existing = self._by_email.get(email.lower())
+                    if existing and existing['id'] != user['id']:
                         return False
-                    user['username'] = username
-                    updated = True
-                
-                if email is not None:
-                    # Kiểm tra email trùng (trừ chính nó)
-                    if email:
-                        for u in users:
-                            if u.get('email') and u['email'].lower() == email.lower() and u['id'] != int(user_id):
-                                return False
-                    user['email'] = email or ''
-                    updated = True
-                
-                if role is not None:
-                    user['role'] = role
-                    updated = True
-                
-                if password is not None:
-                    user['password_hash'] = generate_password_hash(password)
-                    updated = True
-                
-                if is_active is not None:
-                    user['is_active'] = is_active
-                    updated = True
-                
-                if avatar is not None:
-                    user['avatar'] = avatar
-                    updated = True
-                
-                break
-        
-        if updated:
-            self._save_all_users(users)
-        
-        return updated
+                user['email'] = email or ''
+                updated = True
+            
+            if role is not None:
+                user['role'] = role
+                updated = True
+            
+            if password is not None:
+                user['password_hash'] = generate_password_hash(password)
+                updated = True
+            
+            if is_active is not None:
+                user['is_active'] = is_active
+                updated = True
+            
+            if avatar is not None:
+                user['avatar'] = avatar
+                updated = True
+            
+            if updated:
+                new_users = [user if u is current else u for u in users]
+                self._save_all_users(new_users)
+            
+            return updated
     
     def delete_user(self, user_id):
         """Xóa user"""
-        users = self.get_all_users()
-        users = [u for u in users if u['id'] != int(user_id)]
-        self._save_all_users(users)
+        with self._lock, locked_file(self.lock_file):
+            users = self._load_users()
+            self._save_all_users([u for u in users if u['id'] != int(user_id)])
         return True
     
+    @staticmethod
+    def _to_row(user):
+        return [
+            user['id'],
+            user['username'],
+            user.get('email', ''),
+            user['password_hash'],
+            user['role'],
+            user.get('created_at', datetime.utcnow().isoformat()),
+            str(user.get('is_active', True)),
+            user.get('avatar', '')
+        ]
+    
     def _save_all_users(self, users):
-        """Lưu tất cả users vào CSV"""
-        with open(self.csv_file, 'w', newline='', encoding='utf-8') as f:
-            writer = csv.writer(f)
-            writer.writerow(['id', 'username', 'email', 'password_hash', 'role', 'created_at', 'is_active', 'avatar'])
-            for user in users:
-                writer.writerow([
-                    user['id'],
-                    user['username'],
-                    user.get('email', ''),
-                    user['password_hash'],
-                    user['role'],
-                    user.get('created_at', datetime.utcnow().isoformat()),
-                    str(user.get('is_active', True)),
-                    user.get('avatar', '')
-                ])
+        """Lưu tất cả users vào CSV (atomic) và cập nhật cache
+        
+        Caller phải giữ self._lock và locked_file(self.lock_file).
+        """
+        csv_dir = os.path.dirname(os.path.abspath(self.csv_file))
+        fd, temp_file = tempfile.mkstemp(dir=csv_dir, prefix=os.path.basename(self.csv_file) + '.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', newline='', encoding='utf-8') as f:
+                writer = csv.writer(f)
+                writer.writerow(self.FIELDNAMES)
+                for user in users:
+                    writer.writerow(self._to_row(user))
+            os.replace(temp_file, self.csv_file)
+            # rename đổi ctime: lấy chữ ký của file đích (vẫn đang giữ lock_file)
+            signature = self._file_signature()
+        except Exception:
+            if os.path.exists(temp_file):
+                try:
+                    os.remove(temp_file)
+                except:
+                    pass
+            raise
+        self._set_cache(users, signature)
     
     def _dict_to_user(self, user_dict):
         """Chuyển đổi dict thành User object"""
@@ -0,0 +1,1018 @@
+"""
+Storage dùng database (SQLAlchemy, models.py) với cùng API như FileStorage,
+CSVUserStorage và ChatStorage để app.py chuyển backend mà không phải sửa routes.
+
+Bật bằng STORAGE_BACKEND=database, database lấy từ SQLALCHEMY_DATABASE_URI
+(dữ liệu cũ chuyển sang bằng migrate_to_database.py).
+"""
+import os
+import json
+import uuid
+import bisect
+import shutil
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from flask import has_app_context
+from sqlalchemy import event, func, inspect, or_, and_, text
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import defer
+from werkzeug.security import generate_password_hash
+from werkzeug.utils import secure_filename
+
+from models import db, User as UserModel, Category as CategoryModel, Note as NoteModel, \
+    Document as DocumentModel, Attachment as AttachmentModel, ChatMessage as ChatMessageModel, \
+    GroupChatRead as GroupChatReadModel, ChatVersion as ChatVersionModel
+from csv_storage import CSVUserStorage
+from chat_storage import ChatStorage
+from file_storage import Note, Document
+from search_index import SearchIndex
+
+
+def init_database(app):
+    """Gắn db vào app, bật WAL cho SQLite và tạo bảng/index còn thiếu"""
+    db.init_app(app)
+    with app.app_context():
+        engine = db.engine
+        if engine.dialect.name == 'sqlite':
+            db_dir = os.path.dirname(engine.url.database or '')
+            if db_dir:
+                os.makedirs(db_dir, exist_ok=True)
+            
+            @event.listens_for(engine, 'connect')
+            def _set_sqlite_pragmas(dbapi_connection, connection_record):
+                # WAL: nhiều worker đọc song song trong lúc một worker ghi
+                cursor = dbapi_connection.cursor()
+                cursor.execute('PRAGMA journal_mode=WAL')
+                cursor.execute('PRAGMA synchronous=NORMAL')
+                cursor.execute('PRAGMA busy_timeout=5000')
+                cursor.close()
+            engine.dispose()
+        
+        db.create_all()
+        _upgrade_schema(engine)
+
+
+def _upgrade_schema(engine):
+    """Thêm cột/index mới vào các bảng đã được tạo từ trước (create_all không tự làm)"""
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        for table in db.metadata.sorted_tables:
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing and column.nullable:
+                    column_type = column.type.compile(dialect=engine.dialect)
+                    conn.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=engine, checkfirst=True)
+
+
+class _DatabaseStorageBase:
+    def __init__(self, app):
+        self.app = app
+    
+    @contextmanager
+    def _context(self):
+        """Đảm bảo có app context (scheduler job chạy ngoài request)"""
+        if has_app_context():
+            yield
+        else:
+            with self.app.app_context():
+                yield
+
+
+class DatabaseFileStorage(_DatabaseStorageBase):
+    """Notes và Documents trong database; file đính kèm vẫn nằm trong uploads_dir"""
+    SORT_KEYS = {'note': ('updated_at', 'view_count', 'title'), 'doc': ('updated_at', 'title')}
+    
+    def __init__(self, app, data_dir='data', uploads_dir=None, search_index_file=None):
+        super().__init__(app)
+        self.uploads_dir = os.path.abspath(os.path.normpath(uploads_dir or os.path.join(data_dir, 'uploads')))
+        self.notes_uploads_dir = os.path.join(self.uploads_dir, 'notes')
+        self.docs_uploads_dir = os.path.join(self.uploads_dir, 'docs')
+        os.makedirs(self.notes_uploads_dir, exist_ok=True)
+        os.makedirs(self.docs_uploads_dir, exist_ok=True)
+        
+        # Dùng chung inverted index với FileStorage (index lưu theo ID nên không phụ thuộc backend)
+        if search_index_file is None:
+            search_index_file = os.path.join(data_dir, 'search_index.json')
+        self.search_index = SearchIndex(search_index_file)
+        if not self.search_index.exists():
+            self.rebuild_search_index()
+    
+    @staticmethod
+    def _model(item_type):
+        return NoteModel if item_type == 'note' else DocumentModel
+    
+    @staticmethod
+    def _attachment_fk(item_type):
+        return AttachmentModel.note_id if item_type == 'note' else AttachmentModel.document_id
+    
+    def _uploads_dir_for(self, item_type):
+        return self.notes_uploads_dir if item_type == 'note' else self.docs_uploads_dir
+    
+    def _ensure_category(self, key):
+        """Tạo Category nếu chưa có (notes/documents có foreign key tới categories.key)"""
+        if key and not db.session.query(CategoryModel.id).filter_by(key=key).first():
+            name = key.rsplit('/', 1)[-1]
+            db.session.add(CategoryModel(key=key, name=name, display_name=name))
+    
+    def _load_attachments(self, item_type, item_ids):
+        """Lấy attachments của nhiều item trong một query: {item_id: [dict]}"""
+        result = {item_id: [] for item_id in item_ids}
+        if not item_ids:
+            return result
+        fk = self._attachment_fk(item_type)
+        rows = AttachmentModel.query.filter(fk.in_(item_ids)).order_by(AttachmentModel.id).all()
+        for row in rows:
+            result.setdefault(row.note_id if item_type == 'note' else row.document_id, []).append({
+                'filename': row.filename,
+                'original_filename': row.original_filename,
+                'uploaded_at': row.uploaded_at.isoformat()
+            })
+        return result
+    
+    def _load_content(self, item_type, item_id):
+        with self._context():
+            model = self._model(item_type)
+            content = db.session.query(model.content).filter(model.id == item_id).scalar()
+            return content or ''
+    
+    def _build_item(self, item_type, row, attachments, with_content=False):
+        """Tạo Note/Document từ row; nội dung đọc lười nếu with_content=False"""
+        item_id = row.id
+        content = row.content if with_content else None
+        loader = None if with_content else (lambda: self._load_content(item_type, item_id))
+        if item_type == 'note':
+            return Note(
+                id=row.id,
+                title=row.title,
+                content=content,
+                category=row.category_key or 'general',
+                user_id=row.user_id,
+                attachments=attachments,
+                view_count=row.view_count or 0,
+                created_at=row.created_at,
+                updated_at=row.updated_at,
+                updated_by=row.updated_by,
+                content_loader=loader
+            )
+        return Document(
+            id=row.id,
+            title=row.title,
+            content=content,
+            category=row.category_key or 'general',
+            user_id=row.user_id,
+            attachments=attachments,
+            created_at=row.created_at,
+            updated_at=row.updated_at,
+            content_loader=loader
+        )
+    
+    def _build_items(self, item_type, rows):
+        attachments = self._load_attachments(item_type, [row.id for row in rows])
+        return [self._build_item(item_type, row, attachments.get(row.id, [])) for row in rows]
+    
+    def get_next_id(self, item_type='note'):
+        """Lấy ID tiếp theo"""
+        with self._context():
+            model = self._model(item_type)
+            return (db.session.query(func.max(model.id)).scalar() or 0) + 1
+    
+    # === SEARCH INDEX ===
+    def _update_search_index(self, item_type, item_id, title, content):
+        try:
+            self.search_index.index_item(item_type, item_id, title, content)
+        except Exception as e:
+            print(f"Lỗi khi cập nhật search index ({item_type} {item_id}): {e}")
+    
+    def _remove_from_search_index(self, item_type, item_id):
+        try:
+            self.search_index.remove_item(item_type, item_id)
+        except Exception as e:
+            print(f"Lỗi khi cập nhật search index ({item_type} {item_id}): {e}")
+    
+    def reindex_item(self, item_type, item_id):
+        """Index lại một note/doc theo dữ liệu hiện tại (dùng cho job nền; item đã bị xóa thì bỏ khỏi index)"""
+        with self._context():
+            row = db.session.get(self._model(item_type), int(item_id))
+            title, content = (row.title, row.content) if row else (None, None)
+        if row is not None:
+            self._update_search_index(item_type, item_id, title, content)
+        else:
+            self._remove_from_search_index(item_type, item_id)
+    
+    def rebuild_search_index(self):
+        """Build lại toàn bộ index tìm kiếm từ database"""
+        with self._context():
+            items = []
+            for item_type in ('note', 'doc'):
+                model = self._model(item_type)
+                for item_id, title, content in db.session.query(model.id, model.title, model.content):
+                    items.append((item_type, item_id, title, content))
+        self.search_index.rebuild(items)
+    
+    def search_ids(self, query, item_type='note', category=None):
+        """ID các notes/docs khớp query (đã lọc category), sắp xếp theo độ liên quan
+        
+        Chỉ trả về ID để caller dùng chung một lần tìm kiếm cho cả tổng số và trang kết quả.
+        """
+        ranked_ids = [item_id for _, item_id, _ in self.search_index.search(query, item_type=item_type)]
+        if not ranked_ids:
+            return []
+        with self._context():
+            model = self._model(item_type)
+            q = db.session.query(model.id).filter(model.id.in_(ranked_ids))
+            if category and category != 'all':
+                q = q.filter(model.category_key == category)
+            existing = {item_id for item_id, in q}
+        return [item_id for item_id in ranked_ids if item_id in existing]
+    
+    def get_items_by_ids(self, item_type, ids):
+        """Notes/docs theo danh sách ID, giữ thứ tự (bỏ qua ID không còn tồn tại, nội dung đọc lười)"""
+        if not ids:
+            return []
+        with self._context():
+            model = self._model(item_type)
+            rows = {row.id: row for row in model.query.options(defer(model.content)).filter(model.id.in_(ids))}
+            return self._build_items(item_type, [rows[item_id] for item_id in ids if item_id in rows])
+    
+    def search(self, query, item_type='note', category=None, limit=None):
+        """Tìm kiếm notes/docs qua inverted index, kết quả sắp xếp theo độ liên quan"""
+        ids = self.search_ids(query, item_type=item_type, category=category)
+        return self.get_items_by_ids(item_type, ids[:limit] if limit is not None else ids)
+    
+    def _filtered_query(self, item_type, category=None):
+        model = self._model(item_type)
+        q = model.query.options(defer(model.content))
+        if category and category != 'all':
+            q = q.filter(model.category_key == category)
+        return q
+    
+    def _get_all(self, item_type, category=None, search_query=None, sort='updated_at', limit=None, offset=0):
+        if search_query:
+            ids = self.search_ids(search_query, item_type=item_type, category=category)
+            return self.get_items_by_ids(item_type, ids[offset:offset + limit] if limit is not None else ids[offset:])
+        with self._context():
+            model = self._model(item_type)
+            if sort not in self.SORT_KEYS[item_type]:
+                sort = 'updated_at'
+            if sort == 'view_count':
+                order = (model.view_count.desc(), model.updated_at.desc())
+            elif sort == 'title':
+                order = (func.lower(model.title), model.id)
+            else:
+                order = (model.updated_at.desc(), model.id.desc())
+            q = self._filtered_query(item_type, category).order_by(*order).offset(offset)
+            if limit is not None:
+                q = q.limit(limit)
+            return self._build_items(item_type, q.all())
+    
+    def count_items(self, item_type='note', category=None, search_query=None):
+        """Đếm số notes/docs khớp bộ lọc (dùng cho phân trang)"""
+        if search_query:
+            return len(self.search_ids(search_query, item_type=item_type, category=category))
+        with self._context():
+            return self._filtered_query(item_type, category).order_by(None).count()
+    
+    def _get_one(self, item_type, item_id):
+        with self._context():
+            row = db.session.get(self._model(item_type), int(item_id))
+            if row is None:
+                return None
+            attachments = self._load_attachments(item_type, [row.id])
+            return self._build_item(item_type, row, attachments[row.id], with_content=True)
+    
+    def _create(self, item_type, title, content, category, user_id, update_search_index=True):
+        with self._context():
+            self._ensure_category(category)
+            now = datetime.utcnow()
+            row = self._model(item_type)(
+                title=title,
+                content=content,
+                category_key=category,
+                user_id=user_id,
+                created_at=now,
+                updated_at=now
+            )
+            db.session.add(row)
+            db.session.commit()
+            item_id = row.id
+        if update_search_index:
+            self._update_search_index(item_type, item_id, title, content)
+        return self._get_one(item_type, item_id)
+    
+    def _update(self, item_type, item_id, title=None, content=None, category=None, user_id=None):
+        with self._context():
+            row = db.session.get(self._model(item_type), int(item_id))
+            if row is None:
+                return False
+            updated = False
+            if content is not None:
+                row.content = content
+                updated = True
+            if title is not None:
+                row.title = title
+                updated = True
+            if category is not None:
+                self._ensure_category(category)
+                row.category_key = category
+                updated = True
+            if not updated:
+                return False
+            row.updated_at = datetime.utcnow()
+            if item_type == 'note' and user_id is not None:
+                row.updated_by = user_id
+            new_title, new_content = row.title, row.content
+            db.session.commit()
+        if title is not None or content is not None:
+            self._update_search_index(item_type, item_id, new_title, new_content)
+        return True
+    
+    def _delete(self, item_type, item_id):
+        with self._context():
+            row = db.session.get(self._model(item_type), int(item_id))
+            if row is None:
+                return False
+            fk = self._attachment_fk(item_type)
+            for attachment in AttachmentModel.query.filter(fk == row.id):
+                attach_path = os.path.join(self._uploads_dir_for(item_type), attachment.filename)
+                if os.path.exists(attach_path):
+                    os.remove(attach_path)
+                db.session.delete(attachment)
+            db.session.delete(row)
+            db.session.commit()
+        self._remove_from_search_index(item_type, item_id)
+        return True
+    
+    def _add_attachment(self, item_type, item_id, uploaded_file):
+        with self._context():
+            model = self._model(item_type)
+            if db.session.get(model, int(item_id)) is None:
+                return False
+        
+        original_filename = secure_filename(uploaded_file.filename)
+        if not original_filename:
+            return False
+        file_ext = os.path.splitext(original_filename)[1]
+        unique_filename = f"{item_id}_{uuid.uuid4().hex[:8]}{file_ext}"
+        filepath = os.path.join(self._uploads_dir_for(item_type), unique_filename)
+        
+        # Lưu file trước, ngoài transaction
+        uploaded_file.save(filepath)
+        
+        with self._context():
+            row = db.session.get(model, int(item_id))
+            if row is None:
+                # item đã bị xóa trong lúc upload
+                if os.path.exists(filepath):
+                    os.remove(filepath)
+                return False
+            now = datetime.utcnow()
+            db.session.add(AttachmentModel(
+                filename=unique_filename,
+                original_filename=original_filename,
+                file_type=item_type,
+                note_id=row.id if item_type == 'note' else None,
+                document_id=row.id if item_type == 'doc' else None,
+                uploaded_at=now
+            ))
+            row.updated_at = now
+            db.session.commit()
+        return True
+    
+    def _delete_attachment(self, item_type, item_id, attachment_filename):
+        with self._context():
+            row = db.session.get(self._model(item_type), int(item_id))
+            if row is None:
+                return False
+            fk = self._attachment_fk(item_type)
+            attachment = AttachmentModel.query.filter(fk == row.id, AttachmentModel.filename == attachment_filename).first()
+            if attachment is None:
+                return False
+            filepath = os.path.join(self._uploads_dir_for(item_type), attachment_filename)
+            if os.path.exists(filepath):
+                try:
+                    os.remove(filepath)
+                except Exception as e:
+                    print(f"[DEBUG] ERROR khi xóa file vật lý: {e}")
+            db.session.delete(attachment)
+            row.updated_at = datetime.utcnow()
+            db.session.commit()
+        return True
+    
+    def _get_categories(self, item_type):
+        with self._context():
+            model = self._model(item_type)
+            return sorted(key or 'general' for (key,) in db.session.query(model.category_key).distinct())
+    
+    def get_category_stats(self):
+        """Thống kê notes theo category bằng GROUP BY: {category: {'count', 'recent_date', 'recent_note'}}"""
+        with self._context():
+            rows = db.session.query(NoteModel.category_key, func.count(NoteModel.id), func.max(NoteModel.updated_at)) \
+                .group_by(NoteModel.category_key).all()
+            result = {}
+            for category, count, recent_date in rows:
+                latest = db.session.query(NoteModel.id, NoteModel.title) \
+                    .filter(NoteModel.category_key == category, NoteModel.updated_at == recent_date).first()
+                result[category or 'general'] = {
+                    'count': count,
+                    'recent_date': recent_date,
+                    'recent_note': {'id': latest.id, 'title': latest.title} if latest else None
+                }
+            return result
+    
+    def get_item_counts(self):
+        """Đếm số notes và docs"""
+        with self._context():
+            return {
+                'notes': db.session.query(func.count(NoteModel.id)).scalar(),
+                'docs': db.session.query(func.count(DocumentModel.id)).scalar()
+            }
+    
+    # === NOTES METHODS ===
+    def create_note(self, title, content, category='general', user_id=None, update_search_index=True):
+        """Tạo note mới (update_search_index=False: caller tự index sau, vd. qua job nền)"""
+        return self._create('note', title, content, category, user_id, update_search_index)
+    
+    def get_note(self, note_id):
+        """Lấy note theo ID"""
+        return self._get_one('note', note_id)
+    
+    def get_all_notes(self, category=None, search_query=None, sort='updated_at', limit=None, offset=0):
+        """Lấy notes (có thể filter, sắp xếp và phân trang), nội dung được đọc lười"""
+        return self._get_all('note', category, search_query, sort, limit, offset)
+    
+    def get_note_summaries(self, category=None, limit=None):
+        """Lấy thông tin tóm tắt của notes (không đọc cột content), sắp xếp theo updated_at giảm dần"""
+        with self._context():
+            q = db.session.query(NoteModel.id, NoteModel.title, NoteModel.category_key, NoteModel.user_id,
+                                 NoteModel.view_count, NoteModel.created_at, NoteModel.updated_at,
+                                 NoteModel.updated_by)
+            if category and category != 'all':
+                q = q.filter(NoteModel.category_key == category)
+            q = q.order_by(NoteModel.updated_at.desc())
+            if limit is not None:
+                q = q.limit(limit)
+            return [{
+                'id': row.id,
+                'title': row.title,
+                'category': row.category_key or 'general',
+                'user_id': row.user_id,
+                'view_count': row.view_count or 0,
+                'created_at': row.created_at,
+                'updated_at': row.updated_at or row.created_at,
+                'updated_by': row.updated_by
+            } for row in q]
+    
+    def increment_note_view_count(self, note_id):
+        """Tăng số lần xem của note bằng một câu UPDATE (không đổi updated_at)"""
+        with self._context():
+            updated = NoteModel.query.filter(NoteModel.id == int(note_id)).update(
+                {NoteModel.view_count: NoteModel.view_count + 1, NoteModel.updated_at: NoteModel.updated_at},
+                synchronize_session=False
+            )
+            db.session.commit()
+            return updated > 0
+    
+    def compact_view_counts(self):
+        """Database cập nhật view_count trực tiếp nên không có journal cần gộp"""
+        return 0
+    
+    def update_note(self, note_id, title=None, content=None, category=None, user_id=None):
+        """Cập nhật note"""
+        return self._update('note', note_id, title, content, category, user_id)
+    
+    def delete_note(self, note_id):
+        """Xóa note"""
+        return self._delete('note', note_id)
+    
+    def add_note_attachment(self, note_id, uploaded_file):
+        """Thêm file đính kèm vào note"""
+        return self._add_attachment('note', note_id, uploaded_file)
+    
+    def delete_note_attachment(self, note_id, attachment_filename):
+        """Xóa file đính kèm từ note"""
+        return self._delete_attachment('note', note_id, attachment_filename)
+    
+    def get_note_categories(self):
+        """Lấy danh sách categories của notes"""
+        return self._get_categories('note')
+    
+    # === DOCUMENTS METHODS ===
+    def create_doc(self, title, content, category='general', user_id=None, update_search_index=True):
+        """Tạo document mới (update_search_index=False: caller tự index sau, vd. qua job nền)"""
+        return self._create('doc', title, content, category, user_id, update_search_index)
+    
+    def get_doc(self, doc_id):
+        """Lấy document theo ID"""
+        return self._get_one('doc', doc_id)
+    
+    def get_all_docs(self, category=None, search_query=None, sort='updated_at', limit=None, offset=0):
+        """Lấy documents (có thể filter, sắp xếp và phân trang), nội dung được đọc lười"""
+        return self._get_all('doc', category, search_query, sort, limit, offset)
+    
+    def update_doc(self, doc_id, title=None, content=None, category=None):
+        """Cập nhật document"""
+        return self._update('doc', doc_id, title, content, category)
+    
+    def delete_doc(self, doc_id):
+        """Xóa document"""
+        return self._delete('doc', doc_id)
+    
+    def add_doc_attachment(self, doc_id, uploaded_file):
+        """Thêm file đính kèm vào document"""
+        return self._add_attachment('doc', doc_id, uploaded_file)
+    
+    def delete_doc_attachment(self, doc_id, attachment_filename):
+        """Xóa file đính kèm từ document"""
+        return self._delete_attachment('doc', doc_id, attachment_filename)
+    
+    def get_doc_categories(self):
+        """Lấy danh sách categories của documents"""
+        return self._get_categories('doc')
+
+
+class DatabaseUserStorage(_DatabaseStorageBase):
+    """Users trong bảng users, trả về cùng dict/User như CSVUserStorage"""
+    
+    # Chuyển dict -> csv_storage.User giống hệt CSVUserStorage (Flask-Login dùng class này)
+    _dict_to_user = CSVUserStorage._dict_to_user
+    
+    @staticmethod
+    def _row_to_dict(row):
+        return {
+            'id': row.id,
+            'username': row.username,
+            'email': row.email or '',
+            'password_hash': row.password_hash,
+            'role': row.role,
+            'created_at': row.created_at.isoformat() if row.created_at else datetime.utcnow().isoformat(),
+            'is_active': bool(row.is_active),
+            'avatar': row.avatar or ''
+        }
+    
+    def get_next_id(self):
+        """Lấy ID tiếp theo"""
+        with self._context():
+            return (db.session.query(func.max(UserModel.id)).scalar() or 0) + 1
+    
+    def get_all_users(self):
+        """Lấy tất cả users (dạng dict như CSVUserStorage)"""
+        with self._context():
+            return [self._row_to_dict(row) for row in UserModel.query.order_by(UserModel.id)]
+    
+    def get_user_by_id(self, user_id):
+        """Lấy user theo ID"""
+        with self._context():
+            row = db.session.get(UserModel, int(user_id))
+            return self._dict_to_user(self._row_to_dict(row)) if row else None
+    
+    def get_users_by_ids(self, user_ids):
+        """Lấy nhiều user trong một query: {user_id: User}"""
+        wanted = {int(user_id) for user_id in user_ids}
+        if not wanted:
+            return {}
+        with self._context():
+            return {
+                row.id: self._dict_to_user(self._row_to_dict(row))
+                for row in UserModel.query.filter(UserModel.id.in_(wanted))
+            }
+    
+    def get_user_by_username(self, username):
+        """Lấy user theo username (case-insensitive)"""
+        with self._context():
+            row = UserModel.query.filter(func.lower(UserModel.username) == username.lower()).first()
+            return self._dict_to_user(self._row_to_dict(row)) if row else None
+    
+    def _email_taken(self, email, exclude_id=None):
+        q = UserModel.query.filter(func.lower(UserModel.email) == email.lower())
+        if exclude_id is not None:
+            q = q.filter(UserModel.id != exclude_id)
+        return db.session.query(q.exists()).scalar()
+    
+    def create_user(self, username, password, email=None, role='user'):
+        """Tạo user mới"""
+        with self._context():
+            if self.get_user_by_username(username):
+                return None
+            if email and self._email_taken(email):
+                return None
+            row = UserModel(
+                username=username,
+                email=email or None,
+                password_hash=generate_password_hash(password),
+                role=role,
+                is_active=True,
+                avatar='',
+                created_at=datetime.utcnow()
+            )
+            db.session.add(row)
+            db.session.commit()
+            return self.get_user_by_id(row.id)
+    
+    def update_user(self, user_id, username=None, email=None, role=None, password=None, is_active=None, avatar=None):
+        """Cập nhật user"""
+        with self._context():
+            row = db.session.get(UserModel, int(user_id))
+            if row is None:
+                return False
+            updated = False
+            
+            if username is not None:
+                existing = self.get_user_by_username(username)
+                if existing and existing.id != row.id:
+                    return False
+                row.username = username
+                updated = True
+            
+            if email is not None:
+                if email and self._email_taken(email, exclude_id=row.id):
+                    return False
+                row.email = email or None
+                updated = True
+            
+            if role is not None:
+                row.role = role
+                updated = True
+            
+            if password is not None:
+                row.password_hash = generate_password_hash(password)
+                updated = True
+            
+            if is_active is not None:
+                row.is_active = is_active
+                updated = True
+            
+            if avatar is not None:
+                row.avatar = avatar
+                updated = True
+            
+            if updated:
+                db.session.commit()
+            return updated
+    
+    def delete_user(self, user_id):
+        """Xóa user"""
+        with self._context():
+            UserModel.query.filter(UserModel.id == int(user_id)).delete(synchronize_session=False)
+            db.session.commit()
+        return True
+
+
+class DatabaseChatStorage(_DatabaseStorageBase, ChatStorage):
+    """Tin nhắn chat trong bảng chat_messages (quota/storage info dùng lại từ ChatStorage)"""
+    
+    def __init__(self, app, data_dir='data'):
+        _DatabaseStorageBase.__init__(self, app)
+        self.data_dir = data_dir
+        self.chat_uploads_dir = os.path.join(data_dir, 'uploads', 'chat')
+        os.makedirs(self.chat_uploads_dir, exist_ok=True)
+        
+        with self._context():
+            # Dòng bộ đếm phiên bản (worker khác có thể vừa tạo cùng lúc)
+            if db.session.get(ChatVersionModel, 1) is None:
+                try:
+                    db.session.add(ChatVersionModel(id=1, version=0))
+                    db.session.commit()
+                except IntegrityError:
+                    db.session.rollback()
+            # Tin nhắn tạo trước khi có cột attachment_size: đo kích thước 1 lần
+            self._update_attachment_sizes(ChatMessageModel.query.filter(
+                ChatMessageModel.attachment_filename.isnot(None), ChatMessageModel.attachment_size.is_(None)))
+    
+    @staticmethod
+    def _row_to_dict(row, group_reads=None):
+        """Row -> dict; read_by của tin group gộp thêm các user có watermark >= ID tin (group_reads)"""
+        read_by = json.loads(row.read_by) if row.read_by else []
+        if row.receiver_id == 0 and group_reads:
+            watermarks, user_ids = group_reads
+            existing = set(read_by)
+            read_by.extend(user_id for user_id in user_ids[bisect.bisect_left(watermarks, row.id):]
+                           if user_id not in existing)
+        return {
+            'id': row.id,
+            'sender_id': row.sender_id,
+            'receiver_id': row.receiver_id,
+            'message': row.message,
+            'attachment_filename': row.attachment_filename,
+            'attachment_original_name': row.attachment_original_name,
+            'attachment_size': row.attachment_size,
+            'is_read': bool(row.is_read),
+            'read_by': read_by,
+            'created_at': row.created_at.isoformat()
+        }
+    
+    @staticmethod
+    def _group_reads():
+        """Watermark đã xem group sắp xếp tăng dần: ([watermark], [user_id]), đọc một lần cho mỗi lượt đọc"""
+        readers = db.session.query(GroupChatReadModel.last_read_id, GroupChatReadModel.user_id) \
+            .order_by(GroupChatReadModel.last_read_id).all()
+        return [last_read_id for last_read_id, _ in readers], [user_id for _, user_id in readers]
+    
+    def _remove_attachment_file(self, row):
+        if row.attachment_filename:
+            file_path = os.path.join(self.chat_uploads_dir, row.attachment_filename)
+            if os.path.exists(file_path):
+                try:
+                    os.remove(file_path)
+                except:
+                    pass
+    
+    @staticmethod
+    def _bump_version():
+        """Tăng bộ đếm phiên bản chat (gọi trước commit của mỗi lần ghi, cùng transaction)"""
+        ChatVersionModel.query.filter(ChatVersionModel.id == 1).update(
+            {ChatVersionModel.version: ChatVersionModel.version + 1}, synchronize_session=False)
+    
+    def _delete_rows(self, q):
+        """Xóa các tin nhắn theo query (kèm file đính kèm), trả về số tin đã xóa"""
+        deleted_count = 0
+        for row in q:
+            self._remove_attachment_file(row)
+            db.session.delete(row)
+            deleted_count += 1
+        if deleted_count:
+            self._bump_version()
+        db.session.commit()
+        return deleted_count
+    
+    def _load_messages(self):
+        """Tất cả tin nhắn dạng dict (tương thích ChatStorage)"""
+        with self._context():
+            return [self._row_to_dict(row) for row in ChatMessageModel.query.order_by(ChatMessageModel.id)]
+    
+    def _cleanup_old_messages(self):
+        """Xóa tin nhắn cũ hơn MESSAGE_RETENTION_HOURS giờ (chạy từ scheduler)
+        
+        Xóa hàng loạt bằng một câu DELETE theo created_at, file đính kèm thì xóa nguyên thư mục giờ đã hết hạn.
+        """
+        cutoff_time = datetime.utcnow() - timedelta(hours=self.MESSAGE_RETENTION_HOURS)
+        cutoff_partition = cutoff_time.strftime(self.SEGMENT_FORMAT)
+        with self._context():
+            expired = ChatMessageModel.query.filter(ChatMessageModel.created_at < cutoff_time)
+            # File đính kèm kiểu cũ nằm thẳng trong uploads/chat/: xóa từng file
+            for row in expired.filter(ChatMessageModel.attachment_filename.isnot(None),
+                                      ~ChatMessageModel.attachment_filename.contains('/')):
+                self._remove_attachment_file(row)
+            deleted_count = expired.delete(synchronize_session=False)
+            if deleted_count:
+                self._bump_version()
+            db.session.commit()
+        
+        for entry in os.scandir(self.chat_uploads_dir):
+            if entry.is_dir() and entry.name < cutoff_partition:
+                shutil.rmtree(entry.path, ignore_errors=True)
+        if deleted_count > 0:
+            print(f"✓ Đã tự động xóa {deleted_count} tin nhắn cũ hơn {self.MESSAGE_RETENTION_HOURS} giờ")
+        return deleted_count
+    
+    def get_next_id(self):
+        """Lấy ID tiếp theo"""
+        with self._context():
+            return (db.session.query(func.max(ChatMessageModel.id)).scalar() or 0) + 1
+    
+    def send_message(self, sender_id, receiver_id, message=None, attachment_file=None):
+        """Gửi tin nhắn (1-1 chat)"""
+        with self._context():
+            row = ChatMessageModel(
+                sender_id=sender_id,
+                receiver_id=receiver_id,
+                message=message,
+                is_read=False,
+                read_by='[]',
+                created_at=datetime.utcnow()
+            )
+            db.session.add(row)
+            db.session.flush()
+            
+            if attachment_file:
+                # File đính kèm vào thư mục theo giờ tạo (UTC) để retention xóa cả thư mục
+                original_name = secure_filename(attachment_file.filename)
+                file_ext = os.path.splitext(original_name)[1]
+                partition = row.created_at.strftime(self.SEGMENT_FORMAT)
+                os.makedirs(os.path.join(self.chat_uploads_dir, partition), exist_ok=True)
+                row.attachment_filename = f"{partition}/chat_{row.id}_{datetime.now().strftime('%Y%m%d%H%M%S')}{file_ext}"
+                row.attachment_original_name = original_name
+                file_path = os.path.join(self.chat_uploads_dir, row.attachment_filename)
+                attachment_file.save(file_path)
+                row.attachment_size = os.path.getsize(file_path)
+            
+            self._bump_version()
+            db.session.commit()
+            return self._row_to_dict(row)
+    
+    def get_all_messages(self, limit=None, offset=0):
+        """Lấy tin nhắn group chat (receiver_id = 0), cũ -> mới
+        
+        Args:
+            limit: Số lượng tin nhắn tối đa (None = không giới hạn)
+            offset: Bỏ qua bao nhiêu tin nhắn từ cuối (dùng cho pagination)
+        """
+        with self._context():
+            q = ChatMessageModel.query.filter(ChatMessageModel.receiver_id == 0)
+            if limit is None:
+                rows = q.order_by(ChatMessageModel.created_at, ChatMessageModel.id).all()
+            else:
+                rows = q.order_by(ChatMessageModel.created_at.desc(), ChatMessageModel.id.desc()) \
+                    .offset(offset).limit(limit).all()
+                rows.reverse()
+            group_reads = self._group_reads()
+            return [self._row_to_dict(row, group_reads) for row in rows]
+    
+    def get_group_messages_since(self, since_id, limit=None):
+        """Lấy tin nhắn group chat có ID lớn hơn since_id (cũ -> mới)"""
+        with self._context():
+            q = ChatMessageModel.query.filter(ChatMessageModel.receiver_id == 0, ChatMessageModel.id > since_id) \
+                .order_by(ChatMessageModel.id)
+            if limit is not None:
+                q = q.limit(limit)
+            group_reads = self._group_reads()
+            return [self._row_to_dict(row, group_reads) for row in q]
+    
+    def count_group_messages(self):
+        """Đếm số tin nhắn group chat"""
+        with self._context():
+            return ChatMessageModel.query.filter(ChatMessageModel.receiver_id == 0).count()
+    
+    def get_version(self):
+        """Phiên bản hiện tại của chat, dùng làm ETag/long-poll
+        
+        Đọc bộ đếm chat_version (một dòng) mà mọi lần ghi chat tăng trong cùng transaction,
+        thay vì COUNT/SUM trên chat_messages và group_chat_reads mỗi lần kiểm tra.
+        """
+        with self._context():
+            version = db.session.query(ChatVersionModel.version).filter(ChatVersionModel.id == 1).scalar()
+            return str(version or 0)
+    
+    def clear_all_group_messages(self):
+        """Xóa toàn bộ lịch sử chat tổng (receiver_id = 0)"""
+        with self._context():
+            deleted_count = self._delete_rows(ChatMessageModel.query.filter(ChatMessageModel.receiver_id == 0))
+        print(f"✓ Cleared {deleted_count} group chat messages")
+        return deleted_count
+    
+    def clear_conversation(self, sender_id, receiver_id):
+        """Xóa các tin nhắn sender_id đã gửi cho receiver_id"""
+        with self._context():
+            return self._delete_rows(ChatMessageModel.query.filter(
+                ChatMessageModel.sender_id == sender_id, ChatMessageModel.receiver_id == receiver_id))
+    
+    @staticmethod
+    def _conversation_filter(user1_id, user2_id):
+        return or_(
+            and_(ChatMessageModel.sender_id == user1_id, ChatMessageModel.receiver_id == user2_id),
+            and_(ChatMessageModel.sender_id == user2_id, ChatMessageModel.receiver_id == user1_id)
+        )
+    
+    def get_conversation(self, user1_id, user2_id, limit=500):
+        """Lấy cuộc hội thoại giữa 2 users"""
+        with self._context():
+            rows = ChatMessageModel.query.filter(self._conversation_filter(user1_id, user2_id)) \
+                .order_by(ChatMessageModel.created_at.desc(), ChatMessageModel.id.desc()).limit(limit).all()
+            rows.reverse()
+            return [self._row_to_dict(row) for row in rows]
+    
+    def get_user_conversations(self, user_id):
+        """Lấy danh sách người đã chat với user"""
+        with self._context():
+            partners = {other for (other,) in db.session.query(ChatMessageModel.receiver_id)
+                        .filter(ChatMessageModel.sender_id == user_id).distinct()}
+            partners.update(other for (other,) in db.session.query(ChatMessageModel.sender_id)
+                            .filter(ChatMessageModel.receiver_id == user_id).distinct())
+            
+            conversations = []
+            for other_user_id in partners:
+                last_row = ChatMessageModel.query.filter(self._conversation_filter(user_id, other_user_id)) \
+                    .order_by(ChatMessageModel.created_at.desc(), ChatMessageModel.id.desc()).first()
+                if last_row is None:
+                    continue
+                unread_count = ChatMessageModel.query.filter(
+                    ChatMessageModel.sender_id == other_user_id,
+                    ChatMessageModel.receiver_id == user_id,
+                    ChatMessageModel.is_read.is_(False)
+                ).count()
+                conversations.append({
+                    'user_id': other_user_id,
+                    'last_message': self._row_to_dict(last_row),
+                    'unread_count': unread_count
+                })
+        
+        conversations.sort(key=lambda x: x['last_message']['created_at'], reverse=True)
+        return conversations
+    
+    def mark_as_read(self, user_id, other_user_id):
+        """Đánh dấu tất cả tin nhắn từ other_user là đã đọc"""
+        with self._context():
+            updated = ChatMessageModel.query.filter(
+                ChatMessageModel.sender_id == other_user_id,
+                ChatMessageModel.receiver_id == user_id,
+                ChatMessageModel.is_read.is_(False)
+            ).update({ChatMessageModel.is_read: True}, synchronize_session=False)
+            if updated:
+                self._bump_version()
+            db.session.commit()
+    
+    def get_group_read_id(self, user_id):
+        """ID tin nhắn group cuối cùng user đã xem (0 = chưa xem tin nào)"""
+        with self._context():
+            row = db.session.get(GroupChatReadModel, int(user_id))
+            return row.last_read_id if row else 0
+    
+    def mark_group_read(self, user_id, up_to_id):
+        """Đánh dấu user đã xem mọi tin nhắn group có ID <= up_to_id (chỉ ghi khi watermark tăng)"""
+        with self._context():
+            max_id = db.session.query(func.max(ChatMessageModel.id)).scalar() or 0
+            up_to_id = min(int(up_to_id), max_id)
+            row = db.session.get(GroupChatReadModel, int(user_id))
+            if row is None:
+                if up_to_id <= 0:
+                    return False
+                db.session.add(GroupChatReadModel(user_id=int(user_id), last_read_id=up_to_id))
+            else:
+                updated = GroupChatReadModel.query.filter(
+                    GroupChatReadModel.user_id == int(user_id),
+                    GroupChatReadModel.last_read_id < up_to_id
+                ).update({GroupChatReadModel.last_read_id: up_to_id}, synchronize_session=False)
+                if not updated:
+                    db.session.rollback()
+                    return False
+            self._bump_version()
+            db.session.commit()
+            return True
+    
+    def mark_message_as_read_by_user(self, message_id, user_id):
+        """Đánh dấu user đã xem tin nhắn (cho group chat) - nâng watermark tới tin này"""
+        with self._context():
+            row = db.session.get(ChatMessageModel, int(message_id))
+            if row is None or row.receiver_id != 0:
+                return False
+        return self.mark_group_read(user_id, message_id)
+    
+    def get_unread_count(self, user_id):
+        """Đếm số tin nhắn chưa đọc của user"""
+        with self._context():
+            return ChatMessageModel.query.filter(
+                ChatMessageModel.receiver_id == user_id,
+                ChatMessageModel.is_read.is_(False)
+            ).count()
+    
+    def delete_message(self, message_id, user_id):
+        """Xóa tin nhắn (chỉ người gửi mới xóa được)"""
+        with self._context():
+            self._delete_rows(ChatMessageModel.query.filter(
+                ChatMessageModel.id == int(message_id), ChatMessageModel.sender_id == user_id))
+        return True
+    
+    def _user_attachment_rows(self, user_id):
+        return ChatMessageModel.query.filter(
+            or_(ChatMessageModel.sender_id == user_id, ChatMessageModel.receiver_id == user_id),
+            ChatMessageModel.attachment_filename.isnot(None)
+        )
+    
+    def get_user_storage_usage(self, user_id):
+        """Tổng dung lượng file chat của user gửi hoặc nhận (bytes), cộng từ cột attachment_size - không stat file"""
+        with self._context():
+            return int(self._user_attachment_rows(user_id).with_entities(
+                func.coalesce(func.sum(ChatMessageModel.attachment_size), 0)).scalar())
+    
+    def _update_attachment_sizes(self, q):
+        """Đo lại kích thước file của các tin nhắn trong query, trả về số dòng đã sửa"""
+        updated = 0
+        for row in q:
+            file_path = os.path.join(self.chat_uploads_dir, row.attachment_filename)
+            size = os.path.getsize(file_path) if os.path.exists(file_path) else None
+            if row.attachment_size != size:
+                row.attachment_size = size
+                updated += 1
+        if updated:
+            self._bump_version()
+            db.session.commit()
+        return updated
+    
+    def reconcile_storage_usage(self):
+        """Đối chiếu attachment_size với file thật trên đĩa (chạy định kỳ từ scheduler)"""
+        with self._context():
+            return self._update_attachment_sizes(
+                ChatMessageModel.query.filter(ChatMessageModel.attachment_filename.isnot(None)))
+    
+    def get_user_files_list(self, user_id):
+        """Lấy danh sách file của user để quản lý (kích thước lấy từ attachment_size)"""
+        files = []
+        with self._context():
+            for row in self._user_attachment_rows(user_id):
+                file_size = row.attachment_size
+                if file_size is not None:
+                    files.append({
+                        'message_id': row.id,
+                        'filename': row.attachment_filename,
+                        'original_name': row.attachment_original_name or row.attachment_filename,
+                        'size_bytes': file_size,
+                        'size_mb': round(file_size / (1024 * 1024), 2),
+                        'created_at': row.created_at.isoformat(),
+                        'sender_id': row.sender_id,
+                        'receiver_id': row.receiver_id,
+                        'is_sender': row.sender_id == user_id
+                    })
+        files.sort(key=lambda x: x['size_bytes'], reverse=True)
+        return files
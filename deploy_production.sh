@@ -63,7 +63,7 @@ echo "✓ Deployment preparation completed!"
 echo "=========================================="
 echo ""
 echo "To run with Gunicorn:"
-echo "  gunicorn --bind 0.0.0.0:5001 --workers 4 --timeout 120 wsgi:application"
+echo "  gunicorn --bind 0.0.0.0:5001 --workers 4 --worker-class gthread --threads 64 --timeout 120 wsgi:application"
 echo ""
 echo "Or use the run_production.sh script:"
 echo "  ./run_production.sh"
@@ -0,0 +1,378 @@
+"""
+Edit Log Storage - Lưu lịch sử chỉnh sửa bằng log append-only (JSON Lines), chia segment theo ngày
+Ghi log mới chỉ append 1 dòng; retention xóa nguyên segment; trang admin chỉ đọc phần cuối segment mới nhất.
+"""
+import os
+import re
+import json
+import zlib
+import base64
+import struct
+import difflib
+import tempfile
+import threading
+from datetime import datetime, timedelta, timezone
+from file_lock import locked_file
+
+
+# === DELTA NỘI DUNG ===
+# changes['content'] của log sửa note/doc chỉ lưu phần thay đổi thay vì toàn bộ nội dung cũ/mới:
+#   {'format': 'delta', 'ops': [[offset trong nội dung cũ, đoạn cũ, đoạn mới], ...], 'old_crc', 'new_crc'}
+#   hoặc 'format': 'delta+zlib' với 'data' = base64(zlib(JSON ops)) khi ops lớn hơn DELTA_COMPRESS_BYTES.
+# Mỗi op lưu cả đoạn cũ lẫn đoạn mới nên áp được theo 2 chiều: từ nội dung hiện tại lùi dần về bất kỳ
+# phiên bản nào. old_crc/new_crc (crc32) phát hiện chuỗi log bị đứt (nội dung bị sửa mà không có log).
+# Log cũ dạng {'old': ..., 'new': ...} toàn văn vẫn đọc được.
+DELTA_COMPRESS_BYTES = 1024
+_TOKEN_RE = re.compile(r'(?<=[>\n])')  # Nội dung HTML thường nằm trên 1 dòng: diff theo thẻ/dòng
+
+
+def _crc(text):
+    return zlib.crc32(text.encode('utf-8'))
+
+
+def make_content_delta(old, new):
+    """Delta giữa 2 phiên bản nội dung (chỉ chứa các đoạn thay đổi)"""
+    old, new = old or '', new or ''
+    a = [token for token in _TOKEN_RE.split(old) if token]
+    b = [token for token in _TOKEN_RE.split(new) if token]
+    ops = []
+    offset = 0  # Vị trí ký tự trong nội dung cũ ứng với token a[i]
+    position = 0
+    for tag, i1, i2, j1, j2 in difflib.SequenceMatcher(None, a, b).get_opcodes():
+        offset += sum(len(token) for token in a[position:i1])
+        old_part = ''.join(a[i1:i2])
+        if tag != 'equal':
+            ops.append([offset, old_part, ''.join(b[j1:j2])])
+        offset += len(old_part)
+        position = i2
+    
+    delta = {'format': 'delta', 'ops': ops, 'old_crc': _crc(old), 'new_crc': _crc(new)}
+    encoded = json.dumps(ops, ensure_ascii=False).encode('utf-8')
+    if len(encoded) > DELTA_COMPRESS_BYTES:
+        compressed = zlib.compress(encoded, 9)
+        if len(compressed) < len(encoded):
+            delta = {'format': 'delta+zlib', 'data': base64.b64encode(compressed).decode('ascii'),
+                     'old_crc': delta['old_crc'], 'new_crc': delta['new_crc']}
+    return delta
+
+
+def is_content_delta(value):
+    return isinstance(value, dict) and value.get('format') in ('delta', 'delta+zlib')
+
+
+def content_delta_ops(delta):
+    """Danh sách op [offset, đoạn cũ, đoạn mới] của delta"""
+    if delta['format'] == 'delta+zlib':
+        return json.loads(zlib.decompress(base64.b64decode(delta['data'])).decode('utf-8'))
+    return delta['ops']
+
+
+def apply_content_delta(content, delta, reverse=False):
+    """Áp delta lên nội dung: cũ -> mới, hoặc mới -> cũ nếu reverse=True
+    
+    Raises:
+        ValueError: content không phải phiên bản delta được tạo từ (chuỗi log bị đứt)
+    """
+    if _crc(content) != delta['new_crc' if reverse else 'old_crc']:
+        raise ValueError('Nội dung không khớp với phiên bản trong edit log')
+    parts = []
+    position = 0
+    shift = 0  # Chênh lệch vị trí giữa nội dung mới và cũ sau các op đã áp
+    for offset, old_part, new_part in content_delta_ops(delta):
+        source, target = (new_part, old_part) if reverse else (old_part, new_part)
+        start = offset + shift if reverse else offset
+        parts.append(content[position:start])
+        parts.append(target)
+        position = start + len(source)
+        shift += len(new_part) - len(old_part)
+    parts.append(content[position:])
+    return ''.join(parts)
+
+
+class EditLogStorage:
+    SEGMENT_FORMAT = '%Y%m%d'  # Mỗi ngày (UTC, theo created_at) một segment: edit_logs/YYYYMMDD.jsonl
+    # Index thời gian đi kèm mỗi segment (YYYYMMDD.idx): mỗi log một record cố định (id, offset byte
+    # của dòng trong .jsonl, created_at dạng epoch) -> đọc N log cuối hoặc tìm theo thời gian không cần
+    # parse cả segment. Index chỉ để tăng tốc: dòng nào chưa kịp có record index vẫn được đọc tới cuối file.
+    INDEX_RECORD = struct.Struct('<QQd')
+    
+    def __init__(self, data_dir='data'):
+        self.data_dir = data_dir
+        self.legacy_file = os.path.join(data_dir, 'edit_logs.json')  # Định dạng cũ, chỉ dùng để migrate
+        self.log_dir = os.path.join(data_dir, 'edit_logs')
+        self.seq_file = os.path.join(self.log_dir, 'last_id')
+        self.lock_file = os.path.join(self.log_dir, '.lock')
+        self._lock = threading.Lock()
+        
+        os.makedirs(self.log_dir, exist_ok=True)
+        
+        # Chuyển edit_logs.json cũ sang segment (chỉ chạy 1 lần)
+        if os.path.exists(self.legacy_file):
+            with self._lock, locked_file(self.lock_file):
+                if os.path.exists(self.legacy_file):
+                    self._migrate_legacy_file()
+    
+    # === SEGMENT ===
+    @staticmethod
+    def _parse_time(value):
+        """created_at (ISO string, có hoặc không timezone) -> datetime UTC naive, None nếu không đọc được"""
+        if isinstance(value, str):
+            try:
+                value = datetime.fromisoformat(value.replace('Z', '+00:00'))
+            except ValueError:
+                return None
+        if not isinstance(value, datetime):
+            return None
+        if value.tzinfo is not None:
+            value = value.astimezone(timezone.utc).replace(tzinfo=None)
+        return value
+    
+    def _segment_for(self, log):
+        created_at = self._parse_time(log.get('created_at')) or datetime.utcnow()
+        return created_at.strftime(self.SEGMENT_FORMAT)
+    
+    def _segment_names(self):
+        """Tên các segment, cũ -> mới"""
+        try:
+            return sorted(name[:-6] for name in os.listdir(self.log_dir) if name.endswith('.jsonl'))
+        except OSError:
+            return []
+    
+    def _paths(self, segment):
+        base = os.path.join(self.log_dir, segment)
+        return base + '.jsonl', base + '.idx'
+    
+    def _index_count(self, segment):
+        """Số log trong segment theo index (O(1), không đọc file)"""
+        try:
+            return os.path.getsize(self._paths(segment)[1]) // self.INDEX_RECORD.size
+        except OSError:
+            return 0
+    
+    def _read_index(self, segment, start=0):
+        """Các record index (id, offset, timestamp) từ vị trí start tới cuối"""
+        try:
+            with open(self._paths(segment)[1], 'rb') as f:
+                f.seek(start * self.INDEX_RECORD.size)
+                data = f.read()
+        except OSError:
+            return []
+        usable = len(data) - len(data) % self.INDEX_RECORD.size
+        return list(self.INDEX_RECORD.iter_unpack(data[:usable]))
+    
+    def _read_segment(self, segment, offset=0, limit=None):
+        """Parse các log trong segment bắt đầu từ byte offset (tối đa limit log; bỏ qua dòng hỏng/đang ghi dở)"""
+        logs = []
+        try:
+            with open(self._paths(segment)[0], 'rb') as f:
+                f.seek(offset)
+                for line in f:
+                    if not line.endswith(b'\n') or (limit is not None and len(logs) >= limit):
+                        break
+                    try:
+                        logs.append(json.loads(line))
+                    except:
+                        continue
+        except OSError:
+            pass
+        return logs
+    
+    def _write_logs(self, logs):
+        """Append logs vào segment theo ngày created_at, kèm record index
+        
+        Caller phải giữ self._lock và locked_file(self.lock_file).
+        """
+        segments = {}
+        for log in logs:
+            segments.setdefault(self._segment_for(log), []).append(log)
+        
+        for segment, segment_logs in segments.items():
+            log_path, index_path = self._paths(segment)
+            fd = os.open(log_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                offset = os.fstat(fd).st_size
+                data, index = [], []
+                for log in segment_logs:
+                    line = (json.dumps(log, ensure_ascii=False) + '\n').encode('utf-8')
+                    created_at = self._parse_time(log.get('created_at'))
+                    timestamp = created_at.replace(tzinfo=timezone.utc).timestamp() if created_at else 0.0
+                    index.append(self.INDEX_RECORD.pack(int(log.get('id') or 0), offset, timestamp))
+                    data.append(line)
+                    offset += len(line)
+                os.write(fd, b''.join(data))
+            finally:
+                os.close(fd)
+            
+            fd = os.open(index_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, b''.join(index))
+            finally:
+                os.close(fd)
+    
+    def _read_seq(self):
+        """ID log lớn nhất đã cấp (file last_id hỏng/rỗng/mất: tính lại từ các segment)"""
+        try:
+            with open(self.seq_file, 'r') as f:
+                return int(f.read().strip())
+        except:
+            return self._max_logged_id()
+    
+    def _max_logged_id(self):
+        """ID lớn nhất có trong các segment: theo record index, cộng các dòng chưa kịp có index"""
+        max_id = 0
+        for segment in self._segment_names():
+            records = self._read_index(segment)
+            if records:
+                max_id = max(max_id, max(record[0] for record in records))
+            # Các dòng từ record index cuối cùng (crash giữa lúc ghi .jsonl và .idx)
+            tail = self._read_segment(segment, records[-1][1] if records else 0)
+            max_id = max([max_id] + [int(log.get('id') or 0) for log in tail])
+        return max_id
+    
+    def _write_seq(self, last_id):
+        """Ghi last_id atomic (file tạm + os.replace) để crash giữa chừng không làm mất bộ đếm"""
+        fd, temp_file = tempfile.mkstemp(dir=self.log_dir, prefix='.last_id.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(str(last_id))
+            os.replace(temp_file, self.seq_file)
+        except:
+            try:
+                os.remove(temp_file)
+            except OSError:
+                pass
+            raise
+    
+    def _remove_segment(self, segment):
+        for path in self._paths(segment):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+    
+    def _migrate_legacy_file(self):
+        """Chuyển edit_logs.json sang các segment rồi đổi tên file cũ thành .migrated
+        
+        Caller phải giữ self._lock và locked_file(self.lock_file).
+        """
+        try:
+            with open(self.legacy_file, 'r', encoding='utf-8') as f:
+                logs = json.load(f)
+        except:
+            logs = []
+        
+        logs.sort(key=lambda log: (self._parse_time(log.get('created_at')) or datetime.min, log.get('id', 0)))
+        self._write_logs(logs)
+        if logs:
+            self._write_seq(max([self._read_seq()] + [log.get('id', 0) for log in logs]))
+        os.replace(self.legacy_file, self.legacy_file + '.migrated')
+        print(f"✓ Migrated {len(logs)} edit logs to {self.log_dir}")
+    
+    # === PUBLIC API ===
+    def append(self, log_data):
+        """Thêm một edit log (gán id tăng dần, created_at nếu chưa có)
+        
+        Returns:
+            ID của log
+        """
+        with self._lock, locked_file(self.lock_file):
+            log_id = self._read_seq() + 1
+            self._write_seq(log_id)
+            log_data['id'] = log_id
+            log_data.setdefault('created_at', datetime.utcnow().isoformat())
+            self._write_logs([log_data])
+        return log_id
+    
+    def get_recent(self, limit=100):
+        """limit log mới nhất (theo thứ tự ghi, cũ -> mới), chỉ đọc phần cuối các segment mới nhất"""
+        logs = []
+        for segment in reversed(self._segment_names()):
+            remaining = limit - len(logs)
+            if remaining <= 0:
+                break
+            count = self._index_count(segment)
+            offset = 0
+            if count > remaining:
+                offset = self._read_index(segment, count - remaining)[0][1]
+            segment_logs = self._read_segment(segment, offset)
+            logs = segment_logs[-remaining:] + logs
+        return logs
+    
+    def get_logs(self, since=None, until=None):
+        """Log có created_at trong [since, until) (datetime UTC naive), dùng index để bỏ qua phần ngoài khoảng"""
+        since_segment = since.strftime(self.SEGMENT_FORMAT) if since else None
+        until_segment = until.strftime(self.SEGMENT_FORMAT) if until else None
+        since_ts = since.replace(tzinfo=timezone.utc).timestamp() if since else None
+        
+        logs = []
+        for segment in self._segment_names():
+            if (since_segment and segment < since_segment) or (until_segment and segment > until_segment):
+                continue
+            offset = 0
+            if since_ts is not None:
+                # Trong segment created_at gần như tăng dần (chỉ lệch vài giây giữa các worker): bắt đầu
+                # đọc từ record index đầu tiên đạt mốc since, điều kiện chính xác vẫn lọc bên dưới
+                for _, record_offset, timestamp in self._read_index(segment):
+                    if timestamp >= since_ts or not timestamp:  # 0 = created_at không đọc được, luôn giữ
+                        offset = record_offset
+                        break
+                else:
+                    offset = None
+            if offset is None:
+                continue
+            for log in self._read_segment(segment, offset):
+                created_at = self._parse_time(log.get('created_at'))
+                if created_at is None or ((since is None or created_at >= since) and (until is None or created_at < until)):
+                    logs.append(log)
+        return logs
+    
+    def get_log(self, log_id):
+        """Một log theo ID: tìm trong index (mới -> cũ) rồi chỉ đọc đúng dòng đó"""
+        for segment in reversed(self._segment_names()):
+            for record_id, offset, _ in self._read_index(segment):
+                if record_id == log_id:
+                    logs = self._read_segment(segment, offset, limit=1)
+                    if logs and logs[0].get('id') == log_id:
+                        return logs[0]
+        return None
+    
+    def get_item_logs(self, item_type, item_id):
+        """Các log của một note/doc theo thứ tự ID (đọc mọi segment, chỉ dùng khi cần dựng lại phiên bản)"""
+        logs = []
+        for segment in self._segment_names():
+            logs.extend(log for log in self._read_segment(segment)
+                        if log.get('item_type') == item_type and log.get('item_id') == item_id)
+        logs.sort(key=lambda log: log.get('id', 0))
+        return logs
+    
+    def load_all(self):
+        """Toàn bộ log (dùng cho export/import, không dùng trên đường request thường)"""
+        logs = []
+        for segment in self._segment_names():
+            logs.extend(self._read_segment(segment))
+        return logs
+    
+    def replace_all(self, logs):
+        """Thay toàn bộ log bằng danh sách logs (giữ nguyên id; dùng khi import)"""
+        logs = sorted(logs, key=lambda log: (self._parse_time(log.get('created_at')) or datetime.min, log.get('id', 0)))
+        with self._lock, locked_file(self.lock_file):
+            for segment in self._segment_names():
+                self._remove_segment(segment)
+            self._write_logs(logs)
+            self._write_seq(max([self._read_seq()] + [log.get('id', 0) for log in logs]))
+    
+    def cleanup_old_logs(self, days=30):
+        """Xóa log cũ hơn days ngày: xóa nguyên các segment ngày (UTC) đã hết hạn, không đọc từng log
+        
+        Returns:
+            Số log đã xóa (đếm từ index)
+        """
+        cutoff_segment = (datetime.utcnow() - timedelta(days=days)).strftime(self.SEGMENT_FORMAT)
+        deleted = 0
+        with self._lock, locked_file(self.lock_file):
+            for segment in self._segment_names():
+                if segment >= cutoff_segment:
+                    break
+                deleted += self._index_count(segment)
+                self._remove_segment(segment)
+        return deleted
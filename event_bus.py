@@ -0,0 +1,186 @@
+"""
+Event bus giữa các process: pub/sub qua một file log append-only (JSON Lines)
+Worker nào cũng ghi sự kiện vào cùng file, mỗi kết nối realtime (SSE) đọc tiếp phần mới của file,
+nên sự kiện phát ở worker này đến được trình duyệt đang nối vào worker khác.
+
+Dòng đầu mỗi file log là '#gen <N>', N tăng mỗi lần xoay log. Event ID là "<thế hệ>-<offset>":
+thế hệ (không phải inode, inode có thể được dùng lại sau vài lần xoay) xác định file để đọc tiếp.
+"""
+import os
+import json
+import time
+import tempfile
+from file_lock import locked_file
+
+
+class EventBus:
+    MAX_LOG_BYTES = 1 * 1024 * 1024  # Xoay file log khi vượt 1MB
+    POLL_INTERVAL = 0.5  # Giây giữa 2 lần kiểm tra file log khi không có sự kiện mới
+    HEADER_PREFIX = b'#gen '
+    
+    def __init__(self, data_dir='data'):
+        self.log_file = os.path.abspath(os.path.join(data_dir, 'events.log'))
+        self.lock_file = self.log_file + '.lock'
+        os.makedirs(os.path.dirname(self.log_file), exist_ok=True)
+        
+        # Tạo file log nếu chưa có để subscriber mở được ngay
+        with locked_file(self.lock_file):
+            if not os.path.exists(self.log_file):
+                self._create_log()
+    
+    # === THẾ HỆ LOG ===
+    @classmethod
+    def _read_generation(cls, f):
+        """Thế hệ ghi trong header của file log đang mở (không đổi vị trí đọc); 0 nếu file cũ không có header"""
+        head = os.pread(f.fileno(), 64, 0)
+        line = head.split(b'\n', 1)[0]
+        if line.startswith(cls.HEADER_PREFIX) and b'\n' in head:
+            try:
+                return int(line[len(cls.HEADER_PREFIX):])
+            except ValueError:
+                pass
+        return 0
+    
+    def _generation_of(self, path):
+        """Thế hệ của file log tại path, None nếu không mở được"""
+        try:
+            with open(path, 'rb') as f:
+                return self._read_generation(f)
+        except OSError:
+            return None
+    
+    def _create_log(self, previous=0):
+        """Tạo file log mới (đã có header thế hệ > previous) thay cho file hiện tại
+        
+        Caller phải giữ locked_file(self.lock_file).
+        """
+        generation = max(time.time_ns(), previous + 1)
+        fd, temp_file = tempfile.mkstemp(dir=os.path.dirname(self.log_file), prefix='.events.', suffix='.tmp')
+        try:
+            os.write(fd, self.HEADER_PREFIX + str(generation).encode('ascii') + b'\n')
+        finally:
+            os.close(fd)
+        os.chmod(temp_file, 0o644)
+        os.replace(temp_file, self.log_file)
+    
+    def publish(self, event, data=None, user_id=None):
+        """Phát sự kiện
+        
+        Args:
+            event: Tên sự kiện (vd. 'new_message')
+            data: Dict dữ liệu kèm theo (phải serialize được sang JSON)
+            user_id: None = gửi tới mọi user, ngược lại chỉ gửi tới user này
+        """
+        record = {'event': event, 'data': data or {}, 'user_id': user_id}
+        line = (json.dumps(record, ensure_ascii=False, default=str) + '\n').encode('utf-8')
+        
+        with locked_file(self.lock_file):
+            try:
+                if os.path.getsize(self.log_file) > self.MAX_LOG_BYTES:
+                    # Đổi tên chứ không xóa: subscriber đang mở file cũ vẫn đọc được phần còn lại
+                    previous = self._generation_of(self.log_file) or 0
+                    os.replace(self.log_file, self.log_file + '.1')
+                    self._create_log(previous)
+            except OSError:
+                pass
+            if not os.path.exists(self.log_file):
+                self._create_log()
+            fd = os.open(self.log_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, line)
+            finally:
+                os.close(fd)
+    
+    def subscribe(self, last_event_id=None, timeout=None, heartbeat=15):
+        """Generator trả về (event_id, record) cho từng sự kiện mới
+        
+        Args:
+            last_event_id: ID sự kiện cuối client đã nhận (header Last-Event-ID) để nhận tiếp
+                sau khi kết nối lại; None hoặc ID thuộc thế hệ log đã xoay = bắt đầu từ cuối log
+            timeout: Số giây tối đa trước khi kết thúc (None = không giới hạn)
+            heartbeat: Sau bao nhiêu giây không có sự kiện thì trả về (None, None) để gửi keep-alive
+        """
+        deadline = time.monotonic() + timeout if timeout else None
+        last_yield = time.monotonic()
+        f = None
+        generation = None
+        offset = 0
+        buffer = b''
+        
+        try:
+            while deadline is None or time.monotonic() < deadline:
+                if f is None:
+                    if generation is not None:
+                        # Vừa đọc xong file cũ: nếu log đã xoay thêm lần nữa thì file .1 là
+                        # thế hệ ở giữa chưa đọc, đọc nó trước file log hiện tại
+                        f = self._open_if_newer(self.log_file + '.1', generation)
+                    if f is None:
+                        try:
+                            f = open(self.log_file, 'rb')
+                        except FileNotFoundError:
+                            time.sleep(self.POLL_INTERVAL)
+                            continue
+                    size = os.fstat(f.fileno()).st_size
+                    file_generation = self._read_generation(f)
+                    resume = self._parse_event_id(last_event_id)
+                    if generation is not None:
+                        # File mới sau khi xoay: đọc từ đầu
+                        offset = 0
+                    elif resume and resume[0] == file_generation and resume[1] <= size:
+                        offset = resume[1]
+                    else:
+                        offset = size
+                    generation = file_generation
+                    f.seek(offset)
+                    buffer = b''
+                
+                chunk = f.read()
+                if not chunk:
+                    if self._generation_of(self.log_file) != generation:
+                        # Log đã được xoay: đọc nốt phần cuối file cũ rồi chuyển ngay sang file mới
+                        chunk = f.read()
+                        f.close()
+                        f = None
+                        if not chunk:
+                            continue
+                    else:
+                        if heartbeat and time.monotonic() - last_yield >= heartbeat:
+                            last_yield = time.monotonic()
+                            yield None, None
+                        time.sleep(self.POLL_INTERVAL)
+                        continue
+                
+                buffer += chunk
+                # Chỉ xử lý các dòng hoàn chỉnh, dòng đang ghi dở giữ lại cho lần đọc sau
+                while b'\n' in buffer:
+                    line, buffer = buffer.split(b'\n', 1)
+                    offset += len(line) + 1
+                    try:
+                        record = json.loads(line)
+                    except:
+                        continue
+                    last_yield = time.monotonic()
+                    yield f"{generation}-{offset}", record
+        finally:
+            if f is not None:
+                f.close()
+    
+    def _open_if_newer(self, path, generation):
+        """Mở path nếu nó thuộc thế hệ mới hơn generation và không phải file log hiện tại"""
+        try:
+            f = open(path, 'rb')
+        except OSError:
+            return None
+        other_generation = self._read_generation(f)
+        if other_generation <= generation or other_generation == self._generation_of(self.log_file):
+            f.close()
+            return None
+        return f
+    
+    @staticmethod
+    def _parse_event_id(event_id):
+        try:
+            generation, offset = event_id.split('-')
+            return int(generation), int(offset)
+        except:
+            return None
@@ -0,0 +1,39 @@
+"""
+Khóa file giữa các process (advisory lock bằng fcntl)
+Dùng để các gunicorn worker không ghi đè dữ liệu của nhau khi cùng sửa một file JSON
+"""
+import os
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: không có fcntl, chỉ chạy 1 process nên bỏ qua khóa liên process
+    fcntl = None
+
+
+@contextmanager
+def locked_file(lock_path, shared=False):
+    """Giữ advisory lock trên lock_path trong suốt khối with
+
+    Args:
+        lock_path: Đường dẫn file lock (tự tạo nếu chưa có)
+        shared: True = khóa đọc (nhiều process cùng giữ được), False = khóa ghi độc quyền
+
+    Lưu ý: flock gắn với file descriptor, nên không lồng hai khối locked_file
+    trên cùng một file trong cùng process (sẽ tự chặn chính mình).
+    """
+    lock_dir = os.path.dirname(lock_path)
+    if lock_dir:
+        os.makedirs(lock_dir, exist_ok=True)
+    fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        if fcntl is not None:
+            fcntl.flock(fd, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        yield
+    finally:
+        if fcntl is not None:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+            except OSError:
+                pass
+        os.close(fd)
@@ -3,10 +3,21 @@ Module quản lý Notes và Documents bằng file text
 """
 import os
 import json
+import time
+import tempfile
+import threading
 from datetime import datetime
+from file_lock import locked_file
+from search_index import SearchIndex, normalize_text
 
 class FileStorage:
-    def __init__(self, notes_dir='data/notes', docs_dir='data/docs', metadata_file='data/metadata.json', uploads_dir='uploads'):
+    # Các thay đổi metadata đến trong khoảng này (giây) được gom lại và ghi file một lần
+    GROUP_COMMIT_WINDOW = 0.005
+    # Các kiểu sắp xếp hỗ trợ cho get_all_notes/get_all_docs (docs không có lượt xem)
+    SORT_KEYS = {'note': ('updated_at', 'view_count', 'title'), 'doc': ('updated_at', 'title')}
+    
+    def __init__(self, notes_dir='data/notes', docs_dir='data/docs', metadata_file='data/metadata.json', uploads_dir='uploads',
+                 search_index_file=None, view_journal_file=None):
         # Chuẩn hóa tất cả đường dẫn thành absolute path để đảm bảo lưu đúng vị trí
         self.notes_dir = os.path.abspath(os.path.normpath(notes_dir))
         self.docs_dir = os.path.abspath(os.path.normpath(docs_dir))
@@ -24,279 +35,826 @@ class FileStorage:
         if metadata_dir:
             os.makedirs(metadata_dir, exist_ok=True)
         
+        # Cache metadata trong bộ nhớ, chỉ parse lại khi file trên đĩa thay đổi
+        # (so sánh inode/size/mtime/ctime để các gunicorn worker dùng chung file vẫn đồng bộ)
+        self._metadata_cache = None
+        self._metadata_signature = None
+        self._metadata_lock = threading.RLock()
+        # Index id -> metadata entry cho từng loại item, build lại cùng với cache metadata
+        self._metadata_index = {'notes': {}, 'docs': {}}
+        # Danh sách ID đã sắp xếp sẵn theo (loại, kiểu sắp xếp, category), build lười khi cần
+        self._sorted_index = {}
+        
+        # Ghi metadata: khóa fcntl giữa các process + group commit giữa các thread
+        self.metadata_lock_file = self.metadata_file + '.lock'
+        self._commit_lock = threading.Lock()
+        self._pending_updates = []
+        self._commit_in_progress = False
+        
         # Khởi tạo metadata file nếu chưa tồn tại
-        if not os.path.exists(self.metadata_file):
-            self._save_metadata({'notes': [], 'docs': []})
+        with self._metadata_write_lock():
+            if not os.path.exists(self.metadata_file):
+                self._save_metadata({'notes': [], 'docs': [], 'category_stats': {}})
+        
+        # Inverted index cho tìm kiếm, mặc định nằm cạnh metadata.json
+        if search_index_file is None:
+            search_index_file = os.path.join(os.path.dirname(self.metadata_file), 'search_index.json')
+        self.search_index = SearchIndex(search_index_file)
+        
+        # Lượt xem ghi vào log append-only, được gộp vào metadata định kỳ (compact_view_counts)
+        if view_journal_file is None:
+            view_journal_file = os.path.join(os.path.dirname(self.metadata_file), 'view_counts.log')
+        self.view_journal = ViewCountJournal(view_journal_file)
+        if not self.search_index.exists():
+            self.rebuild_search_index()
     
-    def _load_metadata(self):
-        """Load metadata từ file JSON"""
+    def _metadata_file_signature(self, path=None):
+        """Lấy chữ ký (inode, size, mtime, ctime) của file metadata, None nếu không đọc được"""
         try:
-            with open(self.metadata_file, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except:
-            return {'notes': [], 'docs': []}
+            st = os.stat(path or self.metadata_file)
+        except OSError:
+            return None
+        return (st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns)
+    
+    def _invalidate_metadata_cache(self):
+        """Bỏ cache metadata, lần đọc sau sẽ parse lại từ file"""
+        with self._metadata_lock:
+            self._metadata_cache = None
+            self._metadata_signature = None
+            self._metadata_index = {'notes': {}, 'docs': {}}
+            self._sorted_index = {}
+    
+    def _set_metadata_cache(self, metadata, signature):
+        """Ghi metadata vào cache và build lại index id -> entry"""
+        self._metadata_cache = metadata
+        self._metadata_signature = signature
+        self._metadata_index = {
+            key: {int(item['id']): item for item in metadata.get(key, [])}
+            for key in ('notes', 'docs')
+        }
+        self._sorted_index = {}
+    
+    def _find_item_meta(self, item_type, item_id):
+        """Tìm metadata entry của note/doc theo ID (O(1) qua index)
+        
+        Trả về (metadata, entry); entry là None nếu không tìm thấy.
+        """
+        with self._metadata_lock:
+            metadata = self._load_metadata()
+            return metadata, self._metadata_index.get(item_type + 's', {}).get(int(item_id))
+    
+    def _load_metadata(self):
+        """Load metadata (dùng cache trong bộ nhớ, chỉ đọc lại file khi file đã thay đổi)
+        
+        Dict trả về được dùng chung giữa các lần gọi, không sửa trực tiếp:
+        mọi thay đổi phải đi qua _update_metadata().
+        """
+        with self._metadata_lock:
+            signature = self._metadata_file_signature()
+            if self._metadata_cache is not None and signature is not None and signature == self._metadata_signature:
+                return self._metadata_cache
+            
+            try:
+                with open(self.metadata_file, 'r', encoding='utf-8') as f:
+                    metadata = json.load(f)
+            except:
+                # Không cache kết quả lỗi để lần sau thử đọc lại
+                self._invalidate_metadata_cache()
+                return {'notes': [], 'docs': [], 'category_stats': {}}
+            
+            metadata.setdefault('notes', [])
+            metadata.setdefault('docs', [])
+            if 'category_stats' not in metadata:
+                # metadata cũ (hoặc vừa import) chưa có thống kê: tính một lần, lưu ở lần ghi kế tiếp
+                self._rebuild_category_stats(metadata)
+            self._set_metadata_cache(metadata, signature)
+            return metadata
+    
+    def _metadata_write_lock(self):
+        """Khóa ghi metadata: giữ lock trong process và advisory lock fcntl giữa các process"""
+        return _CombinedLock(self._metadata_lock, locked_file(self.metadata_lock_file))
     
     def _save_metadata(self, metadata):
-        """Lưu metadata vào file JSON"""
+        """Lưu metadata vào file JSON
+        
+        Caller phải đang giữ self._metadata_write_lock() (xem _update_metadata).
+        """
+        with self._metadata_lock:
+            temp_file = None
+            try:
+                # Đảm bảo thư mục tồn tại
+                metadata_dir = os.path.dirname(self.metadata_file)
+                if metadata_dir:
+                    os.makedirs(metadata_dir, exist_ok=True)
+                
+                # Ghi file với atomic write (ghi vào file tạm riêng của lần ghi này, tránh đụng worker khác)
+                fd, temp_file = tempfile.mkstemp(dir=metadata_dir or None,
+                                                 prefix=os.path.basename(self.metadata_file) + '.',
+                                                 suffix='.tmp')
+                with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                    json.dump(metadata, f, ensure_ascii=False, indent=2)
+                
+                # Thay thế file cũ bằng file mới (os.replace hoạt động trên cả Windows và Linux từ Python 3.3+)
+                # os.replace() là atomic và tương thích đa nền tảng
+                os.replace(temp_file, self.metadata_file)
+                
+                # rename đổi ctime nên phải lấy chữ ký từ file đích (vẫn đang giữ khóa ghi, không ai thay file)
+                signature = self._metadata_file_signature()
+                
+                self._set_metadata_cache(metadata, signature)
+            except Exception as e:
+                # Dict trong cache có thể đã bị sửa dở, bỏ cache để đọc lại từ file
+                self._invalidate_metadata_cache()
+                # Nếu có lỗi, xóa file tạm nếu tồn tại
+                if temp_file and os.path.exists(temp_file):
+                    try:
+                        os.remove(temp_file)
+                    except:
+                        pass
+                raise Exception(f"Không thể lưu metadata: {str(e)}")
+    
+    def _update_metadata(self, mutator):
+        """Sửa metadata an toàn giữa các worker, gom nhiều thay đổi vào một lần ghi file
+        
+        Args:
+            mutator: Hàm nhận dict metadata (mới nhất, đã khóa) và sửa trực tiếp trên đó.
+                Trả về giá trị truthy nếu có thay đổi cần lưu. Mutator chạy trong khóa
+                metadata chung nên không được ghi file nội dung/đính kèm (ghi trước khi gọi),
+                phải kiểm tra/làm các thao tác có thể lỗi trước khi sửa metadata, và có thể
+                được gọi lại khi một mutator khác trong cùng đợt bị lỗi.
+        
+        Returns:
+            Giá trị mutator trả về (exception của mutator được raise lại cho caller)
+        """
+        request = {'mutator': mutator, 'done': threading.Event(), 'result': None, 'error': None}
+        with self._commit_lock:
+            self._pending_updates.append(request)
+            is_leader = not self._commit_in_progress
+            self._commit_in_progress = True
+        
+        if is_leader:
+            # Thread leader ghi ngay đợt đầu tiên, rồi ghi tiếp các thay đổi xếp hàng trong lúc
+            # đang ghi cho tới khi không còn thay đổi nào đang chờ
+            first = True
+            while True:
+                with self._commit_lock:
+                    queued = bool(self._pending_updates)
+                if queued and not first and self.GROUP_COMMIT_WINDOW:
+                    # Đang có tranh chấp: chờ một chút để gom thêm các thay đổi đến cùng lúc
+                    time.sleep(self.GROUP_COMMIT_WINDOW)
+                first = False
+                with self._commit_lock:
+                    batch = self._pending_updates
+                    self._pending_updates = []
+                    if not batch:
+                        self._commit_in_progress = False
+                        break
+                self._commit_metadata_batch(batch)
+        
+        request['done'].wait()
+        if request['error'] is not None:
+            raise request['error']
+        return request['result']
+    
+    def _commit_metadata_batch(self, batch):
+        """Áp dụng một đợt thay đổi lên metadata mới nhất và ghi file đúng một lần
+        
+        Mutator bị lỗi có thể đã sửa dở dict metadata dùng chung: bỏ cache, đọc lại file
+        và chạy lại các mutator còn lại của đợt (vẫn trong khóa) để không lưu thay đổi dở.
+        """
         try:
-            # Đảm bảo thư mục tồn tại
-            metadata_dir = os.path.dirname(self.metadata_file)
-            if metadata_dir:
-                os.makedirs(metadata_dir, exist_ok=True)
-            
-            # Ghi file với atomic write (ghi vào file tạm trước)
-            temp_file = self.metadata_file + '.tmp'
-            with open(temp_file, 'w', encoding='utf-8') as f:
-                json.dump(metadata, f, ensure_ascii=False, indent=2)
-            
-            # Thay thế file cũ bằng file mới (os.replace hoạt động trên cả Windows và Linux từ Python 3.3+)
-            # os.replace() là atomic và tương thích đa nền tảng
-            os.replace(temp_file, self.metadata_file)
+            with self._metadata_write_lock():
+                while True:
+                    metadata = self._load_metadata()
+                    changed = False
+                    failed = False
+                    for request in batch:
+                        if request['error'] is not None:
+                            continue
+                        try:
+                            request['result'] = request['mutator'](metadata)
+                            changed = changed or bool(request['result'])
+                        except Exception as e:
+                            request['error'] = e
+                            failed = True
+                            break
+                    if not failed:
+                        break
+                    self._invalidate_metadata_cache()
+                if changed:
+                    self._save_metadata(metadata)
         except Exception as e:
-            # Nếu có lỗi, xóa file tạm nếu tồn tại
-            temp_file = self.metadata_file + '.tmp'
-            if os.path.exists(temp_file):
-                try:
-                    os.remove(temp_file)
-                except:
-                    pass
-            raise Exception(f"Không thể lưu metadata: {str(e)}")
+            for request in batch:
+                if request['error'] is None:
+                    request['error'] = e
+        finally:
+            for request in batch:
+                request['done'].set()
+    
+    def _add_item_meta(self, metadata, item_type, item_meta):
+        """Thêm entry mới vào metadata và index (dùng trong mutator)"""
+        metadata[item_type + 's'].append(item_meta)
+        self._metadata_index[item_type + 's'][int(item_meta['id'])] = item_meta
+        self._sorted_index = {}
+        if item_type == 'note':
+            self._category_stats_bump(metadata['category_stats'], item_meta, count_delta=1)
+    
+    def _remove_item_meta(self, metadata, item_type, item_meta):
+        """Xóa entry khỏi metadata và index (dùng trong mutator)"""
+        if item_type == 'note':
+            self._category_stats_remove(metadata, item_meta, item_meta.get('category', 'general'))
+        metadata[item_type + 's'].remove(item_meta)
+        self._metadata_index[item_type + 's'].pop(int(item_meta['id']), None)
+        self._sorted_index = {}
+    
+    @staticmethod
+    def _write_temp_content(items_dir, content):
+        """Ghi nội dung vào file tạm trong items_dir (ngoài khóa metadata), trả về đường dẫn file tạm"""
+        os.makedirs(items_dir, exist_ok=True)
+        fd, temp_file = tempfile.mkstemp(dir=items_dir, prefix='.content.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                f.write(content)
+            os.chmod(temp_file, 0o644)
+        except:
+            FileStorage._remove_file(temp_file)
+            raise
+        return temp_file
+    
+    @staticmethod
+    def _remove_file(filepath):
+        """Xóa file nếu còn, bỏ qua lỗi"""
+        try:
+            if os.path.exists(filepath):
+                os.remove(filepath)
+        except:
+            pass
+    
+    # === CATEGORY STATS ===
+    # metadata['category_stats'] = {category: {count, latest_updated_at, latest_note_id}},
+    # được cập nhật trong các mutator và lưu cùng metadata.json
+    @staticmethod
+    def _note_updated_at(note_meta):
+        return note_meta.get('updated_at') or note_meta['created_at']
+    
+    def _rebuild_category_stats(self, metadata):
+        """Tính lại toàn bộ thống kê category từ danh sách notes"""
+        stats = {}
+        for note_meta in metadata.get('notes', []):
+            self._category_stats_bump(stats, note_meta, count_delta=1)
+        metadata['category_stats'] = stats
+        return stats
+    
+    def _category_stats_bump(self, stats, note_meta, count_delta=0):
+        """Cộng count_delta vào category của note và ghi nhận note nếu nó mới nhất"""
+        entry = stats.setdefault(note_meta.get('category', 'general'),
+                                 {'count': 0, 'latest_updated_at': None, 'latest_note_id': None})
+        entry['count'] += count_delta
+        updated_at = self._note_updated_at(note_meta)
+        if entry['latest_updated_at'] is None or updated_at >= entry['latest_updated_at']:
+            entry['latest_updated_at'] = updated_at
+            entry['latest_note_id'] = note_meta['id']
+    
+    def _category_stats_remove(self, metadata, note_meta, category):
+        """Bỏ note khỏi thống kê của category (note bị xóa hoặc chuyển category)"""
+        stats = metadata['category_stats']
+        entry = stats.get(category)
+        if entry is None:
+            return
+        entry['count'] -= 1
+        if entry['count'] <= 0:
+            del stats[category]
+        elif entry['latest_note_id'] == note_meta['id']:
+            # Note mới nhất rời category: tìm lại note mới nhất trong các note còn lại
+            latest = None
+            for other in metadata['notes']:
+                if other is note_meta or other.get('category', 'general') != category:
+                    continue
+                if latest is None or self._note_updated_at(other) > self._note_updated_at(latest):
+                    latest = other
+            entry['latest_updated_at'] = self._note_updated_at(latest) if latest else None
+            entry['latest_note_id'] = latest['id'] if latest else None
+    
+    def _touch_category_stats(self, metadata, note_meta, old_category=None):
+        """Cập nhật thống kê sau khi note được sửa (dùng trong mutator)
+        
+        old_category: category trước khi sửa, None nếu category không đổi
+        """
+        new_category = note_meta.get('category', 'general')
+        if old_category is not None and old_category != new_category:
+            self._category_stats_remove(metadata, note_meta, old_category)
+            self._category_stats_bump(metadata['category_stats'], note_meta, count_delta=1)
+        else:
+            self._category_stats_bump(metadata['category_stats'], note_meta)
+    
+    def get_category_stats(self):
+        """Thống kê notes theo category (không duyệt danh sách notes)
+        
+        Returns:
+            Dict {category: {'count', 'recent_date', 'recent_note'}}; recent_note là dict (id, title)
+        """
+        with self._metadata_lock:
+            metadata = self._load_metadata()
+            index = self._metadata_index.get('notes', {})
+            result = {}
+            for category, entry in metadata.get('category_stats', {}).items():
+                note_meta = index.get(entry['latest_note_id']) if entry['latest_note_id'] is not None else None
+                result[category] = {
+                    'count': entry['count'],
+                    'recent_date': datetime.fromisoformat(entry['latest_updated_at']) if entry['latest_updated_at'] else None,
+                    'recent_note': {'id': note_meta['id'], 'title': note_meta['title']} if note_meta else None
+                }
+            return result
     
     def get_next_id(self, item_type='note'):
         """Lấy ID tiếp theo"""
+        with self._metadata_lock:
+            self._load_metadata()
+            ids = self._metadata_index.get(item_type + 's', {})
+            if not ids:
+                return 1
+            return max(ids) + 1
+    
+    def _sorted_item_ids(self, item_type, sort='updated_at', category=None):
+        """Lấy danh sách ID đã sắp xếp (cache tới khi metadata hoặc journal lượt xem thay đổi)
+        
+        sort: 'updated_at' (mới nhất trước), 'view_count' (xem nhiều trước), 'title' (A-Z)
+        """
+        if sort not in self.SORT_KEYS[item_type]:
+            sort = 'updated_at'
+        if category == 'all':
+            category = None
+        with self._metadata_lock:
+            self._load_metadata()
+            # Thứ tự theo lượt xem còn phụ thuộc vào journal chưa compact
+            pending_views = self.view_journal.get_pending_counts() if sort == 'view_count' else None
+            version = self.view_journal.version if sort == 'view_count' else None
+            
+            cache_key = (item_type, sort, category)
+            cached = self._sorted_index.get(cache_key)
+            if cached is not None and cached[0] == version:
+                return cached[1]
+            
+            index = self._metadata_index.get(item_type + 's', {})
+            if category is None:
+                items = list(index.values())
+                items.sort(key=self._note_updated_at, reverse=True)
+            else:
+                # Danh sách của category đã sắp xếp theo updated_at trong index theo category
+                category_ids = self._category_item_ids(item_type).get(category, [])
+                if sort == 'updated_at':
+                    return category_ids
+                items = [index[item_id] for item_id in category_ids]
+            
+            if sort == 'view_count':
+                items.sort(key=lambda m: self._get_view_count(m, pending_views), reverse=True)
+            elif sort == 'title':
+                items.sort(key=lambda m: normalize_text(m['title']).strip())
+            
+            ids = [int(item_meta['id']) for item_meta in items]
+            self._sorted_index[cache_key] = (version, ids)
+            return ids
+    
+    def _category_item_ids(self, item_type):
+        """Index category -> danh sách ID sắp xếp theo updated_at giảm dần
+        
+        Build trong một lượt từ danh sách đã sắp xếp và cache cùng _sorted_index.
+        """
+        with self._metadata_lock:
+            self._load_metadata()
+            cache_key = (item_type, 'by_category')
+            cached = self._sorted_index.get(cache_key)
+            if cached is not None:
+                return cached[1]
+            
+            index = self._metadata_index.get(item_type + 's', {})
+            by_category = {}
+            for item_id in self._sorted_item_ids(item_type, 'updated_at'):
+                by_category.setdefault(index[item_id].get('category', 'general'), []).append(item_id)
+            self._sorted_index[cache_key] = (None, by_category)
+            return by_category
+    
+    def _get_page(self, item_type, category=None, search_query=None, sort='updated_at', limit=None, offset=0):
+        """Lấy một trang notes/docs (nội dung đọc lười)"""
+        if search_query:
+            ids = self.search_ids(search_query, item_type=item_type, category=category)
+            return self.get_items_by_ids(item_type, ids[offset:offset + limit] if limit is not None else ids[offset:])
+        
+        if item_type == 'note':
+            pending_views = self.view_journal.get_pending_counts()
+            build = lambda meta: self._build_note(meta, pending_views=pending_views)
+        else:
+            build = self._build_doc
+        with self._metadata_lock:
+            ids = self._sorted_item_ids(item_type, sort, category)
+            page_ids = ids[offset:offset + limit] if limit is not None else ids[offset:]
+            index = self._metadata_index.get(item_type + 's', {})
+            return [build(index[item_id]) for item_id in page_ids]
+    
+    def count_items(self, item_type='note', category=None, search_query=None):
+        """Đếm số notes/docs khớp bộ lọc (dùng cho phân trang)"""
+        if search_query:
+            return len(self.search_ids(search_query, item_type=item_type, category=category))
+        return len(self._sorted_item_ids(item_type, 'updated_at', category))
+    
+    # === SEARCH INDEX ===
+    def _update_search_index(self, item_type, item_id, title, content=None):
+        """Cập nhật index tìm kiếm cho một note/doc (content=None thì đọc lại từ file)"""
+        if content is None:
+            _, item_meta = self._find_item_meta(item_type, item_id)
+            if not item_meta:
+                return
+            items_dir = self.notes_dir if item_type == 'note' else self.docs_dir
+            content = _read_text_file(os.path.join(items_dir, item_meta['filename']))
+        try:
+            self.search_index.index_item(item_type, item_id, title, content)
+        except Exception as e:
+            # Lỗi index không được làm hỏng thao tác lưu; index sẽ được build lại khi cần
+            print(f"Lỗi khi cập nhật search index ({item_type} {item_id}): {e}")
+    
+    def _remove_from_search_index(self, item_type, item_id):
+        """Xóa một note/doc khỏi index tìm kiếm"""
+        try:
+            self.search_index.remove_item(item_type, item_id)
+        except Exception as e:
+            print(f"Lỗi khi cập nhật search index ({item_type} {item_id}): {e}")
+    
+    def reindex_item(self, item_type, item_id):
+        """Index lại một note/doc theo dữ liệu hiện tại (dùng cho job nền; item đã bị xóa thì bỏ khỏi index)"""
+        _, item_meta = self._find_item_meta(item_type, item_id)
+        if item_meta:
+            self._update_search_index(item_type, item_id, item_meta['title'])
+        else:
+            self._remove_from_search_index(item_type, item_id)
+    
+    def rebuild_search_index(self):
+        """Build lại toàn bộ index tìm kiếm từ metadata và file nội dung"""
         metadata = self._load_metadata()
-        items = metadata.get(item_type + 's', [])
-        if not items:
-            return 1
-        return max(int(item['id']) for item in items) + 1
+        items = []
+        for item_type, items_dir in (('note', self.notes_dir), ('doc', self.docs_dir)):
+            for item_meta in metadata.get(item_type + 's', []):
+                content = _read_text_file(os.path.join(items_dir, item_meta['filename']))
+                items.append((item_type, item_meta['id'], item_meta['title'], content))
+        self.search_index.rebuild(items)
     
-    # === NOTES METHODS ===
-    def create_note(self, title, content, category='general', user_id=None):
-        """Tạo note mới"""
-        note_id = self.get_next_id('note')
+    def search_ids(self, query, item_type='note', category=None):
+        """ID các notes/docs khớp query (đã lọc category), sắp xếp theo độ liên quan
         
-        # Đảm bảo thư mục tồn tại
-        os.makedirs(self.notes_dir, exist_ok=True)
+        Chỉ trả về ID để caller dùng chung một lần tìm kiếm cho cả tổng số và trang kết quả.
+        """
+        ids = []
+        with self._metadata_lock:
+            self._load_metadata()
+            index = self._metadata_index.get(item_type + 's', {})
+            for _, item_id, _ in self.search_index.search(query, item_type=item_type):
+                item_meta = index.get(item_id)
+                if item_meta is None:
+                    continue
+                if category and category != 'all' and item_meta.get('category') != category:
+                    continue
+                ids.append(item_id)
+        return ids
+    
+    def get_items_by_ids(self, item_type, ids):
+        """Notes/docs theo danh sách ID, giữ thứ tự (bỏ qua ID không còn tồn tại, nội dung đọc lười)"""
+        if item_type == 'note':
+            pending_views = self.view_journal.get_pending_counts()
+            build = lambda meta: self._build_note(meta, pending_views=pending_views)
+        else:
+            build = self._build_doc
+        with self._metadata_lock:
+            self._load_metadata()
+            index = self._metadata_index.get(item_type + 's', {})
+            return [build(index[item_id]) for item_id in ids if item_id in index]
+    
+    def search(self, query, item_type='note', category=None, limit=None):
+        """Tìm kiếm notes/docs qua inverted index, kết quả sắp xếp theo độ liên quan
         
-        # Lưu nội dung vào file text
-        filename = f"{note_id}.txt"
-        filepath = os.path.join(self.notes_dir, filename)
+        Returns:
+            List Note hoặc Document (nội dung được đọc lười)
+        """
+        ids = self.search_ids(query, item_type=item_type, category=category)
+        return self.get_items_by_ids(item_type, ids[:limit] if limit is not None else ids)
+    
+    # === NOTES METHODS ===
+    def create_note(self, title, content, category='general', user_id=None, update_search_index=True):
+        """Tạo note mới (update_search_index=False: caller tự index sau, vd. qua job nền)"""
+        # Ghi nội dung ra file tạm trước khi lấy khóa metadata
         try:
-            with open(filepath, 'w', encoding='utf-8') as f:
-                f.write(content)
+            temp_file = self._write_temp_content(self.notes_dir, content)
         except Exception as e:
             raise Exception(f"Không thể tạo file ghi chú: {str(e)}")
+        placed = {}
         
-        # Thêm metadata
-        metadata = self._load_metadata()
-        note_meta = {
-            'id': note_id,
-            'title': title,
-            'filename': filename,
-            'category': category,
-            'user_id': user_id,
-            'attachments': [],  # Danh sách file đính kèm
+        def mutate(metadata):
+            # Cấp ID trong lúc giữ khóa để hai worker không lấy trùng ID
+            note_id = self.get_next_id('note')
+            
+            # Đổi tên file nội dung đã ghi sẵn thành file của ID (chạy lại được nếu mutator bị gọi lại)
+            filename = f"{note_id}.txt"
+            filepath = os.path.join(self.notes_dir, filename)
+            os.replace(placed.get('path', temp_file), filepath)
+            placed['path'] = filepath
+            
+            # Thêm metadata
+            note_meta = {
+                'id': note_id,
+                'title': title,
+                'filename': filename,
+                'category': category,
+                'user_id': user_id,
+                'attachments': [],  # Danh sách file đính kèm
             'view_count': 0,  # Số lần xem (để sắp xếp theo độ phổ biến)
-            'created_at': datetime.utcnow().isoformat(),
-            'updated_at': datetime.utcnow().isoformat()
-        }
-        metadata['notes'].append(note_meta)
-        self._save_metadata(metadata)
+                'created_at': datetime.utcnow().isoformat(),
+                'updated_at': datetime.utcnow().isoformat()
+            }
+            self._add_item_meta(metadata, 'note', note_meta)
+            return note_id
+        
+        try:
+            note_id = self._update_metadata(mutate)
+        except Exception:
+            if 'path' not in placed:
+                self._remove_file(temp_file)
+            raise
+        if update_search_index:
+            self._update_search_index('note', note_id, title, content)
         
         return self.get_note(note_id)
     
     def get_note(self, note_id):
         """Lấy note theo ID"""
-        metadata = self._load_metadata()
-        for note_meta in metadata.get('notes', []):
-            if note_meta['id'] == int(note_id):
-                # Đọc nội dung từ file
-                filepath = os.path.join(self.notes_dir, note_meta['filename'])
-                if os.path.exists(filepath):
-                    with open(filepath, 'r', encoding='utf-8') as f:
-                        content = f.read()
-                    
-                    return Note(
-                        id=note_meta['id'],
-                        title=note_meta['title'],
-                        content=content,
-                        category=note_meta.get('category', 'general'),
-                        user_id=note_meta.get('user_id'),
-                        attachments=note_meta.get('attachments', []),
-                        view_count=note_meta.get('view_count', 0),
-                        created_at=datetime.fromisoformat(note_meta['created_at']),
-                        updated_at=datetime.fromisoformat(note_meta.get('updated_at', note_meta['created_at'])),
-                        updated_by=note_meta.get('updated_by')
-                    )
-        return None
-    
-    def get_all_notes(self, category=None, search_query=None):
-        """Lấy tất cả notes (có thể filter)"""
-        metadata = self._load_metadata()
-        notes = []
-        
-        for note_meta in metadata.get('notes', []):
-            # Filter theo category
-            if category and category != 'all' and note_meta.get('category') != category:
-                continue
-            
-            # Đọc nội dung
+        _, note_meta = self._find_item_meta('note', note_id)
+        if note_meta:
+            # Đọc nội dung từ file
             filepath = os.path.join(self.notes_dir, note_meta['filename'])
             if os.path.exists(filepath):
                 with open(filepath, 'r', encoding='utf-8') as f:
                     content = f.read()
                 
-                # Filter theo search query
-                if search_query:
-                    if search_query.lower() not in note_meta['title'].lower() and \
-                       search_query.lower() not in content.lower():
-                        continue
-                
-                note = Note(
-                    id=note_meta['id'],
-                    title=note_meta['title'],
-                    content=content,
-                    category=note_meta.get('category', 'general'),
-                    user_id=note_meta.get('user_id'),
-                    attachments=note_meta.get('attachments', []),
-                    view_count=note_meta.get('view_count', 0),
-                    created_at=datetime.fromisoformat(note_meta['created_at']),
-                    updated_at=datetime.fromisoformat(note_meta.get('updated_at', note_meta['created_at'])),
-                    updated_by=note_meta.get('updated_by')
-                )
-                notes.append(note)
-        
-        # Sắp xếp theo updated_at giảm dần
-        notes.sort(key=lambda x: x.updated_at, reverse=True)
-        return notes
+                return self._build_note(note_meta, content)
+        return None
     
-    def increment_note_view_count(self, note_id):
-        """Tăng số lần xem của note"""
+    def _build_note(self, note_meta, content=None, pending_views=None):
+        """Tạo Note từ metadata; content=None thì nội dung chỉ được đọc khi truy cập note.content"""
+        return Note(
+            id=note_meta['id'],
+            title=note_meta['title'],
+            content=content,
+            category=note_meta.get('category', 'general'),
+            user_id=note_meta.get('user_id'),
+            attachments=list(note_meta.get('attachments', [])),
+            view_count=self._get_view_count(note_meta, pending_views),
+            created_at=datetime.fromisoformat(note_meta['created_at']),
+            updated_at=datetime.fromisoformat(note_meta.get('updated_at', note_meta['created_at'])),
+            updated_by=note_meta.get('updated_by'),
+            content_path=os.path.join(self.notes_dir, note_meta['filename'])
+        )
+    
+    def get_all_notes(self, category=None, search_query=None, sort='updated_at', limit=None, offset=0):
+        """Lấy notes (có thể filter, sắp xếp và phân trang)
+        
+        Khi có search_query, kết quả lấy từ search index và sắp xếp theo độ liên quan.
+        Nội dung của từng note chỉ được đọc khi truy cập note.content.
+        
+        Args:
+            sort: 'updated_at' (mặc định), 'view_count' hoặc 'title'
+            limit, offset: Phân trang (limit=None = lấy hết)
+        """
+        return self._get_page('note', category, search_query, sort, limit, offset)
+    
+    def get_note_summaries(self, category=None, limit=None):
+        """Lấy thông tin tóm tắt của notes chỉ từ metadata (không đọc file nội dung)
+        
+        Args:
+            category: Chỉ lấy notes của category này (tra qua index theo category)
+            limit: Số notes mới nhất tối đa (None = tất cả)
+        
+        Returns:
+            List dict (id, title, category, user_id, view_count, created_at, updated_at, updated_by),
+            sắp xếp theo updated_at giảm dần
+        """
+        pending_views = self.view_journal.get_pending_counts()
+        with self._metadata_lock:
+            ids = self._sorted_item_ids('note', 'updated_at', category)
+            if limit is not None:
+                ids = ids[:limit]
+            index = self._metadata_index.get('notes', {})
+            note_metas = [index[note_id] for note_id in ids]
+        
+        summaries = []
+        for note_meta in note_metas:
+            created_at = datetime.fromisoformat(note_meta['created_at'])
+            summaries.append({
+                'id': note_meta['id'],
+                'title': note_meta['title'],
+                'category': note_meta.get('category', 'general'),
+                'user_id': note_meta.get('user_id'),
+                'view_count': note_meta.get('view_count', 0) + pending_views.get(note_meta['id'], 0),
+                'created_at': created_at,
+                'updated_at': datetime.fromisoformat(note_meta['updated_at']) if note_meta.get('updated_at') else created_at,
+                'updated_by': note_meta.get('updated_by')
+            })
+        return summaries
+    
+    def get_item_counts(self):
+        """Đếm số notes và docs chỉ từ metadata"""
         metadata = self._load_metadata()
-        for note_meta in metadata.get('notes', []):
-            if note_meta['id'] == int(note_id):
-                note_meta['view_count'] = note_meta.get('view_count', 0) + 1
-                self._save_metadata(metadata)
+        return {
+            'notes': len(metadata.get('notes', [])),
+            'docs': len(metadata.get('docs', []))
+        }
+    
+    def _get_view_count(self, note_meta, pending_views=None):
+        """Số lượt xem = giá trị trong metadata + lượt xem chưa được compact trong journal"""
+        if pending_views is None:
+            pending_views = self.view_journal.get_pending_counts()
+        return note_meta.get('view_count', 0) + pending_views.get(note_meta['id'], 0)
+    
+    def increment_note_view_count(self, note_id):
+        """Tăng số lần xem của note (chỉ append vào journal, không ghi lại metadata)"""
+        _, note_meta = self._find_item_meta('note', note_id)
+        if not note_meta:
+            return False
+        self.view_journal.record(note_meta['id'])
+        return True
+    
+    def compact_view_counts(self):
+        """Gộp các lượt xem trong journal vào metadata.json rồi làm rỗng journal
+        
+        Returns:
+            Tổng số lượt xem đã gộp
+        """
+        def apply_counts(counts, generation):
+            def mutate(metadata):
+                # Thế hệ journal này đã được gộp (crash trước khi journal kịp thay): không cộng lại
+                if metadata.get('view_journal_generation') == generation:
+                    return False
+                for note_id, count in counts.items():
+                    _, note_meta = self._find_item_meta('note', note_id)
+                    if note_meta:
+                        note_meta['view_count'] = note_meta.get('view_count', 0) + count
+                metadata['view_journal_generation'] = generation
                 return True
-        return False
+            self._update_metadata(mutate)
+        
+        return self.view_journal.compact(apply_counts)
     
     def update_note(self, note_id, title=None, content=None, category=None, user_id=None):
         """Cập nhật note"""
-        metadata = self._load_metadata()
-        updated = False
+        # Ghi nội dung mới ra file tạm trước khi lấy khóa metadata
+        temp_file = None
+        if content is not None:
+            try:
+                temp_file = self._write_temp_content(self.notes_dir, content)
+            except Exception as e:
+                raise Exception(f"Không thể cập nhật file ghi chú: {str(e)}")
+        placed = []
         
-        for note_meta in metadata['notes']:
-            if note_meta['id'] == int(note_id):
-                if title is not None:
-                    note_meta['title'] = title
-                    updated = True
-                
-                if category is not None:
-                    note_meta['category'] = category
-                    updated = True
-                
-                if content is not None:
-                    # Đảm bảo thư mục tồn tại
-                    os.makedirs(self.notes_dir, exist_ok=True)
-                    
-                    # Cập nhật file text
-                    filepath = os.path.join(self.notes_dir, note_meta['filename'])
-                    try:
-                        with open(filepath, 'w', encoding='utf-8') as f:
-                            f.write(content)
-                        updated = True
-                    except Exception as e:
-                        raise Exception(f"Không thể cập nhật file ghi chú: {str(e)}")
-                
-                if updated:
-                    note_meta['updated_at'] = datetime.utcnow().isoformat()
-                    if user_id is not None:
-                        note_meta['updated_by'] = user_id
-                    self._save_metadata(metadata)
-                break
+        def mutate(metadata):
+            _, note_meta = self._find_item_meta('note', note_id)
+            updated = False
+            if not note_meta:
+                return updated
+            old_category = note_meta.get('category', 'general')
+            
+            # Thay file nội dung (đã ghi sẵn) trước để metadata không bị sửa dở khi lỗi
+            if content is not None:
+                if not placed:
+                    os.replace(temp_file, os.path.join(self.notes_dir, note_meta['filename']))
+                    placed.append(True)
+                updated = True
+            
+            if title is not None:
+                note_meta['title'] = title
+                updated = True
+            
+            if category is not None:
+                note_meta['category'] = category
+                updated = True
+            
+            if updated:
+                note_meta['updated_at'] = datetime.utcnow().isoformat()
+                if user_id is not None:
+                    note_meta['updated_by'] = user_id
+                self._touch_category_stats(metadata, note_meta, old_category)
+            return updated
+        
+        try:
+            updated = self._update_metadata(mutate)
+        finally:
+            if temp_file and not placed:
+                self._remove_file(temp_file)
+        if updated and (title is not None or content is not None):
+            _, note_meta = self._find_item_meta('note', note_id)
+            if note_meta:
+                self._update_search_index('note', note_id, note_meta['title'], content)
         
         return updated
     
     def delete_note(self, note_id):
         """Xóa note"""
-        metadata = self._load_metadata()
-        for note_meta in metadata['notes']:
-            if note_meta['id'] == int(note_id):
-                # Xóa file text
-                filepath = os.path.join(self.notes_dir, note_meta['filename'])
-                if os.path.exists(filepath):
-                    os.remove(filepath)
-                
-                # Xóa tất cả attachments
-                for attachment in note_meta.get('attachments', []):
-                    attach_path = os.path.join(self.notes_uploads_dir, attachment['filename'])
-                    if os.path.exists(attach_path):
-                        os.remove(attach_path)
-                
-                # Xóa metadata
-                metadata['notes'].remove(note_meta)
-                self._save_metadata(metadata)
-                return True
-        return False
+        attach_paths = []
+        
+        def mutate(metadata):
+            _, note_meta = self._find_item_meta('note', note_id)
+            if not note_meta:
+                return False
+            
+            # Xóa file text trong khóa vì ID có thể được cấp lại cho note tạo ngay sau đó
+            filepath = os.path.join(self.notes_dir, note_meta['filename'])
+            if os.path.exists(filepath):
+                os.remove(filepath)
+            
+            # Attachments (tên duy nhất) được xóa sau khi nhả khóa
+            attach_paths[:] = [os.path.join(self.notes_uploads_dir, attachment['filename'])
+                               for attachment in note_meta.get('attachments', [])]
+            
+            # Xóa metadata
+            self._remove_item_meta(metadata, 'note', note_meta)
+            return True
+        
+        deleted = self._update_metadata(mutate)
+        if deleted:
+            for attach_path in attach_paths:
+                self._remove_file(attach_path)
+            self._remove_from_search_index('note', note_id)
+        return deleted
     
     def add_note_attachment(self, note_id, uploaded_file):
         """Thêm file đính kèm vào note"""
         import uuid
         from werkzeug.utils import secure_filename
         
-        metadata = self._load_metadata()
-        for note_meta in metadata['notes']:
-            if note_meta['id'] == int(note_id):
-                # Lấy phần mở rộng file
-                original_filename = secure_filename(uploaded_file.filename)
-                if not original_filename:
-                    return False
-                    
-                file_ext = os.path.splitext(original_filename)[1]
-                
-                # Tạo tên file duy nhất
-                unique_filename = f"{note_id}_{uuid.uuid4().hex[:8]}{file_ext}"
-                filepath = os.path.join(self.notes_uploads_dir, unique_filename)
-                
-                # Lưu file
-                uploaded_file.save(filepath)
-                
-                # Thêm vào metadata
-                if 'attachments' not in note_meta:
-                    note_meta['attachments'] = []
-                
-                note_meta['attachments'].append({
-                    'filename': unique_filename,
-                    'original_filename': original_filename,
-                    'uploaded_at': datetime.utcnow().isoformat()
-                })
-                note_meta['updated_at'] = datetime.utcnow().isoformat()
-                
-                self._save_metadata(metadata)
-                return True
-        return False
+        _, note_meta = self._find_item_meta('note', note_id)
+        if not note_meta:
+            return False
+        
+        # Lấy phần mở rộng file
+        original_filename = secure_filename(uploaded_file.filename)
+        if not original_filename:
+            return False
+            
+        file_ext = os.path.splitext(original_filename)[1]
+        
+        # Tạo tên file duy nhất
+        unique_filename = f"{note_id}_{uuid.uuid4().hex[:8]}{file_ext}"
+        filepath = os.path.join(self.notes_uploads_dir, unique_filename)
+        
+        # Lưu file (ngoài khóa metadata để không chặn các worker khác khi upload file lớn)
+        uploaded_file.save(filepath)
+        
+        def mutate(metadata):
+            _, note_meta = self._find_item_meta('note', note_id)
+            if not note_meta:
+                return False
+            
+            # Thêm vào metadata
+            if 'attachments' not in note_meta:
+                note_meta['attachments'] = []
+            
+            note_meta['attachments'].append({
+                'filename': unique_filename,
+                'original_filename': original_filename,
+                'uploaded_at': datetime.utcnow().isoformat()
+            })
+            note_meta['updated_at'] = datetime.utcnow().isoformat()
+            self._touch_category_stats(metadata, note_meta)
+            return True
+        
+        if not self._update_metadata(mutate):
+            # note đã bị xóa trong lúc upload
+            if os.path.exists(filepath):
+                os.remove(filepath)
+            return False
+        return True
     
     def delete_note_attachment(self, note_id, attachment_filename):
         """Xóa file đính kèm từ note - Dù file vật lý còn hay không thì vẫn xóa attachment khỏi metadata"""
-        metadata = self._load_metadata()
-        for note_meta in metadata['notes']:
-            if note_meta['id'] == int(note_id):
-                attachments = note_meta.get('attachments', [])
-                for attachment in attachments:
-                    if attachment['filename'] == attachment_filename:
-                        # Xóa file vật lý nếu còn
-                        filepath = os.path.join(self.notes_uploads_dir, attachment_filename)
-                        if os.path.exists(filepath):
-                            try:
-                                os.remove(filepath)
-                            except Exception as e:
-                                print(f"[DEBUG] ERROR khi xóa file vật lý: {e}")
-                        # Xóa khỏi metadata (luôn làm)
-                        attachments.remove(attachment)
-                        note_meta['updated_at'] = datetime.utcnow().isoformat()
-                        self._save_metadata(metadata)
-                        print(f"[DEBUG] Đã xóa attachment ({attachment_filename}) khỏi metadata note {note_id}")
-                        return True
+        def mutate(metadata):
+            _, note_meta = self._find_item_meta('note', note_id)
+            if not note_meta:
+                return False
+            attachments = note_meta.get('attachments', [])
+            for attachment in attachments:
+                if attachment['filename'] == attachment_filename:
+                    # Xóa khỏi metadata (luôn làm), file vật lý được xóa sau khi nhả khóa
+                    attachments.remove(attachment)
+                    note_meta['updated_at'] = datetime.utcnow().isoformat()
+                    self._touch_category_stats(metadata, note_meta)
+                    return True
+            return False
+        
+        if self._update_metadata(mutate):
+            # Xóa file vật lý nếu còn
+            filepath = os.path.join(self.notes_uploads_dir, attachment_filename)
+            if os.path.exists(filepath):
+                try:
+                    os.remove(filepath)
+                except Exception as e:
+                    print(f"[DEBUG] ERROR khi xóa file vật lý: {e}")
+            print(f"[DEBUG] Đã xóa attachment ({attachment_filename}) khỏi metadata note {note_id}")
+            return True
         print(f"[DEBUG] Không tìm thấy note hoặc attachment: note_id={note_id}, filename={attachment_filename}")
         return False
     
@@ -309,213 +867,235 @@ class FileStorage:
         return sorted(list(categories))
     
     # === DOCUMENTS METHODS ===
-    def create_doc(self, title, content, category='general', user_id=None):
-        """Tạo document mới"""
-        doc_id = self.get_next_id('doc')
-        
-        # Đảm bảo thư mục tồn tại
-        os.makedirs(self.docs_dir, exist_ok=True)
-        
-        # Lưu nội dung vào file text
-        filename = f"{doc_id}.txt"
-        filepath = os.path.join(self.docs_dir, filename)
+    def create_doc(self, title, content, category='general', user_id=None, update_search_index=True):
+        """Tạo document mới (update_search_index=False: caller tự index sau, vd. qua job nền)"""
+        # Ghi nội dung ra file tạm trước khi lấy khóa metadata
         try:
-            with open(filepath, 'w', encoding='utf-8') as f:
-                f.write(content)
+            temp_file = self._write_temp_content(self.docs_dir, content)
         except Exception as e:
             raise Exception(f"Không thể tạo file tài liệu: {str(e)}")
+        placed = {}
         
-        # Thêm metadata
-        metadata = self._load_metadata()
-        doc_meta = {
-            'id': doc_id,
-            'title': title,
-            'filename': filename,
-            'category': category,
-            'user_id': user_id,
-            'attachments': [],  # Danh sách file đính kèm
-            'created_at': datetime.utcnow().isoformat(),
-            'updated_at': datetime.utcnow().isoformat()
-        }
-        metadata['docs'].append(doc_meta)
-        self._save_metadata(metadata)
+        def mutate(metadata):
+            # Cấp ID trong lúc giữ khóa để hai worker không lấy trùng ID
+            doc_id = self.get_next_id('doc')
+            
+            # Đổi tên file nội dung đã ghi sẵn thành file của ID (chạy lại được nếu mutator bị gọi lại)
+            filename = f"{doc_id}.txt"
+            filepath = os.path.join(self.docs_dir, filename)
+            os.replace(placed.get('path', temp_file), filepath)
+            placed['path'] = filepath
+            
+            # Thêm metadata
+            doc_meta = {
+                'id': doc_id,
+                'title': title,
+                'filename': filename,
+                'category': category,
+                'user_id': user_id,
+                'attachments': [],  # Danh sách file đính kèm
+                'created_at': datetime.utcnow().isoformat(),
+                'updated_at': datetime.utcnow().isoformat()
+            }
+            self._add_item_meta(metadata, 'doc', doc_meta)
+            return doc_id
+        
+        try:
+            doc_id = self._update_metadata(mutate)
+        except Exception:
+            if 'path' not in placed:
+                self._remove_file(temp_file)
+            raise
+        if update_search_index:
+            self._update_search_index('doc', doc_id, title, content)
         
         return self.get_doc(doc_id)
     
     def get_doc(self, doc_id):
         """Lấy document theo ID"""
-        metadata = self._load_metadata()
-        for doc_meta in metadata.get('docs', []):
-            if doc_meta['id'] == int(doc_id):
-                # Đọc nội dung từ file
-                filepath = os.path.join(self.docs_dir, doc_meta['filename'])
-                if os.path.exists(filepath):
-                    with open(filepath, 'r', encoding='utf-8') as f:
-                        content = f.read()
-                    
-                    return Document(
-                        id=doc_meta['id'],
-                        title=doc_meta['title'],
-                        content=content,
-                        category=doc_meta.get('category', 'general'),
-                        user_id=doc_meta.get('user_id'),
-                        attachments=doc_meta.get('attachments', []),
-                        created_at=datetime.fromisoformat(doc_meta['created_at']),
-                        updated_at=datetime.fromisoformat(doc_meta.get('updated_at', doc_meta['created_at']))
-                    )
-        return None
-    
-    def get_all_docs(self, category=None, search_query=None):
-        """Lấy tất cả documents (có thể filter)"""
-        metadata = self._load_metadata()
-        docs = []
-        
-        for doc_meta in metadata.get('docs', []):
-            # Filter theo category
-            if category and category != 'all' and doc_meta.get('category') != category:
-                continue
-            
-            # Đọc nội dung
+        _, doc_meta = self._find_item_meta('doc', doc_id)
+        if doc_meta:
+            # Đọc nội dung từ file
             filepath = os.path.join(self.docs_dir, doc_meta['filename'])
             if os.path.exists(filepath):
                 with open(filepath, 'r', encoding='utf-8') as f:
                     content = f.read()
                 
-                # Filter theo search query
-                if search_query:
-                    if search_query.lower() not in doc_meta['title'].lower() and \
-                       search_query.lower() not in content.lower():
-                        continue
-                
-                doc = Document(
-                    id=doc_meta['id'],
-                    title=doc_meta['title'],
-                    content=content,
-                    category=doc_meta.get('category', 'general'),
-                    user_id=doc_meta.get('user_id'),
-                    attachments=doc_meta.get('attachments', []),
-                    created_at=datetime.fromisoformat(doc_meta['created_at']),
-                    updated_at=datetime.fromisoformat(doc_meta.get('updated_at', doc_meta['created_at']))
-                )
-                docs.append(doc)
-        
-        # Sắp xếp theo updated_at giảm dần
-        docs.sort(key=lambda x: x.updated_at, reverse=True)
-        return docs
+                return self._build_doc(doc_meta, content)
+        return None
+    
+    def _build_doc(self, doc_meta, content=None):
+        """Tạo Document từ metadata; content=None thì nội dung chỉ được đọc khi truy cập doc.content"""
+        return Document(
+            id=doc_meta['id'],
+            title=doc_meta['title'],
+            content=content,
+            category=doc_meta.get('category', 'general'),
+            user_id=doc_meta.get('user_id'),
+            attachments=list(doc_meta.get('attachments', [])),
+            created_at=datetime.fromisoformat(doc_meta['created_at']),
+            updated_at=datetime.fromisoformat(doc_meta.get('updated_at', doc_meta['created_at'])),
+            content_path=os.path.join(self.docs_dir, doc_meta['filename'])
+        )
+    
+    def get_all_docs(self, category=None, search_query=None, sort='updated_at', limit=None, offset=0):
+        """Lấy documents (có thể filter, sắp xếp và phân trang)
+        
+        Khi có search_query, kết quả lấy từ search index và sắp xếp theo độ liên quan.
+        Nội dung của từng document chỉ được đọc khi truy cập doc.content.
+        
+        Args:
+            sort: 'updated_at' (mặc định) hoặc 'title'
+            limit, offset: Phân trang (limit=None = lấy hết)
+        """
+        return self._get_page('doc', category, search_query, sort, limit, offset)
     
     def update_doc(self, doc_id, title=None, content=None, category=None):
         """Cập nhật document"""
-        metadata = self._load_metadata()
-        updated = False
+        # Ghi nội dung mới ra file tạm trước khi lấy khóa metadata
+        temp_file = None
+        if content is not None:
+            try:
+                temp_file = self._write_temp_content(self.docs_dir, content)
+            except Exception as e:
+                raise Exception(f"Không thể cập nhật file tài liệu: {str(e)}")
+        placed = []
         
-        for doc_meta in metadata['docs']:
-            if doc_meta['id'] == int(doc_id):
-                if title is not None:
-                    doc_meta['title'] = title
-                    updated = True
-                
-                if category is not None:
-                    doc_meta['category'] = category
-                    updated = True
-                
-                if content is not None:
-                    # Đảm bảo thư mục tồn tại
-                    os.makedirs(self.docs_dir, exist_ok=True)
-                    
-                    # Cập nhật file text
-                    filepath = os.path.join(self.docs_dir, doc_meta['filename'])
-                    try:
-                        with open(filepath, 'w', encoding='utf-8') as f:
-                            f.write(content)
-                        updated = True
-                    except Exception as e:
-                        raise Exception(f"Không thể cập nhật file tài liệu: {str(e)}")
-                
-                if updated:
-                    doc_meta['updated_at'] = datetime.utcnow().isoformat()
-                    self._save_metadata(metadata)
-                break
+        def mutate(metadata):
+            _, doc_meta = self._find_item_meta('doc', doc_id)
+            updated = False
+            if not doc_meta:
+                return updated
+            
+            # Thay file nội dung (đã ghi sẵn) trước để metadata không bị sửa dở khi lỗi
+            if content is not None:
+                if not placed:
+                    os.replace(temp_file, os.path.join(self.docs_dir, doc_meta['filename']))
+                    placed.append(True)
+                updated = True
+            
+            if title is not None:
+                doc_meta['title'] = title
+                updated = True
+            
+            if category is not None:
+                doc_meta['category'] = category
+                updated = True
+            
+            if updated:
+                doc_meta['updated_at'] = datetime.utcnow().isoformat()
+            return updated
+        
+        try:
+            updated = self._update_metadata(mutate)
+        finally:
+            if temp_file and not placed:
+                self._remove_file(temp_file)
+        if updated and (title is not None or content is not None):
+            _, doc_meta = self._find_item_meta('doc', doc_id)
+            if doc_meta:
+                self._update_search_index('doc', doc_id, doc_meta['title'], content)
         
         return updated
     
     def delete_doc(self, doc_id):
         """Xóa document"""
-        metadata = self._load_metadata()
-        for doc_meta in metadata['docs']:
-            if doc_meta['id'] == int(doc_id):
-                # Xóa file text
-                filepath = os.path.join(self.docs_dir, doc_meta['filename'])
-                if os.path.exists(filepath):
-                    os.remove(filepath)
-                
-                # Xóa tất cả attachments
-                for attachment in doc_meta.get('attachments', []):
-                    attach_path = os.path.join(self.docs_uploads_dir, attachment['filename'])
-                    if os.path.exists(attach_path):
-                        os.remove(attach_path)
-                
-                # Xóa metadata
-                metadata['docs'].remove(doc_meta)
-                self._save_metadata(metadata)
-                return True
-        return False
+        attach_paths = []
+        
+        def mutate(metadata):
+            _, doc_meta = self._find_item_meta('doc', doc_id)
+            if not doc_meta:
+                return False
+            
+            # Xóa file text trong khóa vì ID có thể được cấp lại cho document tạo ngay sau đó
+            filepath = os.path.join(self.docs_dir, doc_meta['filename'])
+            if os.path.exists(filepath):
+                os.remove(filepath)
+            
+            # Attachments (tên duy nhất) được xóa sau khi nhả khóa
+            attach_paths[:] = [os.path.join(self.docs_uploads_dir, attachment['filename'])
+                               for attachment in doc_meta.get('attachments', [])]
+            
+            # Xóa metadata
+            self._remove_item_meta(metadata, 'doc', doc_meta)
+            return True
+        
+        deleted = self._update_metadata(mutate)
+        if deleted:
+            for attach_path in attach_paths:
+                self._remove_file(attach_path)
+            self._remove_from_search_index('doc', doc_id)
+        return deleted
     
     def add_doc_attachment(self, doc_id, uploaded_file):
         """Thêm file đính kèm vào document"""
         import uuid
         from werkzeug.utils import secure_filename
         
-        metadata = self._load_metadata()
-        for doc_meta in metadata['docs']:
-            if doc_meta['id'] == int(doc_id):
-                # Lấy phần mở rộng file
-                original_filename = secure_filename(uploaded_file.filename)
-                if not original_filename:
-                    return False
-                    
-                file_ext = os.path.splitext(original_filename)[1]
-                
-                # Tạo tên file duy nhất
-                unique_filename = f"{doc_id}_{uuid.uuid4().hex[:8]}{file_ext}"
-                filepath = os.path.join(self.docs_uploads_dir, unique_filename)
-                
-                # Lưu file
-                uploaded_file.save(filepath)
-                
-                # Thêm vào metadata
-                if 'attachments' not in doc_meta:
-                    doc_meta['attachments'] = []
-                
-                doc_meta['attachments'].append({
-                    'filename': unique_filename,
-                    'original_filename': original_filename,
-                    'uploaded_at': datetime.utcnow().isoformat()
-                })
-                doc_meta['updated_at'] = datetime.utcnow().isoformat()
-                
-                self._save_metadata(metadata)
-                return True
-        return False
+        _, doc_meta = self._find_item_meta('doc', doc_id)
+        if not doc_meta:
+            return False
+        
+        # Lấy phần mở rộng file
+        original_filename = secure_filename(uploaded_file.filename)
+        if not original_filename:
+            return False
+            
+        file_ext = os.path.splitext(original_filename)[1]
+        
+        # Tạo tên file duy nhất
+        unique_filename = f"{doc_id}_{uuid.uuid4().hex[:8]}{file_ext}"
+        filepath = os.path.join(self.docs_uploads_dir, unique_filename)
+        
+        # Lưu file (ngoài khóa metadata để không chặn các worker khác khi upload file lớn)
+        uploaded_file.save(filepath)
+        
+        def mutate(metadata):
+            _, doc_meta = self._find_item_meta('doc', doc_id)
+            if not doc_meta:
+                return False
+            
+            # Thêm vào metadata
+            if 'attachments' not in doc_meta:
+                doc_meta['attachments'] = []
+            
+            doc_meta['attachments'].append({
+                'filename': unique_filename,
+                'original_filename': original_filename,
+                'uploaded_at': datetime.utcnow().isoformat()
+            })
+            doc_meta['updated_at'] = datetime.utcnow().isoformat()
+            return True
+        
+        if not self._update_metadata(mutate):
+            # doc đã bị xóa trong lúc upload
+            if os.path.exists(filepath):
+                os.remove(filepath)
+            return False
+        return True
     
     def delete_doc_attachment(self, doc_id, attachment_filename):
         """Xóa file đính kèm từ document"""
-        metadata = self._load_metadata()
-        for doc_meta in metadata['docs']:
-            if doc_meta['id'] == int(doc_id):
-                attachments = doc_meta.get('attachments', [])
-                for attachment in attachments:
-                    if attachment['filename'] == attachment_filename:
-                        # Xóa file vật lý
-                        filepath = os.path.join(self.docs_uploads_dir, attachment_filename)
-                        if os.path.exists(filepath):
-                            os.remove(filepath)
-                        
-                        # Xóa khỏi metadata
-                        attachments.remove(attachment)
-                        doc_meta['updated_at'] = datetime.utcnow().isoformat()
-                        self._save_metadata(metadata)
-                        return True
-        return False
+        def mutate(metadata):
+            _, doc_meta = self._find_item_meta('doc', doc_id)
+            if not doc_meta:
+                return False
+            attachments = doc_meta.get('attachments', [])
+            for attachment in attachments:
+                if attachment['filename'] == attachment_filename:
+                    # Xóa khỏi metadata, file vật lý được xóa sau khi nhả khóa
+                    attachments.remove(attachment)
+                    doc_meta['updated_at'] = datetime.utcnow().isoformat()
+                    return True
+            return False
+        
+        if not self._update_metadata(mutate):
+            return False
+        # Xóa file vật lý
+        filepath = os.path.join(self.docs_uploads_dir, attachment_filename)
+        if os.path.exists(filepath):
+            os.remove(filepath)
+        return True
     
     def get_doc_categories(self):
         """Lấy danh sách categories của documents"""
@@ -526,13 +1106,169 @@ class FileStorage:
         return sorted(list(categories))
 
 
+class ViewCountJournal:
+    """Log append-only cho lượt xem note: mỗi dòng là một note_id
+    
+    Mỗi process đọc tiếp phần mới của log (theo offset) để biết số lượt xem chưa
+    được gộp vào metadata, nên xem note không phải ghi lại metadata.json.
+    
+    Dòng đầu '#gen <N>' là thế hệ của journal, đổi mỗi lần compact: process khác so
+    sánh thế hệ (không dựa vào inode, inode có thể được dùng lại cho file mới) để biết
+    phải đọc lại từ đầu. Journal cũ không có header được coi là thế hệ 0.
+    """
+    HEADER_PREFIX = b'#gen '
+    
+    def __init__(self, journal_file):
+        self.journal_file = os.path.abspath(os.path.normpath(journal_file))
+        self.lock_file = self.journal_file + '.lock'
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._offset = 0
+        self._generation = None
+    
+    @property
+    def version(self):
+        """Phiên bản phần journal đã đọc (đổi mỗi khi get_pending_counts đọc thêm lượt xem mới)"""
+        return (self._generation, self._offset)
+    
+    @classmethod
+    def _new_header(cls, previous=0):
+        """Header cho thế hệ mới (luôn lớn hơn thế hệ trước)"""
+        generation = max(time.time_ns(), previous + 1)
+        return generation, cls.HEADER_PREFIX + str(generation).encode('ascii') + b'\n'
+    
+    @classmethod
+    def _read_header(cls, f):
+        """(thế hệ, số byte header) của journal đang mở; journal cũ không có header = (0, 0)"""
+        f.seek(0)
+        line = f.readline(64)
+        if line.startswith(cls.HEADER_PREFIX) and line.endswith(b'\n'):
+            try:
+                return int(line[len(cls.HEADER_PREFIX):]), len(line)
+            except ValueError:
+                pass
+        return 0, 0
+    
+    def record(self, note_id):
+        """Ghi thêm một lượt xem"""
+        line = f"{int(note_id)}\n".encode('ascii')
+        with locked_file(self.lock_file):
+            fd = os.open(self.journal_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                if os.fstat(fd).st_size == 0:
+                    # Journal vừa được tạo: ghi header thế hệ trước dòng đầu tiên
+                    line = self._new_header()[1] + line
+                os.write(fd, line)
+            finally:
+                os.close(fd)
+    
+    @staticmethod
+    def _parse(data, counts):
+        """Cộng các dòng hoàn chỉnh trong data vào counts, trả về số byte đã dùng"""
+        end = data.rfind(b'\n') + 1
+        for line in data[:end].split(b'\n'):
+            if line.strip().isdigit():
+                note_id = int(line)
+                counts[note_id] = counts.get(note_id, 0) + 1
+        return end
+    
+    def get_pending_counts(self):
+        """Lấy {note_id: số lượt xem chưa compact}, chỉ đọc phần log mới ghi thêm"""
+        with self._lock:
+            try:
+                f = open(self.journal_file, 'rb')
+            except OSError:
+                self._pending, self._offset, self._generation = {}, 0, None
+                return self._pending
+            
+            with f:
+                size = os.fstat(f.fileno()).st_size
+                generation, header_size = self._read_header(f)
+                # Journal đã được compact (thế hệ khác) hoặc bị cắt ngắn: đọc lại từ đầu
+                if generation != self._generation or size < self._offset:
+                    self._pending, self._offset, self._generation = {}, header_size, generation
+                
+                if size > self._offset:
+                    f.seek(self._offset)
+                    data = f.read(size - self._offset)
+                    self._offset += self._parse(data, self._pending)
+            return self._pending
+    
+    def compact(self, apply_counts):
+        """Gộp journal: gọi apply_counts({note_id: count}, thế hệ) rồi thay journal bằng thế hệ mới rỗng
+        
+        apply_counts phải ghi thế hệ đã áp dụng cùng lần ghi số lượt xem và bỏ qua nếu thế hệ đó
+        đã được áp dụng, để chạy lại sau khi crash giữa 2 bước không cộng trùng lượt xem.
+        Journal chỉ bị làm rỗng khi apply_counts chạy thành công.
+        """
+        with locked_file(self.lock_file):
+            try:
+                with open(self.journal_file, 'rb') as f:
+                    generation, _ = self._read_header(f)
+                    f.seek(0)
+                    data = f.read()
+            except FileNotFoundError:
+                return 0
+            counts = {}
+            self._parse(data, counts)
+            if counts:
+                apply_counts(counts, generation)
+            
+            # Thay bằng file mới có header thế hệ mới để các process khác đọc lại từ đầu
+            fd, temp_file = tempfile.mkstemp(dir=os.path.dirname(self.journal_file),
+                                             prefix=os.path.basename(self.journal_file) + '.',
+                                             suffix='.tmp')
+            try:
+                os.write(fd, self._new_header(generation)[1])
+            finally:
+                os.close(fd)
+            os.chmod(temp_file, 0o644)
+            os.replace(temp_file, self.journal_file)
+        return sum(counts.values())
+
+
+class _CombinedLock:
+    """Context manager giữ lần lượt một threading lock và một lock khác (vd. khóa file)"""
+    def __init__(self, thread_lock, other_lock):
+        self._thread_lock = thread_lock
+        self._other_lock = other_lock
+    
+    def __enter__(self):
+        self._thread_lock.acquire()
+        try:
+            self._other_lock.__enter__()
+        except Exception:
+            self._thread_lock.release()
+            raise
+        return self
+    
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            return self._other_lock.__exit__(exc_type, exc, tb)
+        finally:
+            self._thread_lock.release()
+
+
+def _read_text_file(filepath):
+    """Đọc nội dung file text, trả về chuỗi rỗng nếu file không tồn tại"""
+    try:
+        with open(filepath, 'r', encoding='utf-8') as f:
+            return f.read()
+    except FileNotFoundError:
+        return ''
+
+
 class Note:
     """Note class"""
     def __init__(self, id, title, content, category='general', user_id=None, 
-                 attachments=None, view_count=0, created_at=None, updated_at=None, updated_by=None):
+                 attachments=None, view_count=0, created_at=None, updated_at=None, updated_by=None,
+                 content_path=None, content_loader=None):
         self.id = id
         self.title = title
-        self.content = content
+        # content=None + content_path/content_loader: nội dung được đọc lười ở lần truy cập đầu tiên
+        self._content = content
+        self._content_path = content_path
+        self._content_loader = content_loader
         self.category = category
         self.user_id = user_id
         self.attachments = attachments or []
@@ -540,18 +1276,46 @@ class Note:
         self.created_at = created_at or datetime.utcnow()
         self.updated_at = updated_at or self.created_at
         self.updated_by = updated_by
+    
+    @property
+    def content(self):
+        if self._content is None:
+            if self._content_loader is not None:
+                self._content = self._content_loader()
+            elif self._content_path:
+                self._content = _read_text_file(self._content_path)
+        return self._content
+    
+    @content.setter
+    def content(self, value):
+        self._content = value
 
 
 class Document:
     """Document class"""
     def __init__(self, id, title, content, category='general', user_id=None,
-                 attachments=None, created_at=None, updated_at=None):
+                 attachments=None, created_at=None, updated_at=None, content_path=None, content_loader=None):
         self.id = id
         self.title = title
-        self.content = content
+        # content=None + content_path/content_loader: nội dung được đọc lười ở lần truy cập đầu tiên
+        self._content = content
+        self._content_path = content_path
+        self._content_loader = content_loader
         self.category = category
         self.user_id = user_id
         self.attachments = attachments or []
         self.created_at = created_at or datetime.utcnow()
         self.updated_at = updated_at or self.created_at
-
+    
+    @property
+    def content(self):
+        if self._content is None:
+            if self._content_loader is not None:
+                self._content = self._content_loader()
+            elif self._content_path:
+                self._content = _read_text_file(self._content_path)
+        return self._content
+    
+    @content.setter
+    def content(self, value):
+        self._content = value
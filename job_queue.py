@@ -0,0 +1,137 @@
+"""
+Hàng đợi job chạy nền, lưu trên đĩa (mỗi job một file JSON trong data/jobs/)
+Request chỉ ghi một file job nhỏ rồi trả về; scheduler của app lấy job ra chạy
+(thông báo, edit log, cập nhật search index...). Worker nhận job bằng os.rename nên
+nhiều gunicorn worker cùng drain mà một job không bị chạy 2 lần.
+"""
+import os
+import json
+import time
+import uuid
+import tempfile
+import threading
+from datetime import datetime
+
+
+class JobQueue:
+    MAX_ATTEMPTS = 3  # Job lỗi quá số lần này thì chuyển sang .failed để xem lại
+    STALE_SECONDS = 300  # Job đã nhận mà quá N giây chưa xong (worker chết giữa chừng) được đưa lại vào hàng đợi
+    
+    def __init__(self, data_dir='data'):
+        self.queue_dir = os.path.abspath(os.path.join(data_dir, 'jobs'))
+        os.makedirs(self.queue_dir, exist_ok=True)
+        self._handlers = {}
+    
+    def register(self, name, func):
+        """Đăng ký hàm xử lý cho loại job name (gọi func(**payload))"""
+        self._handlers[name] = func
+    
+    def handler(self, name):
+        """Decorator của register"""
+        def decorator(func):
+            self.register(name, func)
+            return func
+        return decorator
+    
+    def enqueue(self, name, **payload):
+        """Thêm job vào hàng đợi (payload phải serialize được sang JSON)
+        
+        Returns:
+            ID job (tên file, tăng dần theo thời điểm enqueue)
+        """
+        job_id = f"{time.time_ns():020d}-{uuid.uuid4().hex[:8]}"
+        self._write(os.path.join(self.queue_dir, job_id + '.json'), {
+            'name': name,
+            'payload': payload,
+            'attempts': 0,
+            'enqueued_at': datetime.utcnow().isoformat()
+        })
+        return job_id
+    
+    def _write(self, path, job):
+        """Ghi file job (atomic, worker khác không bao giờ thấy file ghi dở)"""
+        fd, temp_file = tempfile.mkstemp(dir=self.queue_dir, prefix='.job_', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(job, f, ensure_ascii=False, default=str)
+            os.replace(temp_file, path)
+        except Exception:
+            if os.path.exists(temp_file):
+                try:
+                    os.remove(temp_file)
+                except:
+                    pass
+            raise
+    
+    def pending_count(self):
+        """Số job đang chờ chạy"""
+        return sum(1 for name in os.listdir(self.queue_dir) if name.endswith('.json'))
+    
+    def drain(self, max_jobs=None):
+        """Chạy các job đang chờ theo thứ tự enqueue
+        
+        Args:
+            max_jobs: Số job tối đa chạy trong lần này (None = tới khi hết hàng đợi)
+        
+        Returns:
+            Số job đã chạy thành công
+        """
+        self._requeue_stale()
+        done = 0
+        for name in sorted(os.listdir(self.queue_dir)):
+            if max_jobs is not None and done >= max_jobs:
+                break
+            if not name.endswith('.json'):
+                continue
+            
+            path = os.path.join(self.queue_dir, name)
+            claimed = f"{path}.{os.getpid()}-{threading.get_ident()}.running"
+            try:
+                os.rename(path, claimed)
+            except OSError:
+                continue  # Worker khác đã nhận job này
+            os.utime(claimed)
+            
+            if self._run(path, claimed):
+                done += 1
+        return done
+    
+    def _run(self, path, claimed):
+        """Chạy một job đã nhận; lỗi thì trả job về hàng đợi (hoặc .failed sau MAX_ATTEMPTS lần)"""
+        try:
+            with open(claimed, 'r', encoding='utf-8') as f:
+                job = json.load(f)
+        except Exception as e:
+            print(f"✗ Job {os.path.basename(path)} không đọc được: {e}")
+            os.replace(claimed, path + '.failed')
+            return False
+        
+        try:
+            handler = self._handlers.get(job['name'])
+            if handler is None:
+                raise LookupError(f"Chưa đăng ký job '{job['name']}'")
+            handler(**job['payload'])
+        except Exception as e:
+            job['attempts'] = job.get('attempts', 0) + 1
+            job['last_error'] = str(e)
+            print(f"✗ Job {job['name']} ({os.path.basename(path)}) lỗi lần {job['attempts']}: {e}")
+            self._write(path if job['attempts'] < self.MAX_ATTEMPTS else path + '.failed', job)
+            os.remove(claimed)
+            return False
+        
+        os.remove(claimed)
+        return True
+    
+    def _requeue_stale(self):
+        """Đưa job đã nhận nhưng bị bỏ dở (worker chết) trở lại hàng đợi"""
+        now = time.time()
+        for name in os.listdir(self.queue_dir):
+            if not name.endswith('.running'):
+                continue
+            claimed = os.path.join(self.queue_dir, name)
+            try:
+                st = os.stat(claimed)
+                if now - max(st.st_mtime, st.st_ctime) > self.STALE_SECONDS:
+                    os.rename(claimed, claimed[:claimed.index('.json.') + len('.json')])
+            except OSError:
+                pass
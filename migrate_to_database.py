@@ -17,6 +17,7 @@ import csv
 from datetime import datetime
 from flask import Flask
 from models import db, User, Category, Note, Document, Attachment, EditLog
+from edit_log_storage import EditLogStorage
 
 # Setup Flask app
 app = Flask(__name__)
@@ -30,7 +31,6 @@ DATA_DIR = 'data'
 USERS_CSV = os.path.join(DATA_DIR, 'users.csv')
 METADATA_JSON = os.path.join(DATA_DIR, 'metadata.json')
 CATEGORIES_JSON = os.path.join(DATA_DIR, 'categories.json')
-EDIT_LOGS_JSON = os.path.join(DATA_DIR, 'edit_logs.json')
 NOTES_DIR = os.path.join(DATA_DIR, 'notes')
 DOCS_DIR = os.path.join(DATA_DIR, 'docs')
 
@@ -234,13 +234,12 @@ def migrate_edit_logs():
     """Migrate edit logs từ JSON sang database"""
     print("\n📋 Migrating Edit Logs...")
     
-    if not os.path.exists(EDIT_LOGS_JSON):
-        print("⚠️  edit_logs.json không tồn tại, bỏ qua")
+    # EditLogStorage tự chuyển edit_logs.json cũ (nếu còn) sang data/edit_logs/ rồi đọc tất cả segment
+    logs_data = EditLogStorage(DATA_DIR).load_all()
+    if not logs_data:
+        print("⚠️  Không có edit log nào, bỏ qua")
         return
     
-    with open(EDIT_LOGS_JSON, 'r', encoding='utf-8') as f:
-        logs_data = json.load(f)
-    
     count = 0
     for log_data in logs_data:
         edit_log = EditLog(
@@ -19,6 +19,7 @@ class User(UserMixin, db.Model):
     password_hash = db.Column(db.String(255), nullable=False)
     role = db.Column(db.String(20), nullable=False, default='user')  # admin, editor, user, viewer
     is_active = db.Column(db.Boolean, default=True, nullable=False)
+    avatar = db.Column(db.String(255), nullable=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
@@ -67,9 +68,9 @@ class Note(db.Model):
     category_key = db.Column(db.String(255), db.ForeignKey('categories.key'), nullable=False, index=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=True)
     updated_by = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=True)
-    view_count = db.Column(db.Integer, default=0, nullable=False)
+    view_count = db.Column(db.Integer, default=0, nullable=False, index=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False, index=True)
-    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, nullable=False, index=True)
     
     # Relationships
     category = db.relationship('Category', backref='notes', foreign_keys=[category_key])
@@ -91,7 +92,7 @@ class Document(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=True)
     updated_by = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False, index=True)
-    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, nullable=False, index=True)
     
     # Relationships
     category = db.relationship('Category', backref='documents', foreign_keys=[category_key])
@@ -110,8 +111,8 @@ class Attachment(db.Model):
     filename = db.Column(db.String(255), nullable=False)  # Tên file lưu trên server
     original_filename = db.Column(db.String(255), nullable=False)  # Tên file gốc
     file_type = db.Column(db.String(10), nullable=False)  # 'note' hoặc 'doc'
-    note_id = db.Column(db.Integer, db.ForeignKey('notes.id'), nullable=True)
-    document_id = db.Column(db.Integer, db.ForeignKey('documents.id'), nullable=True)
+    note_id = db.Column(db.Integer, db.ForeignKey('notes.id'), nullable=True, index=True)
+    document_id = db.Column(db.Integer, db.ForeignKey('documents.id'), nullable=True, index=True)
     uploaded_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
     
     def __repr__(self):
@@ -144,7 +145,9 @@ class ChatMessage(db.Model):
     message = db.Column(db.Text, nullable=True)  # Text message
     attachment_filename = db.Column(db.String(255), nullable=True)  # File đính kèm
     attachment_original_name = db.Column(db.String(255), nullable=True)  # Tên file gốc
+    attachment_size = db.Column(db.BigInteger, nullable=True)  # Byte, ghi lúc upload (NULL = file không còn)
     is_read = db.Column(db.Boolean, default=False, nullable=False, index=True)
+    read_by = db.Column(db.Text, nullable=True)  # JSON list user ID đã xem (group chat)
     created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False, index=True)
     
     # Relationships
@@ -153,3 +156,25 @@ class ChatMessage(db.Model):
     
     def __repr__(self):
         return f'<ChatMessage from:{self.sender_id} to:{self.receiver_id}>'
+
+
+class GroupChatRead(db.Model):
+    """Watermark đã xem group chat: mỗi user một dòng (thay cho read_by trên từng tin nhắn)"""
+    __tablename__ = 'group_chat_reads'
+    
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    last_read_id = db.Column(db.Integer, default=0, nullable=False)
+    
+    def __repr__(self):
+        return f'<GroupChatRead user:{self.user_id} up_to:{self.last_read_id}>'
+
+
+class ChatVersion(db.Model):
+    """Bộ đếm phiên bản chat (một dòng id=1), tăng trong cùng transaction với mỗi lần ghi chat"""
+    __tablename__ = 'chat_version'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.BigInteger, default=0, nullable=False)
+    
+    def __repr__(self):
+        return f'<ChatVersion {self.version}>'
@@ -4,37 +4,352 @@ Quản lý thông báo hệ thống
 """
 import json
 import os
+import bisect
+import heapq
+import tempfile
+import threading
+import time
 from datetime import datetime, timedelta
-from typing import List, Dict, Optional
+from typing import List, Dict, Iterable, Optional
+from file_lock import locked_file
 
 
 class NotificationStorage:
-    """Lưu trữ và quản lý thông báo"""
+    """Lưu trữ và quản lý thông báo
+    
+    notifications.json: {'last_id', 'notifications': [...]} theo thứ tự ID (= thứ tự tạo), không chứa
+    trạng thái đã đọc; định dạng cũ (list thông báo có read_by) được chuyển sang log đã đọc khi khởi tạo.
+    
+    notification_reads.log: log append-only (JSON Lines) trạng thái đã đọc, mỗi user gồm watermark
+    (mọi thông báo có ID <= watermark đã đọc) và tập nhỏ các ID đã đọc lẻ phía trên watermark:
+        {'user_id', 'up_to'}   - "đánh dấu tất cả đã đọc"
+        {'user_id', 'ids'}     - đọc từng thông báo
+    Log được nén lại (mỗi user một dòng) khi vượt READS_COMPACT_BYTES. Dòng đầu '#gen <N>' là thế hệ
+    của log, đổi mỗi lần nén: worker khác so sánh thế hệ (không dựa vào inode, inode có thể được dùng
+    lại) để biết phải đọc lại từ đầu. Log cũ không có header được coi là thế hệ 0.
+    """
+    READS_COMPACT_BYTES = 256 * 1024
+    READS_HEADER_PREFIX = b'#gen '
     
     def __init__(self, data_dir: str):
         self.data_dir = data_dir
         self.notifications_file = os.path.join(data_dir, 'notifications.json')
+        self.reads_file = os.path.join(data_dir, 'notification_reads.log')
+        self.lock_file = os.path.abspath(self.notifications_file) + '.lock'
+        
+        # Cache + index trong bộ nhớ, chỉ đọc lại file khi file trên đĩa thay đổi (inode/size/mtime/ctime)
+        self._lock = threading.RLock()
+        self._signature = None
+        self._reset_reads()
+        self._set_state([], 0)
+        
         self._ensure_file_exists()
     
     def _ensure_file_exists(self):
-        """Đảm bảo file notifications.json tồn tại"""
-        if not os.path.exists(self.notifications_file):
-            self._save_notifications([])
+        """Đảm bảo file notifications.json tồn tại, chuyển read_by/read_up_to kiểu cũ sang log đã đọc"""
+        with self._lock, locked_file(self.lock_file):
+            if not os.path.exists(self.notifications_file):
+                self._save()
+            else:
+                self._migrate_inline_reads()
     
-    def _load_notifications(self) -> List[Dict]:
-        """Load tất cả thông báo từ file"""
+    def _file_signature(self, path: Optional[str] = None):
+        try:
+            st = os.stat(path or self.notifications_file)
+        except OSError:
+            return None
+        return (st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns)
+    
+    # === INDEX ===
+    def _set_state(self, notifications: List[Dict], last_id: int):
+        """Ghi danh sách thông báo vào cache và build lại các index"""
+        self._notifications = sorted(notifications, key=lambda n: n['id'])
+        self._last_id = max([last_id] + [n['id'] for n in self._notifications])
+        self._by_id = {}
+        self._broadcast_ids = []  # ID thông báo toàn hệ thống, tăng dần
+        self._user_ids = {}  # user_id -> [ID thông báo riêng, tăng dần]
+        for notification in self._notifications:
+            self._index(notification)
+        self._recount_read_above()
+    
+    def _ids_for(self, notification: Dict) -> List[int]:
+        if notification.get('user_id') is None:
+            return self._broadcast_ids
+        return self._user_ids.setdefault(notification['user_id'], [])
+    
+    @staticmethod
+    def _is_visible(notification: Dict, user_id: int) -> bool:
+        return notification.get('user_id') is None or notification.get('user_id') == user_id
+    
+    def _index(self, notification: Dict):
+        """Thêm thông báo vào index (ID luôn lớn hơn mọi ID đã có)"""
+        notification.pop('read_by', None)
+        self._by_id[notification['id']] = notification
+        self._ids_for(notification).append(notification['id'])
+    
+    def _unindex(self, notification: Dict):
+        ids = self._ids_for(notification)
+        del ids[bisect.bisect_left(ids, notification['id'])]
+        self._by_id.pop(notification['id'], None)
+        for user_id, read_ids in self._read_ids.items():
+            if notification['id'] in read_ids and self._is_visible(notification, user_id):
+                self._read_above[user_id] -= 1
+    
+    def _is_read(self, notification: Dict, user_id: int) -> bool:
+        return notification['id'] <= self._read_up_to.get(user_id, 0) or notification['id'] in self._read_ids.get(user_id, ())
+    
+    def _newest_ids(self, user_id: Optional[int]) -> Iterable[int]:
+        """ID các thông báo user thấy được, mới nhất trước (trộn lười 2 list đã sắp xếp)"""
+        if user_id is None:
+            return (notification['id'] for notification in reversed(self._notifications))
+        return heapq.merge(reversed(self._broadcast_ids), reversed(self._user_ids.get(user_id, [])), reverse=True)
+    
+    def _view(self, notification: Dict, user_id: Optional[int]) -> Dict:
+        """Bản sao thông báo trả ra ngoài, read_by được suy ra từ trạng thái đã đọc
+        
+        Với user_id: [user_id] nếu user đã đọc, ngược lại []; None (xem toàn hệ thống): mọi user đã đọc.
+        """
+        if user_id is not None:
+            read_by = [user_id] if self._is_read(notification, user_id) else []
+        else:
+            read_by = sorted(reader for reader in set(self._read_up_to) | set(self._read_ids)
+                             if self._is_visible(notification, reader) and self._is_read(notification, reader))
+        return dict(notification, read_by=read_by)
+    
+    # === READ STATE ===
+    def _reset_reads(self):
+        self._read_up_to = {}  # user_id -> watermark
+        self._read_ids = {}  # user_id -> {ID đã đọc lẻ, > watermark}
+        self._read_above = {}  # user_id -> số ID trong _read_ids còn tồn tại và user thấy được
+        self._reads_position = (None, 0)  # (thế hệ, số byte đã đọc) của log đã đọc
+    
+    def _recount_read_above(self, user_id: Optional[int] = None):
+        user_ids = [user_id] if user_id is not None else list(self._read_ids)
+        for reader in user_ids:
+            self._read_above[reader] = sum(
+                1 for notification_id in self._read_ids.get(reader, ())
+                if notification_id in self._by_id and self._is_visible(self._by_id[notification_id], reader))
+    
+    def _apply_read(self, record: Dict):
+        """Áp dụng một record của log đã đọc vào trạng thái trong bộ nhớ"""
+        user_id = record['user_id']
+        up_to = record.get('up_to', 0)
+        if up_to > self._read_up_to.get(user_id, 0):
+            self._read_up_to[user_id] = up_to
+            self._read_ids[user_id] = {i for i in self._read_ids.get(user_id, ()) if i > up_to}
+            self._recount_read_above(user_id)
+        
+        watermark = self._read_up_to.get(user_id, 0)
+        read_ids = self._read_ids.setdefault(user_id, set())
+        for notification_id in record.get('ids', []):
+            if notification_id > watermark and notification_id not in read_ids:
+                read_ids.add(notification_id)
+                notification = self._by_id.get(notification_id)
+                if notification is not None and self._is_visible(notification, user_id):
+                    self._read_above[user_id] = self._read_above.get(user_id, 0) + 1
+    
+    @classmethod
+    def _new_reads_header(cls, previous: int = 0) -> bytes:
+        """Header cho thế hệ mới của log đã đọc (luôn lớn hơn thế hệ trước)"""
+        generation = max(time.time_ns(), previous + 1)
+        return cls.READS_HEADER_PREFIX + str(generation).encode('ascii') + b'\n'
+    
+    @classmethod
+    def _read_reads_header(cls, f):
+        """(thế hệ, số byte header) của log đang mở; log cũ không có header = (0, 0)"""
+        line = f.readline(64)
+        if line.startswith(cls.READS_HEADER_PREFIX) and line.endswith(b'\n'):
+            try:
+                return int(line[len(cls.READS_HEADER_PREFIX):]), len(line)
+            except ValueError:
+                pass
+        return 0, 0
+    
+    def _refresh_reads(self):
+        """Đọc tiếp các record mới của log đã đọc (kể cả do worker khác ghi)"""
+        try:
+            f = open(self.reads_file, 'rb')
+        except OSError:
+            if self._reads_position[0] is not None:
+                self._reset_reads()
+                self._recount_read_above()
+            return
+        
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            generation, header_size = self._read_reads_header(f)
+            current, offset = self._reads_position
+            if generation != current or size < offset:
+                # Log đã được nén lại (thế hệ mới): đọc lại từ đầu
+                self._reset_reads()
+                offset = header_size
+            if size > offset:
+                f.seek(offset)
+                data = f.read(size - offset)
+                # Chỉ dùng các dòng hoàn chỉnh, dòng đang ghi dở sẽ được đọc ở lần sau
+                end = data.rfind(b'\n') + 1
+                for line in data[:end].split(b'\n'):
+                    if line.strip():
+                        try:
+                            self._apply_read(json.loads(line))
+                        except:
+                            pass
+                offset += end
+        self._reads_position = (generation, offset)
+    
+    def _append_reads(self, records: List[Dict]):
+        """Ghi thêm records vào log đã đọc (vài chục byte mỗi record)
+        
+        Caller phải giữ self._lock và locked_file(self.lock_file).
+        """
+        data = ''.join(json.dumps(record) + '\n' for record in records).encode('utf-8')
+        fd = os.open(self.reads_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size == 0:
+                # Log vừa được tạo: ghi header thế hệ trước record đầu tiên
+                data = self._new_reads_header() + data
+            os.write(fd, data)
+        finally:
+            os.close(fd)
+        self._refresh_reads()
+        if self._reads_position[1] > self.READS_COMPACT_BYTES:
+            self._compact_reads()
+    
+    def _compact_reads(self):
+        """Nén log đã đọc: mỗi user một dòng, nâng watermark qua các ID đọc lẻ liền nhau
+        
+        Caller phải giữ self._lock và locked_file(self.lock_file).
+        """
+        records = []
+        for user_id in sorted(set(self._read_up_to) | set(self._read_ids)):
+            watermark = self._read_up_to.get(user_id, 0)
+            read_ids = {i for i in self._read_ids.get(user_id, ()) if i in self._by_id}
+            for notification_id in self._visible_ids_after(user_id, watermark):
+                if notification_id not in read_ids:
+                    break
+                watermark = notification_id
+                read_ids.discard(notification_id)
+            record = {'user_id': user_id, 'up_to': watermark}
+            if read_ids:
+                record['ids'] = sorted(read_ids)
+            records.append(record)
+        
+        reads_dir = os.path.dirname(os.path.abspath(self.reads_file))
+        fd, temp_file = tempfile.mkstemp(dir=reads_dir, prefix='notification_reads.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(self._new_reads_header(self._reads_position[0] or 0))
+                for record in records:
+                    f.write((json.dumps(record) + '\n').encode('utf-8'))
+            os.replace(temp_file, self.reads_file)
+        except Exception:
+            if os.path.exists(temp_file):
+                try:
+                    os.remove(temp_file)
+                except:
+                    pass
+            raise
+        self._reset_reads()
+        self._refresh_reads()
+    
+    def _visible_ids_after(self, user_id: int, after_id: int) -> Iterable[int]:
+        """ID user thấy được và lớn hơn after_id, tăng dần"""
+        user_ids = self._user_ids.get(user_id, [])
+        return heapq.merge(self._broadcast_ids[bisect.bisect_right(self._broadcast_ids, after_id):],
+                           user_ids[bisect.bisect_right(user_ids, after_id):])
+    
+    def _migrate_inline_reads(self):
+        """Chuyển read_by (từng thông báo) và read_up_to trong notifications.json sang log đã đọc
+        
+        Caller phải giữ self._lock và locked_file(self.lock_file).
+        """
         try:
             with open(self.notifications_file, 'r', encoding='utf-8') as f:
-                return json.load(f)
+                data = json.load(f)
         except (FileNotFoundError, json.JSONDecodeError):
-            return []
+            return
+        if isinstance(data, list):
+            data = {'notifications': data}
+        
+        records = [{'user_id': int(user_id), 'up_to': up_to} for user_id, up_to in data.get('read_up_to', {}).items()]
+        reads = {}
+        for notification in data.get('notifications', []):
+            for user_id in notification.get('read_by', []):
+                reads.setdefault(user_id, []).append(notification['id'])
+        records.extend({'user_id': user_id, 'ids': sorted(ids)} for user_id, ids in reads.items())
+        if not records and 'read_up_to' not in data and all('read_by' not in n for n in data.get('notifications', [])):
+            return
+        
+        self._load()
+        if records:
+            self._append_reads(records)
+        self._save()
+        print(f"✓ Migrated notification read state of {len(set(r['user_id'] for r in records))} users to {self.reads_file}")
     
-    def _save_notifications(self, notifications: List[Dict]):
-        """Lưu thông báo vào file"""
-        with open(self.notifications_file, 'w', encoding='utf-8') as f:
-            json.dump(notifications, f, ensure_ascii=False, indent=2)
+    # === FILE ===
+    def _load(self):
+        """Đọc lại file thông báo nếu đã thay đổi và đọc tiếp log đã đọc"""
+        with self._lock:
+            signature = self._file_signature()
+            if signature is None or signature != self._signature:
+                data = []
+                if signature is not None:
+                    try:
+                        with open(self.notifications_file, 'r', encoding='utf-8') as f:
+                            data = json.load(f)
+                    except (FileNotFoundError, json.JSONDecodeError):
+                        data = []
+                if isinstance(data, list):
+                    data = {'notifications': data}
+                self._set_state(data.get('notifications', []), data.get('last_id', 0))
+                self._signature = signature
+            self._refresh_reads()
     
-    def create_notification(self, title: str, message: str, type: str = 'info', 
+    def _save(self):
+        """Ghi danh sách thông báo ra file (atomic)
+        
+        Caller phải giữ self._lock và locked_file(self.lock_file).
+        """
+        data = {
+            'last_id': self._last_id,
+            'notifications': self._notifications
+        }
+        fd, temp_file = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.notifications_file)),
+                                         prefix='notifications.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False, indent=2)
+            os.replace(temp_file, self.notifications_file)
+            # rename đổi ctime: lấy chữ ký của file đích (vẫn đang giữ lock_file)
+            signature = self._file_signature()
+        except Exception:
+            # Trạng thái trong bộ nhớ có thể đã lệch với file: buộc đọc lại lần sau
+            self._signature = None
+            if os.path.exists(temp_file):
+                try:
+                    os.remove(temp_file)
+                except:
+                    pass
+            raise
+        self._signature = signature
+    
+    def get_version(self) -> str:
+        """
+        Phiên bản hiện tại của thông báo (đổi khi file thông báo được ghi lại hoặc log đã đọc có record mới)
+        
+        Returns:
+            Chuỗi so sánh được, dùng cho long-poll /api/badges
+        """
+        parts = []
+        for path in (self.notifications_file, self.reads_file):
+            try:
+                st = os.stat(path)
+                parts.append(f"{st.st_ino}-{st.st_size}-{st.st_mtime_ns}")
+            except OSError:
+                parts.append('0')
+        return '-'.join(parts)
+    
+    def create_notification(self, title: str, message: str, type: str = 'info',
                           user_id: Optional[int] = None, link: Optional[str] = None,
                           creator_id: Optional[int] = None) -> Dict:
         """
@@ -51,63 +366,58 @@ class NotificationStorage:
         Returns:
             Dict chứa thông tin thông báo đã tạo
         """
-        notifications = self._load_notifications()
-        
-        # Tạo ID mới
-        new_id = max([n.get('id', 0) for n in notifications], default=0) + 1
-        
-        notification = {
-            'id': new_id,
-            'title': title,
-            'message': message,
-            'type': type,
-            'user_id': user_id,  # None = broadcast to all
-            'link': link,
-            'creator_id': creator_id,  # ID người tạo
-            'created_at': datetime.utcnow().isoformat(),
-            'read_by': []  # List of user IDs who have read this
-        }
-        
-        notifications.append(notification)
-        self._save_notifications(notifications)
-        
-        return notification
+        with self._lock, locked_file(self.lock_file):
+            self._load()
+            
+            # ID mới không bao giờ dùng lại (ID cũ có thể đã nằm dưới watermark của user)
+            notification = {
+                'id': self._last_id + 1,
+                'title': title,
+                'message': message,
+                'type': type,
+                'user_id': user_id,  # None = broadcast to all
+                'link': link,
+                'creator_id': creator_id,  # ID người tạo
+                'created_at': datetime.utcnow().isoformat()
+            }
+            
+            self._notifications.append(notification)
+            self._last_id = notification['id']
+            self._index(notification)
+            self._save()
+            
+            return dict(notification, read_by=[])
     
-    def get_notifications(self, user_id: Optional[int] = None, 
-                         unread_only: bool = False, limit: int = 50) -> List[Dict]:
+    def get_notifications(self, user_id: Optional[int] = None,
+                         unread_only: bool = False, limit: Optional[int] = 50) -> List[Dict]:
         """
-        Lấy danh sách thông báo
+        Lấy danh sách thông báo, mới nhất trước (chỉ duyệt tới khi đủ limit)
         
         Args:
             user_id: ID người dùng (None = lấy thông báo hệ thống)
             unread_only: Chỉ lấy thông báo chưa đọc
-            limit: Số lượng thông báo tối đa
+            limit: Số lượng thông báo tối đa (None = không giới hạn)
         
         Returns:
             List các thông báo
         """
-        notifications = self._load_notifications()
-        
-        # Filter theo user_id
-        if user_id is not None:
-            # Lấy thông báo của user hoặc thông báo broadcast (user_id = None)
-            notifications = [
-                n for n in notifications 
-                if n.get('user_id') is None or n.get('user_id') == user_id
-            ]
-        
-        # Filter chưa đọc
-        if unread_only and user_id is not None:
-            notifications = [
-                n for n in notifications 
-                if user_id not in n.get('read_by', [])
-            ]
-        
-        # Sắp xếp theo thời gian (mới nhất trước)
-        notifications.sort(key=lambda x: x.get('created_at', ''), reverse=True)
-        
-        # Limit
-        return notifications[:limit]
+        with self._lock:
+            self._load()
+            watermark = self._read_up_to.get(user_id, 0)
+            read_ids = self._read_ids.get(user_id, ())
+            result = []
+            
+            for notification_id in self._newest_ids(user_id):
+                if limit is not None and len(result) >= limit:
+                    break
+                if unread_only and user_id is not None:
+                    if notification_id <= watermark:
+                        break  # Mọi thông báo cũ hơn đều đã đọc
+                    if notification_id in read_ids:
+                        continue
+                result.append(self._view(self._by_id[notification_id], user_id))
+            
+            return result
     
     def mark_as_read(self, notification_id: int, user_id: int) -> bool:
         """
@@ -120,20 +430,24 @@ class NotificationStorage:
         Returns:
             True nếu thành công
         """
-        notifications = self._load_notifications()
-        
-        for notification in notifications:
-            if notification['id'] == notification_id:
-                if user_id not in notification.get('read_by', []):
-                    notification.setdefault('read_by', []).append(user_id)
-                    self._save_notifications(notifications)
+        with self._lock:
+            self._load()
+            notification = self._by_id.get(notification_id)
+            if notification is None:
+                return False
+            if not self._is_visible(notification, user_id) or self._is_read(notification, user_id):
                 return True
+            
+            with locked_file(self.lock_file):
+                self._load()
+                if notification_id in self._by_id and not self._is_read(self._by_id[notification_id], user_id):
+                    self._append_reads([{'user_id': user_id, 'ids': [notification_id]}])
         
-        return False
+        return True
     
     def mark_all_as_read(self, user_id: int) -> int:
         """
-        Đánh dấu tất cả thông báo đã đọc
+        Đánh dấu tất cả thông báo đã đọc (một dòng nâng watermark của user vào log đã đọc)
         
         Args:
             user_id: ID người dùng
@@ -141,18 +455,14 @@ class NotificationStorage:
         Returns:
             Số lượng thông báo đã đánh dấu
         """
-        notifications = self._load_notifications()
-        count = 0
-        
-        for notification in notifications:
-            # Chỉ đánh dấu thông báo của user hoặc broadcast
-            if notification.get('user_id') is None or notification.get('user_id') == user_id:
-                if user_id not in notification.get('read_by', []):
-                    notification.setdefault('read_by', []).append(user_id)
-                    count += 1
-        
-        if count > 0:
-            self._save_notifications(notifications)
+        with self._lock:
+            if self.get_unread_count(user_id) == 0:
+                return 0
+            
+            with locked_file(self.lock_file):
+                count = self.get_unread_count(user_id)
+                if count > 0:
+                    self._append_reads([{'user_id': user_id, 'up_to': self._last_id}])
         
         return count
     
@@ -166,20 +476,34 @@ class NotificationStorage:
         Returns:
             True nếu thành công
         """
-        notifications = self._load_notifications()
-        original_count = len(notifications)
-        
-        notifications = [n for n in notifications if n['id'] != notification_id]
-        
-        if len(notifications) < original_count:
-            self._save_notifications(notifications)
+        with self._lock, locked_file(self.lock_file):
+            self._load()
+            notification = self._by_id.get(notification_id)
+            if notification is None:
+                return False
+            
+            self._unindex(notification)
+            self._notifications = [n for n in self._notifications if n['id'] != notification_id]
+            self._save()
             return True
+    
+    def delete_all_notifications(self) -> int:
+        """
+        Xóa tất cả thông báo
         
-        return False
+        Returns:
+            Số lượng thông báo đã xóa
+        """
+        with self._lock, locked_file(self.lock_file):
+            self._load()
+            deleted_count = len(self._notifications)
+            self._set_state([], self._last_id)
+            self._save()
+            return deleted_count
     
     def get_unread_count(self, user_id: int) -> int:
         """
-        Đếm số thông báo chưa đọc
+        Đếm số thông báo chưa đọc (từ index, không duyệt thông báo)
         
         Args:
             user_id: ID người dùng
@@ -187,8 +511,13 @@ class NotificationStorage:
         Returns:
             Số lượng thông báo chưa đọc
         """
-        notifications = self.get_notifications(user_id=user_id, unread_only=True)
-        return len(notifications)
+        with self._lock:
+            self._load()
+            user_ids = self._user_ids.get(user_id, [])
+            watermark = self._read_up_to.get(user_id, 0)
+            visible = len(self._broadcast_ids) + len(user_ids)
+            read_below = bisect.bisect_right(self._broadcast_ids, watermark) + bisect.bisect_right(user_ids, watermark)
+            return visible - read_below - self._read_above.get(user_id, 0)
     
     def cleanup_old_notifications(self, days: int = 30) -> int:
         """
@@ -200,18 +529,20 @@ class NotificationStorage:
         Returns:
             Số lượng thông báo đã xóa
         """
-        notifications = self._load_notifications()
-        cutoff_date = datetime.utcnow() - timedelta(days=days)
-        
-        original_count = len(notifications)
-        notifications = [
-            n for n in notifications
-            if datetime.fromisoformat(n.get('created_at', '')) > cutoff_date
-        ]
-        
-        deleted_count = original_count - len(notifications)
-        
-        if deleted_count > 0:
-            self._save_notifications(notifications)
-        
-        return deleted_count
+        with self._lock, locked_file(self.lock_file):
+            self._load()
+            cutoff_date = datetime.utcnow() - timedelta(days=days)
+            
+            original_count = len(self._notifications)
+            notifications = [
+                n for n in self._notifications
+                if datetime.fromisoformat(n.get('created_at', '')) > cutoff_date
+            ]
+            
+            deleted_count = original_count - len(notifications)
+            
+            if deleted_count > 0:
+                self._set_state(notifications, self._last_id)
+                self._save()
+            
+            return deleted_count
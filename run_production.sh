@@ -12,6 +12,12 @@ source venv/bin/activate
 # Số workers (thường là 2-4 x số CPU cores)
 WORKERS=${WORKERS:-4}
 
+# Số thread mỗi worker. Mỗi tab đang mở giữ 1 thread cho kết nối realtime (SSE/long-poll),
+# tối đa REALTIME_MAX_CONNECTIONS kết nối mỗi worker; phần còn lại dành cho request thường.
+# Sức chứa realtime = WORKERS x REALTIME_MAX_CONNECTIONS tab, tab vượt quá tự chuyển sang polling.
+THREADS=${THREADS:-64}
+export REALTIME_MAX_CONNECTIONS=${REALTIME_MAX_CONNECTIONS:-$((THREADS / 2))}
+
 # Timeout (giây)
 TIMEOUT=${TIMEOUT:-120}
 
@@ -21,7 +27,7 @@ BIND=${HOST:-0.0.0.0}:${PORT:-5001}
 echo "=========================================="
 echo "Starting Internal Management System"
 echo "=========================================="
-echo "Workers: $WORKERS"
+echo "Workers: $WORKERS x $THREADS threads (realtime: $REALTIME_MAX_CONNECTIONS kết nối/worker)"
 echo "Timeout: $TIMEOUT seconds"
 echo "Binding to: $BIND"
 echo "=========================================="
@@ -30,6 +36,8 @@ echo "=========================================="
 gunicorn \
     --bind $BIND \
     --workers $WORKERS \
+    --worker-class gthread \
+    --threads $THREADS \
     --timeout $TIMEOUT \
     --access-logfile data/logs/access.log \
     --error-logfile data/logs/error.log \
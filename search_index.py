@@ -0,0 +1,332 @@
+"""
+Module inverted index cho tìm kiếm full-text trong Notes và Documents
+Lưu trên đĩa dưới dạng snapshot JSON + log delta append-only, tokenize có hỗ trợ tiếng Việt (bỏ dấu, đ -> d)
+"""
+import os
+import re
+import json
+import html
+import math
+import bisect
+import tempfile
+import threading
+import unicodedata
+from file_lock import locked_file
+
+_TAG_RE = re.compile(r'<[^>]+>')
+_TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def normalize_text(text):
+    """Chuẩn hóa text để so khớp: bỏ HTML, chữ thường, bỏ dấu tiếng Việt"""
+    if not text:
+        return ''
+    text = html.unescape(_TAG_RE.sub(' ', text)).lower()
+    text = text.replace('đ', 'd')
+    decomposed = unicodedata.normalize('NFD', text)
+    return ''.join(ch for ch in decomposed if unicodedata.category(ch) != 'Mn')
+
+
+def tokenize(text):
+    """Tách text thành danh sách token đã chuẩn hóa"""
+    return _TOKEN_RE.findall(normalize_text(text))
+
+
+class SearchIndex:
+    """Inverted index: token -> {item_key: trọng số}
+
+    item_key có dạng "note:<id>" hoặc "doc:<id>". Snapshot (index_file) được cache trong
+    bộ nhớ và chỉ đọc lại khi file trên đĩa thay đổi (giống metadata của FileStorage).
+    Mỗi lần index/xóa một item chỉ ghi thêm một dòng delta vào log (index_file + '.log');
+    các process đọc tiếp phần log mới theo offset và áp dụng từng delta vào bản cache.
+    Khi log vượt COMPACT_LOG_BYTES, log được gộp vào snapshot với thế hệ mới.
+
+    Dòng đầu của log là '#gen <N>': log chỉ được áp dụng khi N bằng 'generation' của
+    snapshot, nên crash giữa lúc ghi snapshot và lúc thay log không áp dụng trùng delta.
+    """
+    TITLE_WEIGHT = 3  # Token xuất hiện trong tiêu đề được tính nặng hơn nội dung
+    COMPACT_LOG_BYTES = 1 << 20  # Gộp log vào snapshot khi log lớn hơn 1MB
+    LOG_HEADER_PREFIX = b'#gen '
+
+    def __init__(self, index_file):
+        self.index_file = os.path.abspath(os.path.normpath(index_file))
+        self.lock_file = self.index_file + '.lock'
+        self.log_file = self.index_file + '.log'
+        self._lock = threading.RLock()
+        self._data = None
+        self._signature = None
+        self._sorted_terms = []
+        self._log_offset = 0
+
+    @staticmethod
+    def item_key(item_type, item_id):
+        return f"{item_type}:{int(item_id)}"
+
+    def exists(self):
+        """Index đã được build trên đĩa chưa"""
+        return os.path.exists(self.index_file)
+
+    def _file_signature(self, path=None):
+        try:
+            st = os.stat(path or self.index_file)
+        except OSError:
+            return None
+        return (st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns)
+
+    def _set_data(self, data, signature):
+        self._data = data
+        self._signature = signature
+        self._sorted_terms = sorted(data['postings'])
+        self._log_offset = 0
+
+    def _load_snapshot(self, signature):
+        """Đọc lại snapshot từ file (bỏ các delta đã áp dụng trong cache)"""
+        try:
+            with open(self.index_file, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            data = {}
+            signature = None
+        data.setdefault('postings', {})
+        data.setdefault('items', {})
+        data.setdefault('generation', 0)
+        self._set_data(data, signature)
+
+    def _load(self):
+        """Load index (có cache trong bộ nhớ): snapshot + các delta mới trong log"""
+        with self._lock:
+            signature = self._file_signature()
+            if self._data is None or signature is None or signature != self._signature:
+                self._load_snapshot(signature)
+            if not self._read_log():
+                # Log bị thay bằng file ngắn hơn cùng thế hệ: đọc lại snapshot rồi áp dụng log từ đầu
+                self._load_snapshot(self._file_signature())
+                self._read_log()
+            return self._data
+
+    @classmethod
+    def _read_log_header(cls, f):
+        """(thế hệ, số byte header) của log đang mở, (None, 0) nếu không có header"""
+        f.seek(0)
+        line = f.readline(64)
+        if line.startswith(cls.LOG_HEADER_PREFIX) and line.endswith(b'\n'):
+            try:
+                return int(line[len(cls.LOG_HEADER_PREFIX):]), len(line)
+            except ValueError:
+                pass
+        return None, 0
+
+    def _read_log(self):
+        """Áp dụng các delta mới ghi thêm vào log (chỉ khi log cùng thế hệ với snapshot)
+
+        Trả về False nếu log ngắn hơn phần đã đọc (cần đọc lại snapshot).
+        """
+        try:
+            f = open(self.log_file, 'rb')
+        except OSError:
+            return True
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            generation, header_size = self._read_log_header(f)
+            if generation != self._data['generation']:
+                # Log cũ đã được gộp vào snapshot (hoặc chưa có log mới)
+                return True
+            if size < self._log_offset:
+                return False
+            self._log_offset = max(self._log_offset, header_size)
+            if size > self._log_offset:
+                f.seek(self._log_offset)
+                chunk = f.read(size - self._log_offset)
+                end = chunk.rfind(b'\n') + 1
+                for line in chunk[:end].splitlines():
+                    try:
+                        delta = json.loads(line)
+                    except ValueError:
+                        continue
+                    self._remove_key(self._data, delta['key'], self._sorted_terms)
+                    if delta['terms'] is not None:
+                        self._add_key(self._data, delta['key'], delta['terms'], self._sorted_terms)
+                self._log_offset += end
+        return True
+
+    def _reset_log(self, generation):
+        """Thay log bằng log rỗng của thế hệ generation (caller đang giữ lock_file)"""
+        index_dir = os.path.dirname(self.index_file)
+        fd, temp_file = tempfile.mkstemp(dir=index_dir, prefix='.search_index.', suffix='.tmp')
+        try:
+            os.write(fd, self.LOG_HEADER_PREFIX + str(generation).encode('ascii') + b'\n')
+        finally:
+            os.close(fd)
+        os.chmod(temp_file, 0o644)
+        os.replace(temp_file, self.log_file)
+
+    def _append_delta(self, key, weights):
+        """Ghi một delta (weights=None: xóa item) vào log và áp dụng vào cache
+
+        Caller đang giữ self._lock và lock_file, và đã gọi _load().
+        """
+        try:
+            with open(self.log_file, 'rb') as f:
+                generation, _ = self._read_log_header(f)
+        except FileNotFoundError:
+            generation = None
+        if generation != self._data['generation']:
+            # Chưa có log, hoặc log cũ còn sót lại sau khi snapshot đã gộp nó
+            self._reset_log(self._data['generation'])
+        line = json.dumps({'key': key, 'terms': weights}, ensure_ascii=False, separators=(',', ':'))
+        with open(self.log_file, 'ab') as f:
+            f.write(line.encode('utf-8') + b'\n')
+        self._read_log()
+        if self._log_offset > self.COMPACT_LOG_BYTES:
+            self._compact()
+
+    def _compact(self):
+        """Gộp log vào snapshot thế hệ mới rồi bắt đầu log mới (caller đang giữ lock_file)"""
+        data = self._data
+        data['generation'] += 1
+        self._save(data)
+        self._reset_log(data['generation'])
+
+    def _save(self, data):
+        """Ghi index ra file (atomic, file tạm riêng cho mỗi lần ghi)"""
+        with self._lock:
+            index_dir = os.path.dirname(self.index_file)
+            os.makedirs(index_dir, exist_ok=True)
+            fd, temp_file = tempfile.mkstemp(dir=index_dir, prefix='.search_index.', suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                    json.dump(data, f, ensure_ascii=False, separators=(',', ':'))
+                os.replace(temp_file, self.index_file)
+                # rename đổi ctime: lấy chữ ký của file đích (caller đang giữ lock_file)
+                signature = self._file_signature()
+            except Exception:
+                self._data = None
+                self._signature = None
+                if os.path.exists(temp_file):
+                    try:
+                        os.remove(temp_file)
+                    except OSError:
+                        pass
+                raise
+            self._set_data(data, signature)
+
+    @classmethod
+    def _term_weights(cls, title, content):
+        weights = {}
+        for token in tokenize(title):
+            weights[token] = weights.get(token, 0) + cls.TITLE_WEIGHT
+        for token in tokenize(content):
+            weights[token] = weights.get(token, 0) + 1
+        return weights
+
+    @staticmethod
+    def _remove_key(data, key, sorted_terms=None):
+        """Bỏ item khỏi postings (sorted_terms: danh sách term đã sắp xếp cần cập nhật theo)"""
+        postings = data['postings']
+        for term in data['items'].pop(key, []):
+            posting = postings.get(term)
+            if posting is None:
+                continue
+            posting.pop(key, None)
+            if not posting:
+                del postings[term]
+                if sorted_terms is not None:
+                    position = bisect.bisect_left(sorted_terms, term)
+                    if position < len(sorted_terms) and sorted_terms[position] == term:
+                        del sorted_terms[position]
+
+    @staticmethod
+    def _add_key(data, key, weights, sorted_terms=None):
+        """Thêm item vào postings (sorted_terms: danh sách term đã sắp xếp cần cập nhật theo)"""
+        postings = data['postings']
+        for term, weight in weights.items():
+            posting = postings.get(term)
+            if posting is None:
+                posting = postings[term] = {}
+                if sorted_terms is not None:
+                    bisect.insort(sorted_terms, term)
+            posting[key] = weight
+        data['items'][key] = list(weights)
+
+    def index_item(self, item_type, item_id, title, content):
+        """Thêm hoặc cập nhật một note/doc trong index"""
+        key = self.item_key(item_type, item_id)
+        weights = self._term_weights(title, content)
+        with self._lock, locked_file(self.lock_file):
+            self._load()
+            self._append_delta(key, weights)
+
+    def remove_item(self, item_type, item_id):
+        """Xóa một note/doc khỏi index"""
+        key = self.item_key(item_type, item_id)
+        with self._lock, locked_file(self.lock_file):
+            data = self._load()
+            if key not in data['items']:
+                return
+            self._append_delta(key, None)
+
+    def rebuild(self, items):
+        """Build lại toàn bộ index (ghi snapshot thế hệ mới và bắt đầu log mới)
+
+        Args:
+            items: iterable các tuple (item_type, item_id, title, content)
+        """
+        data = {'postings': {}, 'items': {}}
+        for item_type, item_id, title, content in items:
+            self._add_key(data, self.item_key(item_type, item_id), self._term_weights(title, content))
+        with self._lock, locked_file(self.lock_file):
+            data['generation'] = self._load()['generation'] + 1
+            self._save(data)
+            self._reset_log(data['generation'])
+
+    def _matching_postings(self, data, term, prefix):
+        """Lấy các posting khớp với term (khớp tiền tố nếu prefix=True)"""
+        postings = data['postings']
+        if not prefix:
+            posting = postings.get(term)
+            return [posting] if posting else []
+        matches = []
+        sorted_terms = self._sorted_terms
+        position = bisect.bisect_left(sorted_terms, term)
+        while position < len(sorted_terms) and sorted_terms[position].startswith(term):
+            matches.append(postings[sorted_terms[position]])
+            position += 1
+        return matches
+
+    def search(self, query, item_type=None, limit=None):
+        """Tìm kiếm, trả về danh sách (item_type, item_id, score) sắp xếp theo điểm giảm dần
+
+        Mọi token của query phải xuất hiện (AND); token cuối được khớp theo tiền tố
+        để hỗ trợ gợi ý khi đang gõ.
+        """
+        terms = tokenize(query)
+        if not terms:
+            return []
+        with self._lock:
+            data = self._load()
+            total_items = max(len(data['items']), 1)
+            scores = None
+            for position, term in enumerate(terms):
+                is_last = position == len(terms) - 1
+                term_scores = {}
+                for posting in self._matching_postings(data, term, prefix=is_last):
+                    idf = math.log(1 + total_items / len(posting))
+                    for key, weight in posting.items():
+                        if item_type and not key.startswith(item_type + ':'):
+                            continue
+                        term_scores[key] = term_scores.get(key, 0) + weight * idf
+                if scores is None:
+                    scores = term_scores
+                else:
+                    scores = {key: score + term_scores[key] for key, score in scores.items() if key in term_scores}
+                if not scores:
+                    return []
+
+        ranked = sorted(scores.items(), key=lambda x: x[1], reverse=True)
+        if limit is not None:
+            ranked = ranked[:limit]
+        results = []
+        for key, score in ranked:
+            kind, item_id = key.split(':', 1)
+            results.append((kind, int(item_id), score))
+        return results